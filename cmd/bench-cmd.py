@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+import sys, os, time, tempfile, hashlib, subprocess, shutil, json
+from cStringIO import StringIO
+from bup import git, hashsplit, index, drecurse, options, path, _helpers
+from bup import _version
+from bup.helpers import *
+
+
+optspec = """
+bup bench [-s size] [-n number] [--json] [benchmarks...]
+--
+s,size=    bytes of random data to split, write and read [32M]
+n,number=  number of objects to look up [100000]
+f,files=   number of files to index and scan [10000]
+S,seed=    random number seed [1]
+r,repeat=  run each read-only benchmark n times and keep the best [3]
+json       print the results as JSON
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+opt.size = parse_num(opt.size)
+if opt.size < 1024*1024:
+    o.fatal('--size must be at least 1M')
+if opt.number < 1 or opt.files < 1 or opt.repeat < 1:
+    o.fatal('--number, --files and --repeat must be at least 1')
+
+handle_ctrl_c()
+
+
+results = []  # (name, value, unit), in the order they were measured
+
+def result(name, value, unit):
+    results.append((name, value, unit))
+    if not opt.json:
+        print '%-24s %12.2f %s' % (name, value, unit)
+        sys.stdout.flush()
+
+
+def best_time(fn):
+    # The fastest of several runs is the least disturbed by the rest of
+    # the system, so it's the most reproducible.
+    best = None
+    for i in xrange(opt.repeat):
+        start = time.time()
+        fn()
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return max(best, 1e-9)
+
+
+def run_bup(*args):
+    argv = [path.exe()] + list(args)
+    rv = subprocess.call(argv, stdout=open('/dev/null', 'w'))
+    if rv:
+        raise Exception('%r returned %d' % (argv, rv))
+
+
+_data = None
+def data():
+    global _data
+    if _data is None:
+        name = os.path.join(tmpdir, 'random')
+        fd = os.open(name, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0600)
+        try:
+            _helpers.write_random(fd, opt.size, opt.seed, 0)
+        finally:
+            os.close(fd)
+        _data = open(name).read()
+    return _data
+
+
+_blobs = None
+def blobs():
+    global _blobs
+    if _blobs is None:
+        _blobs = hashsplit.read_blobs([StringIO(data())])
+    return _blobs
+
+
+def use_repo(name):
+    d = os.path.join(tmpdir, name)
+    if os.path.exists(d):
+        git.check_repo_or_die(d)
+    else:
+        git.init_repo(d)
+    os.environ['BUP_DIR'] = git.repodir  # for run_bup()
+
+
+_tree = None
+def repo(timed=False):
+    # Write blobs() and their tree to a new repository.
+    global _tree
+    if _tree is None:
+        use_repo('repo')
+        start = time.time()
+        w = git.PackWriter()
+        mode, _tree = hashsplit.blobs_to_blob_or_tree(w.new_blob, w.new_tree,
+                                                      blobs())
+        w.close(run_midx=False)
+        secs = max(time.time() - start, 1e-9)
+        if timed:
+            result('write', len(blobs()) / secs, 'objects/s')
+            result('write-bytes', len(data()) / secs / 1e6, 'MB/s')
+    return _tree
+
+
+def lookup_repo(npacks=8):
+    # Write blobs() to a new repository in several packs, so that there is
+    # something for midx and bloom to do.
+    use_repo('lookup')
+    per_pack = len(blobs()) // npacks + 1
+    for i in xrange(0, len(blobs()), per_pack):
+        w = git.PackWriter()
+        for b, level in blobs()[i:i+per_pack]:
+            w.new_blob(b)
+        w.close(run_midx=False)
+    return git.repo('objects/pack')
+
+
+_files = None
+def files():
+    global _files
+    if _files is None:
+        _files = os.path.join(tmpdir, 'files')
+        for i in xrange(opt.files):
+            d = os.path.join(_files, '%03d' % (i // 100))
+            if not i % 100:
+                os.makedirs(d)
+            open(os.path.join(d, '%05d' % i), 'w').close()
+    return _files
+
+
+def bench_split():
+    buf = data()
+    mb = len(buf) / 1e6
+    for name, find_splits in sorted(hashsplit.CHUNKERS.items()):
+        result('split-%s' % name, mb / best_time(lambda: find_splits(buf)),
+               'MB/s')
+    def split():
+        for blob, level in hashsplit.hashsplit_iter([StringIO(buf)],
+                                                    False, None):
+            pass
+    result('hashsplit', mb / best_time(split), 'MB/s')
+
+
+def bench_write():
+    repo(timed=True)
+
+
+def bench_exists():
+    packdir = lookup_repo()
+    hits = [git.calc_hash('blob', b) for b, level in blobs()]
+    hits = [hits[i % len(hits)] for i in xrange(opt.number)]
+    misses = [hashlib.sha1('%d %d' % (opt.seed, i)).digest()
+              for i in xrange(opt.number)]
+    def lookups(exists, shas):
+        for sha in shas:
+            exists(sha)
+    for variant in ('idx', 'midx', 'bloom'):
+        if variant == 'midx':
+            run_bup('midx', '-f', '--dir', packdir)
+        elif variant == 'bloom':
+            run_bup('bloom', '--dir', packdir)
+        git.ignore_midx = (variant == 'idx')
+        ix = git.PackIdxList(packdir)
+        if variant != 'bloom':
+            ix.bloom = None
+        for kind, shas in (('hit', hits), ('miss', misses)):
+            secs = best_time(lambda: lookups(ix.exists, shas))
+            result('exists-%s-%s' % (variant, kind),
+                   secs * 1e6 / len(shas), 'us/lookup')
+        secs = best_time(lambda: ix.exists_many(hits + misses))
+        result('exists-%s-many' % variant,
+               secs * 1e6 / (len(hits) + len(misses)), 'us/lookup')
+        ix = None  # only one PackIdxList may exist at a time
+    git.ignore_midx = 0
+
+
+def bench_join():
+    tree = repo().encode('hex')
+    use_repo('repo')
+    for name, reader in (('join', git.PackReader()),
+                         ('join-catpipe', git.CatPipe())):
+        def join():
+            for b in reader.join(tree):
+                pass
+        result(name, len(data()) / best_time(join) / 1e6, 'MB/s')
+
+
+def bench_index():
+    name = os.path.join(tmpdir, 'bupindex')
+    run_bup('index', '-f', name, files())
+    def read():
+        for e in index.Reader(name):
+            pass
+    count = opt.files + opt.files // 100 + 1
+    result('index', count / best_time(read), 'entries/s')
+
+
+def bench_drecurse():
+    top = files()
+    def scan():
+        for name, st in drecurse.recursive_dirlist([top], xdev=False):
+            pass
+    count = opt.files + opt.files // 100 + 1
+    result('drecurse', count / best_time(scan), 'entries/s')
+
+
+benchmarks = [
+    ('split', bench_split),
+    ('write', bench_write),
+    ('exists', bench_exists),
+    ('join', bench_join),
+    ('index', bench_index),
+    ('drecurse', bench_drecurse),
+]
+
+names = [name for name, fn in benchmarks]
+for name in extra:
+    if name not in names:
+        o.fatal('unknown benchmark %r (not one of %s)'
+                % (name, ', '.join(names)))
+
+tmpdir = tempfile.mkdtemp(prefix='bup-bench-')
+try:
+    for name, fn in benchmarks:
+        if not extra or name in extra:
+            fn()
+finally:
+    shutil.rmtree(tmpdir)
+
+if opt.json:
+    json.dump({'commit': _version.COMMIT,
+               'parameters': {'size': opt.size, 'number': opt.number,
+                              'files': opt.files, 'seed': opt.seed,
+                              'repeat': opt.repeat},
+               'results': [{'name': name, 'value': value, 'unit': unit}
+                           for name, value, unit in results]},
+              sys.stdout, indent=2, sort_keys=True)
+    print
+
+if saved_errors:
+    log('WARNING: %d errors encountered.\n' % len(saved_errors))
+    sys.exit(1)
@@ -11,6 +11,7 @@ f,force    ignore existing bloom file and regenerate it from scratch
 o,output=  output bloom filename (default: auto)
 d,dir=     input directory to look for idx files (default: auto)
 k,hashes=  number of hash functions to use (4 or 5) (default: auto)
+format=    2, or 3 for a blocked filter (default: the existing one's, or 2)
 c,check=   check the given .idx file against the bloom filter
 """
 
@@ -22,7 +23,7 @@ def ruin_bloom(bloomfilename):
         add_error("bloom: %s not found to ruin\n" % rbloomfilename)
         return
     b = bloom.ShaBloom(bloomfilename, readwrite=True, expected=1)
-    b.map[16:16+2**b.bits] = '\0' * 2**b.bits
+    b.map[b.headerlen:b.headerlen+2**b.bits] = '\0' * 2**b.bits
 
 
 def check_bloom(path, bloomfilename, idx):
@@ -53,11 +54,25 @@ _first = None
 def do_bloom(path, outfilename):
     global _first
     b = None
-    if os.path.exists(outfilename) and not opt.force:
+    if os.path.exists(outfilename):
         b = bloom.ShaBloom(outfilename)
         if not b.valid():
             debug1("bloom: Existing invalid bloom found, regenerating.\n")
             b = None
+    # Even when it's regenerated, keep the kind of filter there was.
+    version = opt.format or (b and b.version) or 2
+    if version == bloom.BLOCKED_VERSION:
+        if opt.k and not 1 <= opt.k <= bloom.BLOCKED_MAX_K:
+            o.fatal('k must be between 1 and %d for a blocked filter'
+                    % bloom.BLOCKED_MAX_K)
+    elif opt.k and opt.k not in (4,5):
+        o.fatal('only k values of 4 and 5 are supported')
+    if b and opt.force:
+        b = None
+    elif b and b.version != version:
+        debug1("bloom: regenerating: version %d != %d.\n"
+               % (b.version, version))
+        b = None
 
     add = []
     rest = []
@@ -92,6 +107,9 @@ def do_bloom(path, outfilename):
             b = None
         else:
             b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
+            # A save may have added some of them in place meanwhile.
+            add = [name for name in add
+                   if os.path.basename(name) not in b.idxnames]
     if not b: # Need all idxs to build from scratch
         add += rest
         add_count += rest_count
@@ -108,8 +126,10 @@ def do_bloom(path, outfilename):
 
     tfname = None
     if b is None:
-        tfname = os.path.join(path, 'bup.tmp.bloom')
-        b = bloom.create(tfname, expected=add_count, k=opt.k)
+        # A bup bloom started in the background by a save may be
+        # regenerating it too, so don't share the temporary file.
+        tfname = os.path.join(path, 'bup.tmp.%d.bloom' % os.getpid())
+        b = bloom.create(tfname, expected=add_count, k=opt.k, version=version)
     count = 0
     icount = 0
     for name in add:
@@ -120,12 +140,29 @@ def do_bloom(path, outfilename):
         count += 1
         icount += len(ix)
 
-    # Currently, there's an open file object for tfname inside b.
-    # Make sure it's closed before rename.
-    b.close()
+    if not tfname:
+        b.close()
+        return
 
-    if tfname:
+    # Saves add their packs to the old filter in place (see
+    # git.add_to_bloom()).  Hold its lock while the packs that were
+    # written meanwhile are added to the new one too, and it's renamed
+    # over the old one; writers that were waiting then find the new one.
+    old = os.path.exists(outfilename) and bloom.lock(outfilename)
+    try:
+        have = set(b.idxnames)
+        for name in glob.glob('%s/*.idx' % path):
+            if os.path.basename(name) not in have:
+                debug1('bloom: adding %s, written meanwhile\n'
+                       % os.path.basename(name))
+                b.add_idx(git.open_idx(name))
+        # Currently, there's an open file object for tfname inside b.
+        # Make sure it's closed before rename.
+        b.close()
         os.rename(tfname, outfilename)
+    finally:
+        if old:
+            old.close()
 
 
 handle_ctrl_c()
@@ -138,8 +175,8 @@ if extra:
 
 git.check_repo_or_die()
 
-if not opt.check and opt.k and opt.k not in (4,5):
-    o.fatal('only k values of 4 and 5 are supported')
+if opt.format and opt.format not in (2, bloom.BLOCKED_VERSION):
+    o.fatal('only formats 2 and 3 are supported')
 
 paths = opt.dir and [opt.dir] or git.all_packdirs()
 for path in paths:
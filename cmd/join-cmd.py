@@ -24,7 +24,7 @@ if opt.remote:
     cli = client.Client(opt.remote)
     cat = cli.cat
 else:
-    cp = git.CatPipe()
+    cp = git.PackReader()
     cat = cp.join
 
 if opt.o:
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys, re, struct, time, resource
+import sys, re, struct, time, resource, glob, tempfile, shutil
 from bup import git, bloom, midx, options, _helpers
 from bup.helpers import *
 
@@ -58,6 +58,43 @@ def report(count):
     last = time.time()
 
 
+def compare_blooms():
+    # Build each kind of bloom filter from the repository's idxs, then see
+    # how many random (so almost certainly missing) objects they let
+    # through, and how long it takes to ask them.
+    names = glob.glob(git.repo('objects/pack/*.idx'))
+    count = sum(len(git.open_idx(name)) for name in names)
+    if not count:
+        o.fatal('no objects in the repository')
+    tmpdir = tempfile.mkdtemp(prefix='bup-memtest-')
+    try:
+        for version in (2, bloom.BLOCKED_VERSION):
+            b = bloom.create(os.path.join(tmpdir, 'v%d.bloom' % version),
+                             expected=count, version=version)
+            for name in names:
+                b.add_idx(git.open_idx(name))
+            expected = b.pfalse_positive()
+            b.close()
+            b = bloom.ShaBloom(b.name)
+            positives = 0
+            secs = 0
+            for c in xrange(opt.cycles):
+                shas = [_helpers.random_sha() for n in xrange(opt.number)]
+                start = time.time()
+                for sha in shas:
+                    if b.exists(sha):
+                        positives += 1
+                secs += time.time() - start
+            lookups = opt.cycles * opt.number
+            print ('bloom v%d, k=%d, 2^%d bytes: %.4f%% false positives'
+                   ' (%.4f%% expected), %.3f us/lookup'
+                   % (version, b.k, b.bits, positives * 100.0 / lookups,
+                      expected, secs * 1e6 / lookups))
+            b.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 optspec = """
 bup memtest [-n elements] [-c cycles]
 --
@@ -65,6 +102,7 @@ n,number=  number of objects per cycle [10000]
 c,cycles=  number of cycles to run [100]
 ignore-midx  ignore .midx files, use only .idx files
 existing   test with existing objects instead of fake ones
+bloom      compare the false positives and speed of each bloom filter format
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -75,6 +113,11 @@ if extra:
 git.ignore_midx = opt.ignore_midx
 
 git.check_repo_or_die()
+
+if opt.bloom:
+    compare_blooms()
+    sys.exit(0)
+
 m = git.PackIdxList(git.repo('objects/pack'))
 
 report(-1)
@@ -4,8 +4,8 @@ import tempfile
 from bup import options, git, midx, _helpers, xstat
 from bup.helpers import *
 
-PAGE_SIZE=4096
-SHA_PER_PAGE=PAGE_SIZE/20.
+TIER_BASE=1024  # objects that count as much as one more pack does
+DEFAULT_FAN_IN=4
 
 optspec = """
 bup midx [options...] <idxnames...>
@@ -16,6 +16,7 @@ f,force    merge produce exactly one .midx containing all objects
 p,print    print names of generated midx files
 check      validate contents of the given midx files (with -a, all midx files)
 max-files= maximum number of idx files to open at once [-1]
+fan-in=    with -a, merge this many indexes of about the same size at a time
 d,dir=     directory containing idx/midx files
 """
 
@@ -108,8 +109,7 @@ def _do_midx(outdir, outfilename, infilenames, prefixstr):
             debug1('midx: nothing to do.\n')
             return
 
-        pages = int(total/SHA_PER_PAGE) or 1
-        bits = int(math.ceil(math.log(pages, 2)))
+        bits = midx.table_bits(total)
         entries = 2**bits
         debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
 
@@ -160,6 +160,7 @@ def do_midx(outdir, outfilename, infilenames, prefixstr):
 def do_midx_dir(path):
     already = {}
     sizes = {}
+    packs = {}  # how many packs each index covers
     if opt.force and not opt.auto:
         midxs = []   # don't use existing midx files
     else:
@@ -169,6 +170,7 @@ def do_midx_dir(path):
             m = git.open_idx(mname)
             contents[mname] = [('%s/%s' % (path,i)) for i in m.idxnames]
             sizes[mname] = len(m)
+            packs[mname] = len(m.idxnames)
                     
         # sort the biggest+newest midxes first, so that we can eliminate
         # smaller (or older) redundant ones that come later in the list
@@ -191,25 +193,14 @@ def do_midx_dir(path):
     for iname in idxs:
         i = git.open_idx(iname)
         sizes[iname] = len(i)
+        packs[iname] = 1
 
     all = [(sizes[n],n) for n in (midxs + idxs)]
-    
-    # FIXME: what are the optimal values?  Does this make sense?
-    DESIRED_HWM = opt.force and 1 or 5
-    DESIRED_LWM = opt.force and 1 or 2
     existed = dict((name,1) for sz,name in all)
-    debug1('midx: %d indexes; want no more than %d.\n' 
-           % (len(all), DESIRED_HWM))
-    if len(all) <= DESIRED_HWM:
-        debug1('midx: nothing to do.\n')
-    while len(all) > DESIRED_HWM:
-        all.sort()
-        part1 = [name for sz,name in all[:len(all)-DESIRED_LWM+1]]
-        part2 = all[len(all)-DESIRED_LWM+1:]
-        all = list(do_midx_group(path, part1)) + part2
-        if len(all) > DESIRED_HWM:
-            debug1('\nStill too many indexes (%d > %d).  Merging again.\n'
-                   % (len(all), DESIRED_HWM))
+    if opt.force:
+        all = do_midx_all(path, all)
+    else:
+        all = do_midx_tiers(path, all, packs)
 
     if opt['print']:
         for sz,name in all:
@@ -217,6 +208,57 @@ def do_midx_dir(path):
                 print name
 
 
+def do_midx_all(path, all):
+    debug1('midx: %d indexes; want no more than 1.\n' % len(all))
+    if len(all) <= 1:
+        debug1('midx: nothing to do.\n')
+    while len(all) > 1:
+        all = list(do_midx_group(path, [name for sz,name in all]))
+        if len(all) > 1:
+            debug1('\nStill too many indexes (%d > 1).  Merging again.\n'
+                   % len(all))
+    return all
+
+
+def tier(size, packs):
+    # Indexes in the same tier are within a factor of fan_in in weight.
+    # The weight of a merged index is the sum of the weights of what went
+    # into it, so merging fan_in indexes of a tier always makes one of a
+    # higher tier, even when they're too small for their sizes to show it.
+    return int(math.log(size / float(TIER_BASE) + packs, fan_in))
+
+
+def do_midx_tiers(path, all, packs):
+    """Merge the indexes in the list of (size, name) all, fan_in at a time,
+    whenever that many are in the same tier, and return what's left.
+    packs says how many packs each of them covers.
+
+    Each merge moves objects to a higher tier, so each object is only
+    rewritten about log(total weight, fan_in) times, however often it's
+    done.
+    """
+    while 1:
+        tiers = {}
+        for sz,name in all:
+            tiers.setdefault(tier(sz, packs[name]), []).append((sz,name))
+        full = [t for t,members in tiers.iteritems() if len(members) >= fan_in]
+        if not full:
+            debug1('midx: %d indexes in %d tiers; nothing to do.\n'
+                   % (len(all), len(tiers)))
+            return all
+        t = min(full)
+        # Only the smallest, so that what's left can fill the tier again
+        # before it's merged.
+        members = sorted(tiers[t])[:fan_in]
+        debug1('midx: merging %d indexes in tier %d.\n' % (len(members), t))
+        merged = list(do_midx_group(path, [name for sz,name in members]))
+        if not merged:
+            return all
+        for sz,name in merged:
+            packs[name] = sum(packs[n] for sz,n in members)
+        all = [e for e in all if e not in members] + merged
+
+
 def do_midx_group(outdir, infiles):
     groups = list(_group(infiles, opt.max_files))
     gprefix = ''
@@ -244,6 +286,14 @@ if opt.max_files < 0:
     opt.max_files = max_files()
 assert(opt.max_files >= 5)
 
+fan_in = opt.fan_in or git.git_config_get('bup.midx.fanin') or DEFAULT_FAN_IN
+try:
+    fan_in = int(fan_in)
+except ValueError:
+    fan_in = 0
+if not 2 <= fan_in <= opt.max_files:
+    o.fatal('the fan-in must be between 2 and %d' % opt.max_files)
+
 if opt.check:
     # check existing midx files
     if extra:
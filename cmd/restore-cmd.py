@@ -1,6 +1,7 @@
 #!/usr/bin/env python
-import copy, errno, sys, stat, re
-from bup import options, git, metadata, vfs
+import copy, errno, sys, stat, re, threading, Queue
+from collections import deque
+from bup import options, git, hashsplit, metadata, vfs
 from bup.helpers import *
 from bup._helpers import write_sparsely
 
@@ -12,6 +13,8 @@ numeric-ids restore numeric IDs (user, group, etc.) rather than names
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 sparse      create sparse files
+j,jobs=     write up to n files at a time [1]
+pack-order  read file content in the order it's stored in the packs
 v,verbose   increase log output (can be used more than once)
 map-user=   given OLD=NEW, restore OLD user as NEW user
 map-group=  given OLD=NEW, restore OLD group as NEW group
@@ -157,20 +160,20 @@ def hardlink_if_possible(fullname, node, meta):
     return False
 
 
-def write_file_content(fullname, n):
+def write_file_content(fullname, blocks):
     outf = open(fullname, 'wb')
     try:
-        for b in chunkyreader(n.open()):
+        for b in blocks:
             outf.write(b)
     finally:
         outf.close()
 
 
-def write_file_content_sparsely(fullname, n):
+def write_file_content_sparsely(fullname, blocks):
     outfd = os.open(fullname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
     try:
         trailing_zeros = 0;
-        for b in chunkyreader(n.open()):
+        for b in blocks:
             trailing_zeros = write_sparsely(outfd, b, 512, trailing_zeros)
         pos = os.lseek(outfd, trailing_zeros, os.SEEK_END)
         os.ftruncate(outfd, pos)
@@ -178,28 +181,229 @@ def write_file_content_sparsely(fullname, n):
         os.close(outfd)
 
 
+# With --jobs, the content of regular files is read from the repository
+# and written on worker threads, each with its own PackReader, while the
+# main loop goes on creating the paths that come next.  What has to wait
+# for some content -- applying the metadata of a file, and then of the
+# directories around it, which sets their times and permissions -- is
+# queued instead, and run in the same order as without --jobs, as soon
+# as all of the writes that were queued before it are done.  Paths are
+# created in the main loop, so hardlinks can still be made to files
+# whose content is being written.
+#
+# With --pack-order, the writes are gathered instead, until the chunks
+# of the files add up to STAGING_MAX.  Then the chunks are found in the
+# idx files, read in the order they're in their packs, which is close
+# to the order they were saved in, and kept in memory while the files
+# are written from them.  After many incremental saves the chunks of a
+# directory are spread over many packs, and reading them in tree order
+# would be close to random I/O.
+
+PENDING_MAX = 10000  # metadata waiting for writes to finish
+STAGING_MAX = 64*1024*1024  # bytes of chunks read ahead with --pack-order
+
+class _Writer:
+    """What's common to the writers: the writes are numbered as they're
+    queued, and what's queued with later() is run in order, once all the
+    writes before it are done.  A subclass provides _collect(wait), which
+    notes the writes that are done, waiting for some if wait is true,
+    and then calls _run_ready()."""
+    def __init__(self):
+        self.queued = 0  # writes queued so far
+        self.written = 0  # how many writes are done, from the first one on
+        self.pending = deque()  # (writes it waits for, function, args)
+
+    def _run_ready(self):
+        while self.pending and self.pending[0][0] <= self.written:
+            (needs, f, args) = self.pending.popleft()
+            f(*args)
+
+    def later(self, f, *args):
+        """Call f(*args) once all the writes queued so far are done."""
+        self._collect(False)
+        if self.written == self.queued and not self.pending:
+            f(*args)
+            return
+        self.pending.append((self.queued, f, args))
+        while len(self.pending) > PENDING_MAX:
+            self._collect(True)
+
+    def wait(self):
+        """Wait for all the writes, and for what's queued after them."""
+        while self.written < self.queued:
+            self._collect(True)
+        self._collect(False)
+
+    def close(self):
+        pass
+
+
+class ContentWriter(_Writer):
+    def __init__(self, jobs):
+        _Writer.__init__(self)
+        self.todo = Queue.Queue(jobs * 8)
+        self.done = Queue.Queue()
+        self.finished = set()  # the writes that are done after the others
+        self.threads = []
+        for i in xrange(jobs):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        reader = git.PackReader()
+        try:
+            while 1:
+                job = self.todo.get()
+                if job is None:
+                    return
+                (seq, fullname, hexsha, sparse) = job
+                try:
+                    write = (sparse and write_file_content_sparsely
+                             or write_file_content)
+                    write(fullname, reader.join(hexsha))
+                except:
+                    self.done.put((seq, sys.exc_info()))
+                else:
+                    self.done.put((seq, None))
+        finally:
+            reader.close()
+
+    def _collect(self, wait):
+        while 1:
+            try:
+                # With a timeout, so that ^C isn't held up.
+                (seq, exc) = self.done.get(wait, 1)
+            except Queue.Empty:
+                if wait:
+                    continue
+                break
+            wait = False
+            if exc:
+                raise exc[0], exc[1], exc[2]
+            self.finished.add(seq)
+            while self.written in self.finished:
+                self.finished.remove(self.written)
+                self.written += 1
+        self._run_ready()
+
+    def write(self, fullname, n, sparse):
+        self.todo.put((self.queued, fullname, n.hash.encode('hex'), sparse))
+        self.queued += 1
+        self._collect(False)
+
+    def close(self):
+        for t in self.threads:
+            self.todo.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class PackOrderWriter(_Writer):
+    def __init__(self):
+        _Writer.__init__(self)
+        self.reader = git.cp()
+        self.files = []  # (fullname, sparse, chunk shas)
+        self.chunks = {}  # sha -> (idx basename, offset, size), or None
+        self.size = 0  # of the chunks, once they're read
+
+    def _chunk_shas(self, n):
+        """Return the shas of the blobs that make up the content of n."""
+        if n.bupmode != git.BUP_CHUNKED:
+            return [n.hash]
+        shas = []
+        todo = [(hashsplit.GIT_MODE_TREE, n.hash)]  # what's left, last first
+        while todo:
+            (mode, sha) = todo.pop()
+            if stat.S_ISDIR(mode):
+                todo.extend((mode, sha) for (mode, name, sha)
+                            in reversed(git.read_tree(sha)))
+            else:
+                shas.append(sha)
+        return shas
+
+    def _flush(self):
+        # Loose objects (None) are read first, then each pack in turn.
+        order = sorted(self.chunks.iteritems(), key=lambda (sha, loc): loc)
+        staged = {}
+        for (sha, loc) in order:
+            it = self.reader.get(sha.encode('hex'))
+            it.next()  # the type
+            staged[sha] = ''.join(it)
+        for (fullname, sparse, shas) in self.files:
+            write = (sparse and write_file_content_sparsely
+                     or write_file_content)
+            write(fullname, (staged[sha] for sha in shas))
+        self.written = self.queued
+        self.files = []
+        self.chunks = {}
+        self.size = 0
+
+    def _collect(self, wait):
+        if wait:
+            self._flush()
+        self._run_ready()
+
+    def write(self, fullname, n, sparse):
+        shas = self._chunk_shas(n)
+        new = []
+        size = 0
+        for sha in shas:
+            if sha not in self.chunks:
+                loc = self.chunks[sha] = self.reader.locate(sha)
+                new.append(sha)
+                if loc:
+                    size += loc[2]
+        if size > STAGING_MAX:
+            # Too big to keep in memory; it's written on its own, from
+            # packs that it mostly has to itself anyway.
+            for sha in new:
+                del self.chunks[sha]
+            self._flush()
+            write = (sparse and write_file_content_sparsely
+                     or write_file_content)
+            write(fullname, chunkyreader(n.open()))
+            self.queued += 1
+            self.written += 1
+            return
+        self.files.append((fullname, sparse, shas))
+        self.queued += 1
+        self.size += size
+        if self.size >= STAGING_MAX:
+            self._flush()
+
+
+writer = None
+
+def write_content(fullname, n, sparse):
+    if writer:
+        writer.write(fullname, n, sparse)
+    elif sparse:
+        write_file_content_sparsely(fullname, chunkyreader(n.open()))
+    else:
+        write_file_content(fullname, chunkyreader(n.open()))
+
+
+def apply_metadata_later(meta, name, restore_numeric_ids, owner_map):
+    """Like apply_metadata(), but after the content of any files that
+    are still being written."""
+    if writer:
+        writer.later(apply_metadata, meta, name, restore_numeric_ids,
+                     owner_map)
+    else:
+        apply_metadata(meta, name, restore_numeric_ids, owner_map)
+
+
 def find_dir_item_metadata_by_name(dir, name):
     """Find metadata in dir (a node) for an item with the given name,
     or for the directory itself if the name is ''."""
-    meta_stream = None
+    if name == '':
+        return dir.metadata()
     try:
-        mfile = dir.metadata_file() # VFS file -- cannot close().
-        if mfile:
-            meta_stream = mfile.open()
-            # First entry is for the dir itself.
-            meta = metadata.Metadata.read(meta_stream)
-            if name == '':
-                return meta
-            for sub in dir:
-                if stat.S_ISDIR(sub.mode):
-                    meta = find_dir_item_metadata_by_name(sub, '')
-                else:
-                    meta = metadata.Metadata.read(meta_stream)
-                if sub.name == name:
-                    return meta
-    finally:
-        if meta_stream:
-            meta_stream.close()
+        return dir.sub(name).metadata()
+    except vfs.NoSuchFile:
+        return None
 
 
 def do_root(n, sparse, owner_map, restore_root_meta = True):
@@ -227,7 +431,7 @@ def do_root(n, sparse, owner_map, restore_root_meta = True):
                 m = metadata.Metadata.read(meta_stream)
             do_node(n, sub, sparse, owner_map, meta = m)
         if root_meta and restore_root_meta:
-            apply_metadata(root_meta, '.', opt.numeric_ids, owner_map)
+            apply_metadata_later(root_meta, '.', opt.numeric_ids, owner_map)
     finally:
         if meta_stream:
             meta_stream.close()
@@ -239,7 +443,6 @@ def do_node(top, n, sparse, owner_map, meta = None):
     # metadata).
     global total_restored, opt
     meta_stream = None
-    write_content = sparse and write_file_content_sparsely or write_file_content
     try:
         fullname = n.fullname(stop_at=top)
         # Match behavior of index --exclude-rx with respect to paths.
@@ -265,9 +468,9 @@ def do_node(top, n, sparse, owner_map, meta = None):
             create_path(n, fullname, meta)
             if meta:
                 if stat.S_ISREG(meta.mode):
-                    write_content(fullname, n)
+                    write_content(fullname, n, sparse)
             elif stat.S_ISREG(n.mode):
-                write_content(fullname, n)
+                write_content(fullname, n, sparse)
 
         total_restored += 1
         plog('Restoring: %d\r' % total_restored)
@@ -278,7 +481,7 @@ def do_node(top, n, sparse, owner_map, meta = None):
                 m = metadata.Metadata.read(meta_stream)
             do_node(top, sub, sparse, owner_map, meta = m)
         if meta and not created_hardlink:
-            apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
+            apply_metadata_later(meta, fullname, opt.numeric_ids, owner_map)
     finally:
         if meta_stream:
             meta_stream.close()
@@ -295,7 +498,11 @@ top = vfs.RefList(None)
 
 if not extra:
     o.fatal('must specify at least one filename to restore')
-    
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+if opt.pack_order and opt.jobs > 1:
+    o.fatal('--pack-order and --jobs are incompatible')
+
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 
 owner_map = {}
@@ -306,6 +513,11 @@ if opt.outdir:
     mkdirp(opt.outdir)
     os.chdir(opt.outdir)
 
+if opt.pack_order:
+    writer = PackOrderWriter()
+elif opt.jobs > 1:
+    writer = ContentWriter(opt.jobs)
+
 ret = 0
 for d in extra:
     if not valid_restore_path(d):
@@ -341,6 +553,11 @@ for d in extra:
         else: # Not a directory or fake symlink.
             meta = find_dir_item_metadata_by_name(n.parent, n.name)
             do_node(n.parent, n, opt.sparse, owner_map, meta = meta)
+    if writer:
+        writer.wait()  # before the next path (and chdir) is dealt with
+
+if writer:
+    writer.close()
 
 if not opt.quiet:
     progress('Restoring: %d, done.\n' % total_restored)
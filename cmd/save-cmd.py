@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import sys, stat, time, math
+import sys, stat, time, math, threading, Queue
+from collections import deque
 from cStringIO import StringIO
 from errno import EACCES
 
@@ -25,6 +26,9 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    compress objects using n threads [1]
+split-jobs=  read and split up to n small files at a time [1]
+readahead=  ask the kernel to read up to n bytes of upcoming files early [0]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -37,6 +41,11 @@ if not extra:
 
 opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+if opt.split_jobs < 1:
+    o.fatal('--split-jobs must be at least 1')
+opt.readahead = parse_num(opt.readahead)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 
@@ -80,11 +89,17 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    w = cli.new_packwriter(compression_level=opt.compress, jobs=opt.jobs)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    w = git.PackWriter(compression_level=opt.compress, jobs=opt.jobs)
+
+try:
+    hashsplit.configure(cli and cli.config_get or git.git_config_get)
+except ValueError, e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -230,6 +245,113 @@ def find_hardlink_target(hlink_db, ent):
         if link_paths:
             return link_paths[0]
 
+# With --split-jobs, upcoming small files that need saving are opened,
+# read and split on worker threads while the main loop below is still
+# busy with earlier entries.  The main loop stays the only user of the
+# PackWriter, and consumes the results in index order, so the trees,
+# .bupm files and packs are the same as without it.
+
+SPLIT_AHEAD_MAX_FILE = 4*1024*1024  # larger files are split in the loop
+SPLIT_AHEAD_MAX_BYTES = 64*1024*1024  # total size of files read ahead
+SPLIT_AHEAD_MAX_ENTRIES = 4096  # index entries held back by the lookahead
+
+split_ahead = {}  # ent.name -> SplitJob
+
+class SplitJob:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.blobs = None
+        self.error = None
+        self.done = threading.Event()
+
+def split_worker(todo):
+    while 1:
+        job = todo.get()
+        if job is None:
+            return
+        try:
+            f = hashsplit.open_noatime(job.name)
+        except (IOError, OSError), e:
+            job.error = e
+        else:
+            try:
+                job.blobs = hashsplit.read_blobs([f])
+            except (IOError, OSError), e:
+                job.error = '%s: %s' % (job.name, e)
+            f.close()
+        job.done.set()
+
+def will_read(ent):
+    return (stat.S_ISREG(ent.mode) and ent.exists()
+            and not (opt.smaller and ent.size >= opt.smaller)
+            and not already_saved(ent))
+
+def want_split_ahead(ent):
+    return ent.size <= SPLIT_AHEAD_MAX_FILE and will_read(ent)
+
+def split_ahead_filter(entries, jobs):
+    todo = Queue.Queue()
+    for i in xrange(jobs):
+        t = threading.Thread(target=split_worker, args=(todo,))
+        t.daemon = True
+        t.start()
+    pending = deque()
+    njobs = nbytes = 0
+    try:
+        for item in entries:
+            transname, ent = item
+            if want_split_ahead(ent):
+                job = SplitJob(ent.name, ent.size)
+                split_ahead[ent.name] = job
+                todo.put(job)
+                njobs += 1
+                nbytes += job.size
+            pending.append(item)
+            while (njobs > jobs * 8 or nbytes > SPLIT_AHEAD_MAX_BYTES
+                   or len(pending) > SPLIT_AHEAD_MAX_ENTRIES):
+                item = pending.popleft()
+                job = split_ahead.get(item[1].name)
+                if job:
+                    njobs -= 1
+                    nbytes -= job.size
+                yield item
+        while pending:
+            yield pending.popleft()
+    finally:
+        for i in xrange(jobs):
+            todo.put(None)
+
+# Independently of --split-jobs, ask the kernel to start reading the
+# files the main loop will need next, so that each one doesn't begin
+# with a cold, synchronous read.  At most --readahead bytes of them
+# are requested at a time; larger files only get their beginning
+# requested, and the kernel's own readahead takes over from there.
+
+READAHEAD_MAX_ENTRIES = 4096  # index entries held back by the lookahead
+
+def readahead_filter(entries, budget):
+    pending = deque()  # (item, bytes requested)
+    requested = 0
+    for item in entries:
+        transname, ent = item
+        count = 0
+        if requested < budget and will_read(ent):
+            count = min(ent.size, budget - requested)
+            try:
+                hashsplit.fadvise_willneed(ent.name, count)
+            except (IOError, OSError):
+                count = 0  # the main loop will report it, if it persists
+        requested += count
+        pending.append((item, count))
+        while requested >= budget or len(pending) > READAHEAD_MAX_ENTRIES:
+            item, count = pending.popleft()
+            requested -= count
+            yield item
+    while pending:
+        yield pending.popleft()[0]
+
+
 total = ftotal = 0
 if opt.progress:
     for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_pre):
@@ -262,8 +384,14 @@ tstart = time.time()
 count = subcount = fcount = 0
 lastskip_name = None
 lastdir = ''
-for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
+entries = r.filter(extra, wantrecurse=wantrecurse_during)
+if opt.readahead > 0:
+    entries = readahead_filter(entries, opt.readahead)
+if opt.split_jobs > 1:
+    entries = split_ahead_filter(entries, opt.split_jobs)
+for (transname,ent) in entries:
     (dir, file) = os.path.split(ent.name)
+    split_job = split_ahead.pop(ent.name, None)
     exists = (ent.flags & index.IX_EXISTS)
     hashvalid = already_saved(ent)
     wasmissing = ent.sha_missing()
@@ -373,7 +501,17 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
         (meta.atime, meta.mtime, meta.ctime) = (ent.atime, ent.mtime, ent.ctime)
         metalists[-1].append((sort_key, meta))
     else:
-        if stat.S_ISREG(ent.mode):
+        if stat.S_ISREG(ent.mode) and split_job:
+            split_job.done.wait()
+            if split_job.error:
+                add_error(split_job.error)
+                lastskip_name = ent.name
+            else:
+                (mode, id) = hashsplit.blobs_to_blob_or_tree(
+                                        w.new_blob, w.new_tree,
+                                        split_job.blobs,
+                                        makeblobs=w.new_blobs)
+        elif stat.S_ISREG(ent.mode):
             try:
                 f = hashsplit.open_noatime(ent.name)
             except (IOError, OSError), e:
@@ -143,12 +143,18 @@ def update_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, option):
+    _init_session()
+    conn.write('%s\n' % (git.git_config_get(option) or ''))
+    conn.ok()
+
+
 cat_pipe = None
 def cat(conn, id):
     global cat_pipe
     _init_session()
     if not cat_pipe:
-        cat_pipe = git.CatPipe()
+        cat_pipe = git.PackReader()
     try:
         for blob in cat_pipe.join(id):
             conn.write(struct.pack('!I', len(blob)))
@@ -183,6 +189,7 @@ commands = {
     'receive-objects-v2': receive_objects_v2,
     'read-ref': read_ref,
     'update-ref': update_ref,
+    'config-get': config_get,
     'cat': cat,
 }
 
@@ -8,6 +8,7 @@ optspec = """
 bup split [-t] [-c] [-n name] OPTIONS [--git-ids | filenames...]
 bup split -b OPTIONS [--git-ids | filenames...]
 bup split <--noop [--copy]|--copy>  OPTIONS [--git-ids | filenames...]
+bup split --params [-r host:path]
 --
  Modes:
 b,blobs    output a series of blob ids.  Implies --fanout=0.
@@ -16,6 +17,7 @@ c,commit   output a commit id
 n,name=    save the result under the given name
 noop       split the input, but throw away the result
 copy       split the input, copy it to stdout, don't save to repo
+params     print the repository's chunking parameters
  Options:
 r,remote=  remote repository path
 d,date=    date for the commit (seconds since the epoch)
@@ -29,15 +31,20 @@ max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
 bwlimit=   maximum bytes/sec to transmit to server
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    compress objects using n threads [1]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 
 handle_ctrl_c()
 git.check_repo_or_die()
-if not (opt.blobs or opt.tree or opt.commit or opt.name or
-        opt.noop or opt.copy):
-    o.fatal("use one or more of -b, -t, -c, -n, --noop, --copy")
+if opt.params:
+    if (opt.blobs or opt.tree or opt.commit or opt.name or
+        opt.noop or opt.copy or opt.git_ids or extra):
+        o.fatal('--params is incompatible with the other modes and input')
+elif not (opt.blobs or opt.tree or opt.commit or opt.name or
+          opt.noop or opt.copy):
+    o.fatal("use one or more of -b, -t, -c, -n, --noop, --copy, --params")
 if (opt.noop or opt.copy) and (opt.blobs or opt.tree or
                                opt.commit or opt.name):
     o.fatal('--noop and --copy are incompatible with -b, -t, -c, -n')
@@ -53,12 +60,10 @@ if opt.max_pack_size:
     git.max_pack_size = parse_num(opt.max_pack_size)
 if opt.max_pack_objects:
     git.max_pack_objects = parse_num(opt.max_pack_objects)
-if opt.fanout:
-    hashsplit.fanout = parse_num(opt.fanout)
-if opt.blobs:
-    hashsplit.fanout = 0
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
 else:
@@ -85,14 +90,39 @@ if opt.name and opt.name.startswith('.'):
 refname = opt.name and 'refs/heads/%s' % opt.name or None
 if opt.noop or opt.copy:
     cli = pack_writer = oldref = None
+elif opt.params:
+    cli = (opt.remote or is_reverse) and client.Client(opt.remote) or None
+    pack_writer = None
 elif opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
-    pack_writer = cli.new_packwriter(compression_level=opt.compress)
+    pack_writer = cli.new_packwriter(compression_level=opt.compress,
+                                     jobs=opt.jobs)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    pack_writer = git.PackWriter(compression_level=opt.compress)
+    pack_writer = git.PackWriter(compression_level=opt.compress,
+                                 jobs=opt.jobs)
+
+try:
+    hashsplit.configure(cli and cli.config_get or git.git_config_get)
+except ValueError, e:
+    log('error: %s\n' % e)
+    sys.exit(1)
+
+if opt.params:
+    for option, value in hashsplit.params():
+        print '%s=%s' % (option, value)
+    if cli:
+        cli.close()
+    sys.exit(0)
+
+# These only change the shape of the trees, not the blobs, so they're
+# allowed to override the repository's configuration.
+if opt.fanout:
+    hashsplit.fanout = parse_num(opt.fanout)
+if opt.blobs:
+    hashsplit.fanout = 0
 
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
@@ -103,7 +133,7 @@ if opt.git_ids:
     # It would be less ugly if either CatPipe.get() returned a file-like object
     # (not very efficient), or split_to_shalist() expected an iterator instead
     # of a file.
-    cp = git.CatPipe()
+    cp = git.PackReader()
     class IterToFile:
         def __init__(self, it):
             self.it = iter(it)
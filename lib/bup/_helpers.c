@@ -11,6 +11,8 @@
 #include <errno.h>
 #include <fcntl.h>
 #include <arpa/inet.h>
+#include <setjmp.h>
+#include <signal.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <stdio.h>
@@ -38,6 +40,7 @@
 #endif
 
 #include "bupsplit.h"
+#include "fastcdc.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
 #define BUP_HAVE_FILE_ATTRS 1
@@ -394,6 +397,103 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
 }
 
 
+// Return every (end offset, bits) split in buf as packed native unsigned
+// ints, using either bupsplit or fastcdc, and never making a blob bigger
+// than max_blob.
+static PyObject *find_all_splits(const unsigned char *buf, Py_ssize_t len,
+                                 int max_blob, int use_fastcdc, int bits)
+{
+    Py_ssize_t ofs = 0, n = 0, size = 64;
+    int out, outbits, nomem = 0;
+    PyObject *result;
+    unsigned int *splits, *tmp;
+
+    assert(len <= INT_MAX);
+    if (max_blob < 1)
+        return PyErr_Format(PyExc_ValueError, "max_blob must be positive");
+
+    splits = malloc(size * sizeof(*splits));
+    if (!splits)
+        return PyErr_NoMemory();
+    // Same as calling splitbuf() on what's left after each split, but
+    // without a round trip through python for every blob.  Nothing here
+    // touches python objects, so let other threads run meanwhile.
+    Py_BEGIN_ALLOW_THREADS;
+    while (ofs < len)
+    {
+        outbits = -1;
+        if (use_fastcdc)
+            out = fastcdc_find_ofs(buf + ofs, len - ofs, bits, max_blob,
+                                   &outbits);
+        else
+            out = bupsplit_find_ofs_bits(buf + ofs, len - ofs, bits,
+                                         &outbits);
+        if (!out)
+            break;
+        if (out > max_blob)
+        {
+            // Cap the blob, and report it as a level 0 split.
+            out = max_blob;
+            outbits = bits;
+        }
+        assert(outbits >= bits);
+        ofs += out;
+        if (n + 2 > size)
+        {
+            size *= 2;
+            tmp = realloc(splits, size * sizeof(*splits));
+            if (!tmp)
+            {
+                nomem = 1;
+                break;
+            }
+            splits = tmp;
+        }
+        splits[n++] = ofs;
+        splits[n++] = outbits;
+    }
+    Py_END_ALLOW_THREADS;
+    if (nomem)
+        result = PyErr_NoMemory();
+    else
+        result = PyString_FromStringAndSize((char *) splits,
+                                            n * sizeof(*splits));
+    free(splits);
+    return result;
+}
+
+
+static PyObject *splitbuf_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int max_blob = 0, bits = BUP_BLOBBITS;
+
+    if (!PyArg_ParseTuple(args, "t#i|i", &buf, &len, &max_blob, &bits))
+	return NULL;
+    if (bits < 1 || bits > BUP_MAX_BLOBBITS)
+        return PyErr_Format(PyExc_ValueError,
+                            "bits must be between 1 and %d", BUP_MAX_BLOBBITS);
+    return find_all_splits(buf, len, max_blob, 0, bits);
+}
+
+
+static PyObject *fastcdc_splitbuf_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int max_blob = 0, bits = BUP_BLOBBITS;
+
+    if (!PyArg_ParseTuple(args, "t#i|i", &buf, &len, &max_blob, &bits))
+	return NULL;
+    if (bits < FASTCDC_MIN_BITS || bits > FASTCDC_MAX_BITS)
+        return PyErr_Format(PyExc_ValueError,
+                            "bits must be between %d and %d",
+                            FASTCDC_MIN_BITS, FASTCDC_MAX_BITS);
+    return find_all_splits(buf, len, max_blob, 1, bits);
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -566,6 +666,106 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+// A blocked bloom filter puts all k bits of an object in the same 64 byte
+// block, so a lookup touches a single cache line (and page) instead of k
+// of them.  The first 32 bits of the sha pick the block, and each of the
+// next k groups of 9 bits picks a bit in it.
+#define BLOOM3_HEADERLEN 64
+#define BLOOM3_BLOCK_BITS 6  // 64 byte blocks...
+#define BLOOM3_BIT_BITS 9  // ...of 512 bits
+#define BLOOM3_MAX_BITS (32 + BLOOM3_BLOCK_BITS)
+#define BLOOM3_MAX_K ((160 - 32) / BLOOM3_BIT_BITS)
+
+static unsigned char *blocked_bloom_block(unsigned char *bloom,
+                                          const unsigned char *sha, int nbits)
+{
+    uint32_t high;
+    uint64_t block;
+
+    memcpy(&high, sha, 4);
+    block = (uint64_t)ntohl(high) >> (32 - (nbits - BLOOM3_BLOCK_BITS));
+    return bloom + BLOOM3_HEADERLEN + (block << BLOOM3_BLOCK_BITS);
+}
+
+static int blocked_bloom_bit(const unsigned char *sha, int i)
+{
+    int ofs = 32 + i * BLOOM3_BIT_BITS;
+    int v = (sha[ofs / 8] << 8) | sha[ofs / 8 + 1];
+    return (v >> (16 - BLOOM3_BIT_BITS - ofs % 8)) & ((1 << BLOOM3_BIT_BITS) - 1);
+}
+
+static int _check_blocked_bloom(Py_ssize_t blen, int nbits, int k)
+{
+    if (nbits < BLOOM3_BLOCK_BITS || nbits > BLOOM3_MAX_BITS)
+    {
+        PyErr_Format(PyExc_ValueError, "nbits must be between %d and %d",
+                     BLOOM3_BLOCK_BITS, BLOOM3_MAX_BITS);
+        return 0;
+    }
+    if (k < 1 || k > BLOOM3_MAX_K)
+    {
+        PyErr_Format(PyExc_ValueError, "k must be between 1 and %d",
+                     BLOOM3_MAX_K);
+        return 0;
+    }
+    if (blen < BLOOM3_HEADERLEN + ((Py_ssize_t)1 << nbits))
+    {
+        PyErr_SetString(PyExc_ValueError, "bloom filter is too short");
+        return 0;
+    }
+    return 1;
+}
+
+static PyObject *blocked_bloom_add(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block, *end;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, bit;
+
+    if (!PyArg_ParseTuple(args, "w#t#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!_check_blocked_bloom(blen, nbits, k))
+        return NULL;
+    if (len % 20 != 0)
+        return PyErr_Format(PyExc_ValueError,
+                            "shas must be a multiple of 20 bytes long");
+
+    for (end = sha + len; sha < end; sha += 20)
+    {
+        block = blocked_bloom_block(bloom, sha, nbits);
+        for (i = 0; i < k; i++)
+        {
+            bit = blocked_bloom_bit(sha, i);
+            block[bit >> 3] |= 1 << (bit & 7);
+        }
+    }
+    return Py_BuildValue("n", len/20);
+}
+
+static PyObject *blocked_bloom_contains(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, bit;
+
+    if (!PyArg_ParseTuple(args, "t#t#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!_check_blocked_bloom(blen, nbits, k))
+        return NULL;
+    if (len != 20)
+        return PyErr_Format(PyExc_ValueError, "sha must be 20 bytes long");
+
+    block = blocked_bloom_block(bloom, sha, nbits);
+    for (i = 0; i < k; i++)
+    {
+        bit = blocked_bloom_bit(sha, i);
+        if (!(block[bit >> 3] & (1 << (bit & 7))))
+            return Py_BuildValue("Oi", Py_None, i + 1);
+    }
+    return Py_BuildValue("ii", 1, k);
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -593,6 +793,266 @@ static PyObject *extract_bits(PyObject *self, PyObject *args)
 }
 
 
+// The sorted tables of an idx (or midx) have count entries, stride bytes
+// apart, with the sha at the start of each.  Make sure they're all there.
+static int _check_sha_table(Py_ssize_t len, int stride, Py_ssize_t count)
+{
+    if (stride < 20 || count < 0
+        || (count > 0 && (count - 1) > (len - 20) / stride))
+    {
+        PyErr_SetString(PyExc_ValueError, "sha table is too short");
+        return 0;
+    }
+    return 1;
+}
+
+
+static PyObject *bsearch_sha(PyObject *self, PyObject *args)
+{
+    unsigned char *table = NULL, *sha = NULL;
+    Py_ssize_t len = 0, shalen = 0, start = 0, end = 0, mid;
+    int stride = 0, steps = 1, c;  // the lookup table is a step
+
+    if (!PyArg_ParseTuple(args, "t#inns#", &table, &len, &stride,
+                          &start, &end, &sha, &shalen))
+	return NULL;
+    if (shalen != 20)
+        return PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+    if (start < 0 || !_check_sha_table(len, stride, end))
+	return NULL;
+    while (start < end)
+    {
+        steps++;
+        mid = start + (end - start) / 2;
+        c = memcmp(table + mid * stride, sha, 20);
+        if (c < 0)
+            start = mid + 1;
+        else if (c > 0)
+            end = mid;
+        else
+            return Py_BuildValue("ni", mid, steps);
+    }
+    return Py_BuildValue("Oi", Py_None, steps);
+}
+
+
+// Return the i'th big-endian 32-bit word of buf.
+static uint32_t _get_word(const unsigned char *buf, Py_ssize_t i)
+{
+    uint32_t v;
+    memcpy(&v, buf + i * 4, 4);
+    return ntohl(v);
+}
+
+
+static PyObject *midx_find_sha(PyObject *self, PyObject *args)
+{
+    unsigned char *table = NULL, *fanout = NULL, *sha = NULL, *v;
+    Py_ssize_t len = 0, fanlen = 0, shalen = 0;
+    int bits = 0, steps = 1, c;  // the lookup table is a step
+    uint32_t el;
+    uint64_t start, end, mid, startv, endv, hashv;
+
+    if (!PyArg_ParseTuple(args, "t#t#is#", &table, &len, &fanout, &fanlen,
+                          &bits, &sha, &shalen))
+	return NULL;
+    if (shalen != 20)
+        return PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+    if (bits < 0 || bits > 31 || fanlen < ((Py_ssize_t)4 << bits))
+        return PyErr_Format(PyExc_ValueError, "invalid midx fanout");
+    if (!_check_sha_table(len, 20, _get_word(fanout, (1 << bits) - 1)))
+	return NULL;
+
+    // Same interpolation search as PackMidx.exists() used to do in python.
+    el = bits ? _extract_bits(sha, bits) : 0;
+    start = el ? _get_word(fanout, el - 1) : 0;
+    startv = (uint64_t)el << (32 - bits);
+    end = _get_word(fanout, el);
+    endv = (uint64_t)(el + 1) << (32 - bits);
+    hashv = _get_word(sha, 0);
+    while (start < end)
+    {
+        steps++;
+        if (endv > startv)
+            mid = start + (hashv - startv) * (end - start - 1) / (endv - startv);
+        else
+            mid = start;  // the first words of both ends are the same
+        v = table + mid * 20;
+        c = memcmp(v, sha, 20);
+        if (c < 0)
+        {
+            start = mid + 1;
+            startv = _get_word(v, 0);
+        }
+        else if (c > 0)
+        {
+            end = mid;
+            endv = _get_word(v, 0);
+        }
+        else
+            return Py_BuildValue("ni", (Py_ssize_t) mid, steps);
+    }
+    return Py_BuildValue("Oi", Py_None, steps);
+}
+
+
+// Return a (query number, table index) pair of packed native int32s for
+// each of the sorted shas that's in the table.
+static PyObject *find_shas(PyObject *self, PyObject *args)
+{
+    unsigned char *table = NULL, *shas = NULL, *sha;
+    Py_ssize_t len = 0, count = 0, shaslen = 0, n, i, lo = 0, hi, mid, step;
+    Py_ssize_t nfound = 0;
+    int stride = 0;
+    int32_t *found;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#int#", &table, &len, &stride, &count,
+                          &shas, &shaslen))
+	return NULL;
+    if (shaslen % 20)
+        return PyErr_Format(PyExc_ValueError,
+                            "shas must be a multiple of 20 bytes");
+    if (count > INT32_MAX || !_check_sha_table(len, stride, count))
+	return NULL;
+    n = shaslen / 20;
+    if (n > INT32_MAX)
+        return PyErr_Format(PyExc_ValueError, "too many shas");
+    found = malloc(n * 2 * sizeof(*found) + 1);
+    if (!found)
+        return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (i = 0; i < n; i++)
+    {
+        sha = shas + i * 20;
+        // The shas are sorted, so each one is at or after the previous
+        // one.  Gallop forward from there to bracket it, then bisect.
+        for (hi = lo, step = 1;
+             hi < count && memcmp(table + hi * stride, sha, 20) < 0;
+             hi += step, step *= 2)
+            lo = hi + 1;
+        if (hi > count)
+            hi = count;
+        while (lo < hi)
+        {
+            mid = lo + (hi - lo) / 2;
+            if (memcmp(table + mid * stride, sha, 20) < 0)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        if (lo < count && memcmp(table + lo * stride, sha, 20) == 0)
+        {
+            found[nfound++] = i;
+            found[nfound++] = lo;
+        }
+    }
+    Py_END_ALLOW_THREADS;
+    result = PyString_FromStringAndSize((char *) found,
+                                        nfound * sizeof(*found));
+    free(found);
+    return result;
+}
+
+
+// Read one of the little-endian base 128 sizes at the start of a git
+// delta, or return -1 if it runs past end.
+static long long _delta_size(const unsigned char **p, const unsigned char *end)
+{
+    long long size = 0;
+    int shift = 0;
+    unsigned char c;
+
+    do {
+        if (*p >= end || shift > 56)
+            return -1;
+        c = *(*p)++;
+        size |= (long long)(c & 0x7f) << shift;
+        shift += 7;
+    } while (c & 0x80);
+    return size;
+}
+
+
+// Rebuild an object from its base and a git delta (see pack-format.txt).
+static PyObject *apply_delta(PyObject *self, PyObject *args)
+{
+    const unsigned char *base = NULL, *delta = NULL, *p, *end;
+    unsigned char *out;
+    Py_ssize_t blen = 0, dlen = 0;
+    long long srcsize, size, ofs, n, pos = 0;
+    unsigned char op;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#t#", &base, &blen, &delta, &dlen))
+	return NULL;
+    p = delta;
+    end = delta + dlen;
+    srcsize = _delta_size(&p, end);
+    size = _delta_size(&p, end);
+    if (srcsize < 0 || size < 0 || size > PY_SSIZE_T_MAX)
+        return PyErr_Format(PyExc_ValueError, "invalid delta header");
+    if (srcsize != blen)
+        return PyErr_Format(PyExc_ValueError,
+                            "delta expects a %zd byte base, not %zd",
+                            (Py_ssize_t)srcsize, blen);
+    result = PyString_FromStringAndSize(NULL, size);
+    if (!result)
+        return NULL;
+    out = (unsigned char *)PyString_AS_STRING(result);
+    while (p < end)
+    {
+        op = *p++;
+        if (op & 0x80)
+        {
+            // copy from the base: which bytes of the offset and size
+            // follow is given by the low seven bits of op
+            int i;
+            ofs = n = 0;
+            for (i = 0; i < 4; i++)
+                if (op & (1 << i))
+                {
+                    if (p >= end)
+                        goto bad;
+                    ofs |= (long long)*p++ << (8 * i);
+                }
+            for (i = 0; i < 3; i++)
+                if (op & (0x10 << i))
+                {
+                    if (p >= end)
+                        goto bad;
+                    n |= (long long)*p++ << (8 * i);
+                }
+            if (!n)
+                n = 0x10000;
+            if (ofs + n > blen || n > size - pos)
+                goto bad;
+            memcpy(out + pos, base + ofs, n);
+        }
+        else if (op)
+        {
+            // insert the next op bytes of the delta
+            n = op;
+            if (n > end - p || n > size - pos)
+                goto bad;
+            memcpy(out + pos, p, n);
+            p += n;
+        }
+        else
+            goto bad;  // reserved
+        pos += n;
+    }
+    if (pos != size)
+        goto bad;
+    return result;
+
+ bad:
+    Py_DECREF(result);
+    return PyErr_Format(PyExc_ValueError, "invalid delta");
+}
+
+
 struct sha {
     unsigned char bytes[20];
 };
@@ -679,9 +1139,10 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     uint32_t count, prefix;
     int num_i;
     int last_i;
+    int progress = 1;
 
-    if (!PyArg_ParseTuple(args, "w#iOO",
-                          &fmap, &flen, &bits, &py_total, &ilist))
+    if (!PyArg_ParseTuple(args, "w#iOO|i",
+                          &fmap, &flen, &bits, &py_total, &ilist, &progress))
 	return NULL;
 
     if (!bup_uint_from_py(&total, py_total, "total"))
@@ -716,7 +1177,7 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     {
 	struct idx *idx;
 	uint32_t new_prefix;
-	if (count % 102424 == 0 && istty2)
+	if (count % 102424 == 0 && progress && istty2)
 	    fprintf(stderr, "midx: writing %.2f%% (%d/%d)\r",
 		    count*100.0/total, count, total);
 	idx = idxs[last_i];
@@ -955,6 +1416,128 @@ static PyObject *fadvise_done(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *fadvise_willneed(PyObject *self, PyObject *args)
+{
+    const char *filename = NULL;
+    long long len = 0;
+    struct stat st;
+    int fd, err = 0;
+
+    if (!PyArg_ParseTuple(args, "sL", &filename, &len))
+	return NULL;
+    // Opening and hinting may block on a slow (e.g. network)
+    // filesystem, and the caller only wants the reads started, so
+    // don't hold everyone else up meanwhile.  O_NONBLOCK keeps a file
+    // that has since been replaced by a fifo from blocking the open.
+    Py_BEGIN_ALLOW_THREADS;
+    fd = _open_noatime(filename, O_NONBLOCK);
+    if (fd < 0)
+	err = errno;
+    else
+    {
+	if (fstat(fd, &st) < 0)
+	    err = errno;
+#ifdef POSIX_FADV_WILLNEED
+	else if (S_ISREG(st.st_mode) && len > 0)
+	    posix_fadvise(fd, 0, len, POSIX_FADV_WILLNEED);
+#endif
+	close(fd);
+    }
+    Py_END_ALLOW_THREADS;
+    if (err)
+    {
+	errno = err;
+	return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+    }
+    return Py_BuildValue("");
+}
+
+
+static PyObject *madvise_done(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    long long ofs = 0;
+    long pagesize = sysconf(_SC_PAGESIZE);
+
+    if (!PyArg_ParseTuple(args, "t#L", &buf, &len, &ofs))
+	return NULL;
+    if (ofs > len)
+        ofs = len;
+    // buf must be the start of a mapping, so it's page aligned.
+    ofs -= ofs % pagesize;
+#ifdef MADV_DONTNEED
+    if (ofs > 0)
+        madvise(buf, ofs, MADV_DONTNEED);
+#endif
+    return Py_BuildValue("");
+}
+
+
+// Set while copy_mapped() runs in this thread; where its SIGBUS handler
+// jumps back to.  Volatile, or the compiler, which knows memcpy() can't
+// see it, may never store it at all.
+static __thread sigjmp_buf * volatile copy_mapped_env = NULL;
+
+static void copy_mapped_sigbus(int sig)
+{
+    if (copy_mapped_env)
+        siglongjmp(*copy_mapped_env, 1);
+    // Not ours: fault again, and die the way we would have.
+    signal(sig, SIG_DFL);
+}
+
+static PyObject *copy_mapped(PyObject *self, PyObject *args)
+{
+    Py_buffer dest;
+    unsigned char *src = NULL;
+    Py_ssize_t slen = 0, dofs = 0, sofs = 0, n = 0;
+    struct sigaction sa, old_sa;
+    sigjmp_buf env;
+    int faulted = 0;
+
+    if (!PyArg_ParseTuple(args, "w*nt#nn", &dest, &dofs,
+                          &src, &slen, &sofs, &n))
+	return NULL;
+    if (n < 0 || dofs < 0 || sofs < 0 || dofs > dest.len - n
+        || sofs > slen - n)
+    {
+        PyBuffer_Release(&dest);
+        return PyErr_Format(PyExc_ValueError, "copy out of range");
+    }
+
+    // Reading a page of a mapping past the end of its file raises SIGBUS,
+    // so a file that's truncated while it's mapped would kill us.  Catch
+    // it, and let the caller find out what's left with read().
+    memset(&sa, 0, sizeof(sa));
+    sa.sa_handler = copy_mapped_sigbus;
+    sigemptyset(&sa.sa_mask);
+    if (sigaction(SIGBUS, &sa, &old_sa))
+    {
+        PyBuffer_Release(&dest);
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+    Py_BEGIN_ALLOW_THREADS;
+    if (sigsetjmp(env, 1) == 0)
+    {
+        copy_mapped_env = &env;
+        memcpy((unsigned char *)dest.buf + dofs, src + sofs, n);
+    }
+    else
+        faulted = 1;
+    copy_mapped_env = NULL;
+    Py_END_ALLOW_THREADS;
+    sigaction(SIGBUS, &old_sa, NULL);
+    PyBuffer_Release(&dest);
+    if (faulted)
+    {
+        errno = EFAULT;
+        return PyErr_SetFromErrno(PyExc_IOError);
+    }
+    return Py_BuildValue("n", n);
+}
+
+
 // Currently the Linux kernel and FUSE disagree over the type for
 // FS_IOC_GETFLAGS and FS_IOC_SETFLAGS.  The kernel actually uses int,
 // but FUSE chose long (matching the declaration in linux/fs.h).  So
@@ -1334,6 +1917,11 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "splitbuf_all", splitbuf_all, METH_VARARGS,
+	"Return every (end offset, bits) split in buf as packed native uints;"
+	" blobs average 2^bits bytes." },
+    { "fastcdc_splitbuf_all", fastcdc_splitbuf_all, METH_VARARGS,
+	"Like splitbuf_all(), but using FastCDC with an average of 2^bits." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
@@ -1342,8 +1930,20 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "blocked_bloom_contains", blocked_bloom_contains, METH_VARARGS,
+	"Check if a blocked bloom filter of 2^nbits bytes contains an object" },
+    { "blocked_bloom_add", blocked_bloom_add, METH_VARARGS,
+	"Add objects to a blocked bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
+    { "bsearch_sha", bsearch_sha, METH_VARARGS,
+	"Find a sha between two entries of an idx sha table." },
+    { "midx_find_sha", midx_find_sha, METH_VARARGS,
+	"Find a sha in a midx sha table, using its fanout." },
+    { "find_shas", find_shas, METH_VARARGS,
+	"Find which of a string of sorted shas are in an idx sha table." },
+    { "apply_delta", apply_delta, METH_VARARGS,
+	"Return the object made by applying a git delta to its base." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
@@ -1356,6 +1956,12 @@ static PyMethodDef helper_methods[] = {
 	"open() the given filename for read with O_NOATIME if possible" },
     { "fadvise_done", fadvise_done, METH_VARARGS,
 	"Inform the kernel that we're finished with earlier parts of a file" },
+    { "fadvise_willneed", fadvise_willneed, METH_VARARGS,
+	"Ask the kernel to start reading the first len bytes of a file" },
+    { "madvise_done", madvise_done, METH_VARARGS,
+	"Drop the pages of an mmap() before ofs; they'll be reread if used" },
+    { "copy_mapped", copy_mapped, METH_VARARGS,
+	"Copy part of an mmap() into a buffer; IOError if the file shrank" },
 #ifdef BUP_HAVE_FILE_ATTRS
     { "get_linux_file_attr", bup_get_linux_file_attr, METH_VARARGS,
       "Return the Linux attributes for the given file." },
@@ -1416,6 +2022,8 @@ PyMODINIT_FUNC init_helpers(void)
     if (m == NULL)
         return;
 
+    fastcdc_init();
+
 #pragma clang diagnostic push
 #pragma clang diagnostic ignored "-Wtautological-compare" // For INTEGER_TO_PY().
 #ifdef HAVE_UTIMENSAT
@@ -0,0 +1,4 @@
+
+COMMIT='502e064c97c9073ab24e36a5c25129b87dc48cbe'
+NAMES='(tag: bup-502e064)'
+DATE='2026-10-18 19:49:05 +0000'
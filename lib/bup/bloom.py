@@ -78,14 +78,39 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 (blocked) filters:
+
+Once the table is much bigger than the CPU caches, each of the k bits of a
+lookup is a cache miss (and often a TLB miss) of its own.  A blocked
+filter puts all k bits of an entry in the same 64 byte block: the first 32
+bits of the SHA pick the block, and each of the next k groups of 9 bits
+picks a bit in it.  That's one memory access per lookup whatever k is, and
+up to 2^38 bytes of table.
+
+Blocks don't all fill up evenly, so for the same k and size a blocked
+filter has more false positives.  But since extra bits are nearly free,
+it can use a bigger k instead:
+
+mn|v2 k=5 |v3 k=5 |v3 k=6 |v3 k=7 |v3 k=8
+16|0.13925|0.16920|0.12220|0.09884|0.08728
+24|0.02352|0.03254|0.01843|0.01198|0.00869
+32|0.00633|0.00992|0.00469|0.00258|0.00161
+
+So version 3 filters use k=7 by default.
 """
-import sys, os, math, mmap
+import sys, os, errno, math, mmap, fcntl
 from bup import _helpers
 from bup.helpers import *
 
-BLOOM_VERSION = 2
+BLOOM_VERSION = 3
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
 MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
+BLOCKED_VERSION = 3
+BLOCKED_BITS = (6, 38) # at least one 64 byte block, at most 2^32 blocks
+BLOCKED_K = 7
+BLOCKED_MAX_K = 14 # (160-32)/9
+_HEADERLEN = {2: 16, 3: 64}
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
 
 _total_searches = 0
@@ -93,11 +118,38 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+blocked_bloom_contains = _helpers.blocked_bloom_contains
+blocked_bloom_add = _helpers.blocked_bloom_add
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
 # to know who is responsible for closing it.
 
+def _lock(f, filename):
+    """Lock f, which was opened as filename, and return it.  If bup bloom
+    renamed a new filter over it while this waited, lock and return that
+    one instead, so that nothing is added to a filter that's gone."""
+    while 1:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            st = os.stat(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return f
+        fst = os.fstat(f.fileno())
+        if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+            return f
+        f.close()
+        f = open(filename, f.mode)
+
+
+def lock(filename):
+    """Return the filter called filename, opened for reading and locked
+    against the writers that update it in place, until it's closed."""
+    return _lock(open(filename, 'rb'), filename)
+
+
 class ShaBloom:
     """Wrapper which contains data from multiple index files. """
     def __init__(self, filename, f=None, readwrite=False, expected=-1):
@@ -107,7 +159,10 @@ class ShaBloom:
         assert(filename.endswith('.bloom'))
         if readwrite:
             assert(expected > 0)
-            self.rwfile = f = f or open(filename, 'r+b')
+            # Writers update the table in place (see git.PackWriter), so
+            # keep them from losing each other's bits.  The lock goes away
+            # when the file is closed.
+            self.rwfile = f = _lock(f or open(filename, 'r+b'), filename)
             f.seek(0)
 
             # Decide if we want to mmap() the pages as writable ('immediate'
@@ -142,7 +197,7 @@ class ShaBloom:
             log('Warning: invalid BLOM header (%r) in %r\n' % (got, filename))
             return self._init_failed()
         ver = struct.unpack('!I', self.map[4:8])[0]
-        if ver < BLOOM_VERSION:
+        if ver < 2:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
@@ -151,8 +206,14 @@ class ShaBloom:
                 % (ver, filename))
             return self._init_failed()
 
+        self.version = ver
+        self.headerlen = _HEADERLEN[ver]
+        if ver == BLOCKED_VERSION:
+            self._add, self._contains = blocked_bloom_add, blocked_bloom_contains
+        else:
+            self._add, self._contains = bloom_add, bloom_contains
         self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
-        idxnamestr = str(self.map[16 + 2**self.bits:])
+        idxnamestr = str(self.map[self.headerlen + 2**self.bits:])
         if idxnamestr:
             self.idxnames = idxnamestr.split('\0')
         else:
@@ -182,7 +243,7 @@ class ShaBloom:
                 self.rwfile.write(self.map)
             else:
                 self.map.flush()
-            self.rwfile.seek(16 + 2**self.bits)
+            self.rwfile.seek(self.headerlen + 2**self.bits)
             if self.idxnames:
                 self.rwfile.write('\0'.join(self.idxnames))
         self._init_failed()
@@ -191,13 +252,24 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if self.version != BLOCKED_VERSION:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # The chance for each possible number of entries in a block (a
+        # poisson distribution) times the false positive rate of a little
+        # 512 bit filter with that many entries.
+        per_block = 512.0*n/m
+        p = math.exp(-per_block)
+        total = 0
+        for i in xrange(int(per_block + 20*math.sqrt(per_block) + 20)):
+            total += p * (1-(1-1/512.0)**(k*i))**k
+            p *= per_block/(i+1)
+        return 100*total
 
     def add_idx(self, ix):
         """Add the object to the filter, return current pfalse_positive."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ix.shatable, self.bits, self.k)
+        self.entries += self._add(self.map, ix.shatable, self.bits, self.k)
         self.idxnames.append(os.path.basename(ix.name))
 
     def exists(self, sha):
@@ -211,7 +283,7 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        found, steps = self._contains(self.map, str(sha), self.bits, self.k)
         _total_steps += steps
         return found
 
@@ -219,21 +291,49 @@ class ShaBloom:
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
-    """Create and return a bloom filter for `expected` entries."""
+def _size(expected, version, k=None):
+    """Return the (bits, k, ideal bits) of a new filter for `expected`
+    entries; bits is less than the ideal if that's too big."""
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if version == BLOCKED_VERSION:
+        k = k or BLOCKED_K
+        min_bits, max_bits = BLOCKED_BITS
+        bits = max(bits, min_bits)
+    else:
+        assert(version == 2)
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    return min(bits, max_bits), k, bits
+
+
+def needs_resize(b, additional=0):
+    """Return true if b would have too many false positives with
+    `additional` more entries, and a new filter for all of them would be
+    bigger."""
+    if b.pfalse_positive(additional) <= MAX_PFALSE_POSITIVE:
+        return False
+    # bup bloom picks k again when it regenerates a filter.
+    return _size(len(b) + additional, b.version)[0] > b.bits
+
+
+def create(name, expected, delaywrite=None, f=None, k=None, version=2):
+    """Create and return a bloom filter for `expected` entries.
+
+    version is 2 for a classic filter, or 3 for a blocked one.
+    """
+    bits, k, ideal_bits = _size(expected, version, k)
+    if ideal_bits > bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
     debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+    headerlen = _HEADERLEN[version]
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
-    assert(f.tell() == 16)
+    f.write(struct.pack('!IHHI', version, bits, k, 0))
+    f.write('\0' * (headerlen - 16))
+    assert(f.tell() == headerlen)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
-    f.truncate(16+2**bits)
+    f.truncate(headerlen+2**bits)
     f.seek(0)
     if delaywrite != None and not delaywrite:
         # tell it to expect very few objects, forcing a direct mmap
@@ -91,22 +91,24 @@ static uint32_t rollsum_sum(uint8_t *buf, size_t ofs, size_t len)
 }
 
 
-int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
+int bupsplit_find_ofs_bits(const unsigned char *buf, int len, int blobbits,
+                           int *bits)
 {
     Rollsum r;
     int count;
+    unsigned mask = (1 << blobbits) - 1;
     
     rollsum_init(&r);
     for (count = 0; count < len; count++)
     {
 	rollsum_roll(&r, buf[count]);
-	if ((r.s2 & (BUP_BLOBSIZE-1)) == ((~0) & (BUP_BLOBSIZE-1)))
+	if ((r.s2 & mask) == mask)
 	{
 	    if (bits)
 	    {
 		unsigned rsum = rollsum_digest(&r);
-		rsum >>= BUP_BLOBBITS;
-		for (*bits = BUP_BLOBBITS; (rsum >>= 1) & 1; (*bits)++)
+		rsum >>= blobbits;
+		for (*bits = blobbits; (rsum >>= 1) & 1; (*bits)++)
 		    ;
 	    }
 	    return count+1;
@@ -116,6 +118,12 @@ int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
 }
 
 
+int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
+{
+    return bupsplit_find_ofs_bits(buf, len, BUP_BLOBBITS, bits);
+}
+
+
 #ifndef BUP_NO_SELFTEST
 #define BUP_SELFTEST_SIZE 100000
 
@@ -32,6 +32,8 @@
 
 #define BUP_BLOBBITS (13)
 #define BUP_BLOBSIZE (1<<BUP_BLOBBITS)
+// Only the low 16 bits of the rolling sum's s2 are well mixed.
+#define BUP_MAX_BLOBBITS (16)
 #define BUP_WINDOWBITS (6)
 #define BUP_WINDOWSIZE (1<<BUP_WINDOWBITS)
 
@@ -40,6 +42,8 @@ extern "C" {
 #endif
     
 int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits);
+int bupsplit_find_ofs_bits(const unsigned char *buf, int len, int blobbits,
+                           int *bits);
 int bupsplit_selftest(void);
 
 #ifdef __cplusplus
@@ -234,7 +234,7 @@ class Client:
             self.conn.write('%s\n' % ob)
         return idx
 
-    def new_packwriter(self, compression_level = 1):
+    def new_packwriter(self, compression_level = 1, jobs = 1):
         self.check_busy()
         def _set_busy():
             self._busy = 'receive-objects-v2'
@@ -245,7 +245,8 @@ class Client:
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
-                                 compression_level = compression_level)
+                                 compression_level = compression_level,
+                                 jobs = jobs)
 
     def read_ref(self, refname):
         self.check_busy()
@@ -258,6 +259,15 @@ class Client:
         else:
             return None   # nonexistent ref
 
+    def config_get(self, option):
+        """Return the value of a git config option in the server's
+        repository, or None if it isn't set."""
+        self.check_busy()
+        self.conn.write('config-get %s\n' % option)
+        r = self.conn.readline().rstrip('\n')
+        self.check_ok()
+        return r or None
+
     def update_ref(self, refname, newval, oldval):
         self.check_busy()
         self.conn.write('update-ref %s\n%s\n%s\n' 
@@ -283,8 +293,9 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
-                 compression_level=1):
-        git.PackWriter.__init__(self, objcache_maker)
+                 compression_level=1,
+                 jobs=1):
+        git.PackWriter.__init__(self, objcache_maker, jobs=jobs)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -301,6 +312,7 @@ class PackWriter_Remote(git.PackWriter):
             self._packopen = True
 
     def _end(self):
+        self._flush_encoder()
         if self._packopen and self.file:
             self.file.write('\0\0\0\0')
             self._packopen = False
@@ -311,6 +323,9 @@ class PackWriter_Remote(git.PackWriter):
     def close(self):
         id = self._end()
         self.file = None
+        if self.encoder:
+            self.encoder.close()
+            self.encoder = None
         return id
 
     def abort(self):
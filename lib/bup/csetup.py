@@ -1,7 +1,7 @@
 from distutils.core import setup, Extension
 
 _helpers_mod = Extension('_helpers',
-                         sources=['_helpers.c', 'bupsplit.c'],
+                         sources=['_helpers.c', 'bupsplit.c', 'fastcdc.c'],
                          depends=['../../config/config.h'])
 
 setup(name='_helpers',
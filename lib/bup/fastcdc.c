@@ -0,0 +1,90 @@
+// A content-defined chunker based on FastCDC (Xia et al., "FastCDC: a
+// Fast and Efficient Content-Defined Chunking Approach for Data
+// Deduplication", USENIX ATC 2016).
+//
+// Instead of bupsplit's rolling checksum, it uses a "gear" hash, which
+// only needs a shift, an add and a table lookup per byte.  Each shift
+// pushes older bytes out of the top of the hash, so the top bits depend
+// on the last 64 bytes.  It also skips the first quarter of the average
+// blob size entirely, and normalizes the blob sizes.  Splitting is
+// harder before the average size and easier after it.
+#include "fastcdc.h"
+#include <stdint.h>
+
+static uint64_t gear[256];
+
+
+// splitmix64, so that the table is the same everywhere without having to
+// carry 256 magic numbers around.  Changing it changes every split.
+static uint64_t next_gear(uint64_t *state)
+{
+    uint64_t z = (*state += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+
+void fastcdc_init(void)
+{
+    uint64_t state = 0x62757073706c6974ULL;  // "bupsplit"
+    int i;
+
+    for (i = 0; i < 256; i++)
+        gear[i] = next_gear(&state);
+}
+
+
+static int leading_zeros(uint64_t x)
+{
+    return x ? __builtin_clzll(x) : 64;
+}
+
+
+// Return the length of the first blob in buf, or 0 if buf ends before a
+// split was found (but was shorter than max_len).  A blob of max_len
+// bytes is returned when no split is found before that, in which case
+// *outbits is bits, ie. level 0.  Otherwise *outbits is bits plus the
+// number of extra zero bits in the hash, as for bupsplit_find_ofs().
+int fastcdc_find_ofs(const unsigned char *buf, int len, int bits, int max_len,
+                     int *outbits)
+{
+    const int min_len = 1 << (bits - FASTCDC_MIN_SHIFT);
+    const int avg_len = 1 << bits;
+    const uint64_t mask_hard = ~0ULL << (64 - (bits + 1));
+    const uint64_t mask_easy = ~0ULL << (64 - (bits - 1));
+    uint64_t hash = 0;
+    int ofs = min_len, end, used;
+
+    if (len > max_len)
+        len = max_len;
+    end = len < avg_len ? len : avg_len;
+    for (; ofs < end; ofs++)
+    {
+        hash = (hash << 1) + gear[buf[ofs]];
+        if (!(hash & mask_hard))
+        {
+            used = bits + 1;
+            goto found;
+        }
+    }
+    for (; ofs < len; ofs++)
+    {
+        hash = (hash << 1) + gear[buf[ofs]];
+        if (!(hash & mask_easy))
+        {
+            used = bits - 1;
+            goto found;
+        }
+    }
+    if (len == max_len)
+    {
+        *outbits = bits;
+        return max_len;
+    }
+    return 0;
+
+found:
+    *outbits = bits + leading_zeros(hash) - used;
+    return ofs + 1;
+}
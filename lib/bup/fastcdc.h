@@ -0,0 +1,13 @@
+#ifndef __FASTCDC_H
+#define __FASTCDC_H
+
+// Blobs are never split before 1/(1<<FASTCDC_MIN_SHIFT) of the average size.
+#define FASTCDC_MIN_SHIFT (2)
+#define FASTCDC_MIN_BITS (FASTCDC_MIN_SHIFT + 2)
+#define FASTCDC_MAX_BITS (30)
+
+void fastcdc_init(void);
+int fastcdc_find_ofs(const unsigned char *buf, int len, int bits, int max_len,
+                     int *outbits);
+
+#endif /* __FASTCDC_H */
@@ -3,7 +3,9 @@ bup repositories are in Git format. This library allows us to
 interact with the Git data structures.
 """
 import os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
-from collections import namedtuple
+import threading, Queue
+from array import array
+from collections import namedtuple, deque
 
 from bup.helpers import *
 from bup import _helpers, path, midx, bloom, xstat
@@ -21,6 +23,17 @@ _typermap = { 3:'blob', 2:'tree', 1:'commit', 4:'tag' }
 _total_searches = 0
 _total_steps = 0
 
+# PackIdxList remembers which packs the last RECENT_MAX to 2*RECENT_MAX
+# objects it found were in.  Once MERGE_AFTER lookups have had to ask more
+# than MERGE_MIN_IDXS indexes, it merges its idxs into a temporary midx,
+# smallest first, up to MERGE_MAX_OBJECTS (24 bytes each in $TMPDIR).
+RECENT_MAX = 4096
+MERGE_MIN_IDXS = 32
+MERGE_AFTER = 256
+MERGE_MAX_OBJECTS = 4*1024*1024
+BASE_CACHE_MAX = 16*1024*1024  # bytes of delta bases kept by PackReader
+TREE_CACHE_MAX = 16*1024*1024  # bytes of decoded trees kept by read_tree()
+
 
 class GitError(Exception):
     pass
@@ -124,26 +137,82 @@ def all_packdirs():
     return paths
 
 
-def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
+def _run_bup(args, wait=True, stderr=None):
+    args = [path.exe()] + args
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
+        p = subprocess.Popen(args, stdout=open('/dev/null', 'w'),
+                             stderr=stderr)
     except OSError, e:
         # make sure 'args' gets printed to help with debugging
         add_error('%r: exception: %s' % (args, e))
         raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+    if wait:
+        rv = p.wait()
+        if rv:
+            add_error('%r: returned %d' % (args, rv))
+    return p
+
+
+def auto_midx(objdir, run_bloom=True):
+    _run_bup(['midx', '--auto', '--dir', objdir])
+    if run_bloom:
+        _run_bup(['bloom', '--dir', objdir])
 
-    args = [path.exe(), 'bloom', '--dir', objdir]
+
+def add_to_bloom(objdir, idxname):
+    """Add the objects of the idx called idxname to the bloom filter of
+    objdir in place.
+
+    Return None if there's no usable filter, or it doesn't have the other
+    idxs of objdir either, in which case `bup bloom` should bring it up to
+    date.  Otherwise, return true if the filter has become too full and
+    should be regenerated.
+    """
+    bfull = os.path.join(objdir, 'bup.bloom')
+    if not os.path.exists(bfull):
+        return None
+    # Asking for a single entry gets a shared mapping, so only the pages
+    # that change are written back, rather than the whole table.
+    b = bloom.ShaBloom(bfull, readwrite=True, expected=1)
+    ix = None
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError, e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        if not b.valid():
+            return None
+        base = os.path.basename(idxname)
+        have = set(b.idxnames)
+        have.add(base)
+        for name in glob.glob(os.path.join(objdir, '*.idx')):
+            if os.path.basename(name) not in have:
+                return None
+        if base not in b.idxnames:
+            ix = open_idx(idxname)
+            b.add_idx(ix)
+        return bloom.needs_resize(b)
+    finally:
+        b.close()
+        if ix is not None:
+            ix.close()
+
+
+_bloom_rebuilds = {}  # objdir -> the bup bloom regenerating its filter
+
+def rebuild_bloom_in_background(objdir):
+    """Start regenerating the bloom filter of objdir from scratch, unless
+    that's already under way.
+
+    Meanwhile, the old filter is still used, and new packs are added to
+    it in place.  bup bloom adds those to the new filter too, under the
+    old one's lock, before it renames the new one over it.
+    """
+    p = _bloom_rebuilds.get(objdir)
+    if p and p.poll() is None:
+        return
+    debug1('bloom: regenerating %s in the background\n' % repo_rel(objdir))
+    # Nobody waits for it, so it has to keep quiet; if it fails, the old
+    # filter stays, and this is tried again after the next pack.
+    _bloom_rebuilds[objdir] = _run_bup(['bloom', '--force', '--dir', objdir],
+                                       wait=False,
+                                       stderr=open('/dev/null', 'w'))
 
 
 def mangle_name(name, mode, gitmode):
@@ -298,12 +367,34 @@ class PackIdx:
             return self._ofs_from_idx(idx)
         return None
 
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in this index."""
         if hash and (self._idx_from_hash(hash) != None):
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes."""
+        shas = sorted(set(str(h) for h in hashes))
+        found = dict((shas[n], want_source and self._source(i) or True)
+                     for n, i in self._find_sorted(''.join(shas)))
+        return [found.get(str(h)) for h in hashes]
+
+    def _find_sorted(self, shas):
+        """Return an (n, index) pair for each of the concatenated sorted
+        shas that's in the index, where it's the nth of them."""
+        found = array('i', _helpers.find_shas(self._shas, self._sha_stride,
+                                              len(self), shas))
+        return zip(found[::2], found[1::2])
+
+    def _source(self, idx):
+        return os.path.basename(self.name)
+
     def __len__(self):
         return int(self.fanout[255])
 
@@ -314,19 +405,13 @@ class PackIdx:
         b1 = ord(hash[0])
         start = self.fanout[b1-1] # range -1..254
         end = self.fanout[b1] # range 0..255
-        want = str(hash)
-        _total_steps += 1  # lookup table is a step
-        while start < end:
-            _total_steps += 1
-            mid = start + (end-start)/2
-            v = self._idx_to_hash(mid)
-            if v < want:
-                start = mid+1
-            elif v > want:
-                end = mid
-            else: # got it!
-                return mid
-        return None
+        if start >= end:
+            _total_steps += 1  # lookup table is a step
+            return None
+        idx, steps = _helpers.bsearch_sha(self._shas, self._sha_stride,
+                                          start, end, str(hash))
+        _total_steps += steps
+        return idx
 
 
 class PackIdxV1(PackIdx):
@@ -341,13 +426,12 @@ class PackIdxV1(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*24)
+        self._shas = buffer(self.shatable, 4)  # each after a 4 byte offset
+        self._sha_stride = 24
 
     def _ofs_from_idx(self, idx):
         return struct.unpack('!I', str(self.shatable[idx*24 : idx*24+4]))[0]
 
-    def _idx_to_hash(self, idx):
-        return str(self.shatable[idx*24+4 : idx*24+24])
-
     def __iter__(self):
         for i in xrange(self.fanout[255]):
             yield buffer(self.map, 256*4 + 24*i + 4, 20)
@@ -366,6 +450,8 @@ class PackIdxV2(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
+        self._shas = self.shatable
+        self._sha_stride = 20
         self.ofstable = buffer(self.map,
                                self.sha_ofs + nsha*20 + nsha*4,
                                nsha*4)
@@ -380,15 +466,13 @@ class PackIdxV2(PackIdx):
                                 str(buffer(self.ofs64table, idx64*8, 8)))[0]
         return ofs
 
-    def _idx_to_hash(self, idx):
-        return str(self.shatable[idx*20:(idx+1)*20])
-
     def __iter__(self):
         for i in xrange(self.fanout[255]):
             yield buffer(self.map, 8 + 256*4 + 20*i, 20)
 
 
 _mpi_count = 0
+_merge_warned = 0
 class PackIdxList:
     def __init__(self, dir):
         global _mpi_count
@@ -399,6 +483,12 @@ class PackIdxList:
         self.packs = []
         self.do_bloom = False
         self.bloom = None
+        self.hits = {}  # pack -> how many lookups were answered by it
+        self._last = None  # the pack the last hit was in
+        self._recent = {}  # sha -> pack, for the latest hits
+        self._recent_old = {}  # the generation before those
+        self._merged = None  # a midx of many of the idxs in self.packs
+        self._slow = 0  # lookups that had to ask too many idxs
         self.refresh()
 
     def __del__(self):
@@ -418,23 +508,146 @@ class PackIdxList:
         _total_searches += 1
         if hash in self.also:
             return True
+        sha = str(hash)
+        p = self._recent.get(sha)
+        if p is None:
+            p = self._recent_old.get(sha)
+        if p is not None:
+            return want_source and p.exists(sha, want_source=True) or True
         if self.do_bloom and self.bloom:
             if self.bloom.exists(hash):
                 self.do_bloom = False
             else:
                 _total_searches -= 1  # was counted by bloom
                 return None
-        for i in xrange(len(self.packs)):
-            p = self.packs[i]
+        # Objects written together tend to be looked up together, so the
+        # pack that had the last one is the likeliest to have this one too.
+        last = self._last
+        if last is not None:
             _total_searches -= 1  # will be incremented by sub-pack
-            ix = p.exists(hash, want_source=want_source)
+            ix = last.exists(sha, want_source=want_source)
             if ix:
-                # reorder so most recently used packs are searched first
-                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                self._found(sha, last, None)
+                return ix
+        packs = self.packs
+        for i in xrange(len(packs)):
+            if i == MERGE_MIN_IDXS:
+                self._slow += 1
+                if self._slow >= MERGE_AFTER and self._merge():
+                    # packs is gone; ask the new list from the start.
+                    _total_searches -= 1  # counted again
+                    return self.exists(hash, want_source=want_source)
+            p = packs[i]
+            if p is last:
+                continue
+            _total_searches -= 1  # will be incremented by sub-pack
+            ix = p.exists(sha, want_source=want_source)
+            if ix:
+                self._found(sha, p, i)
                 return ix
         self.do_bloom = True
         return None
 
+    def _found(self, sha, p, i):
+        """Account for sha having been found in p, which is self.packs[i]
+        (or somewhere in self.packs if i is None)."""
+        hits = self.hits[p] = self.hits.get(p, 0) + 1
+        if i:
+            # Move the pack up one place whenever it has had more hits than
+            # the one before it, so that the busiest packs are asked first
+            # without ever rebuilding the whole list.
+            packs = self.packs
+            prev = packs[i-1]
+            if hits > self.hits.get(prev, 0):
+                packs[i-1], packs[i] = p, prev
+        self._last = p
+        recent = self._recent
+        recent[sha] = p
+        if len(recent) >= RECENT_MAX:
+            self._recent_old = recent
+            self._recent = {}
+
+    def _merge(self):
+        """Replace the version 2 idxs in self.packs, which are too many to
+        ask one after the other, with a single midx of as many of them as
+        fit in MERGE_MAX_OBJECTS, and return true if that was done."""
+        global _merge_warned
+        self._slow = 0
+        if self._merged is not None:
+            return False  # one at a time; refresh() drops it
+        ixs = [p for p in self.packs if isinstance(p, PackIdxV2) and len(p)]
+        if len(ixs) < MERGE_MIN_IDXS:
+            return False
+        # Every idx costs a lookup the same, whatever its size, so the
+        # smallest ones are merged first.  A repository with more objects
+        # than fit still gets most of its idxs merged, as long as its bulk
+        # is in a few big packs.
+        ixs.sort(key=len)
+        total = 0
+        for n, p in enumerate(ixs):
+            if total + len(p) > MERGE_MAX_OBJECTS:
+                ixs = ixs[:n]
+                break
+            total += len(p)
+        if len(ixs) < MERGE_MIN_IDXS:
+            if not _merge_warned:
+                log('warning: too many objects to merge the indexes on the'
+                    ' fly; run "bup midx" to merge them.\n')
+                _merge_warned = 1
+            return False
+        debug1('PackIdxList: merging %d indexes.\n' % len(ixs))
+        merged = midx.merge(os.path.join(self.dir, 'merged.midx'), ixs)
+        self.hits[merged] = sum(self.hits.pop(p, 0) for p in ixs)
+        ixs = set(ixs)
+        self.packs = [p for p in self.packs if p not in ixs] + [merged]
+        self.packs.sort(key=lambda p: -self.hits.get(p, 0))
+        self._merged = merged
+        self._last = None
+        self._recent = {}
+        self._recent_old = {}
+        return True
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes.
+
+        This is much faster than calling exists() for each of them, since
+        they're sorted once, and then found in a single pass over each of
+        the index files.
+        """
+        # The bloom filter isn't used: asking it about each hash costs
+        # more than the walk over each index does.
+        result = [None] * len(hashes)
+        todo = {}  # sha -> positions in hashes
+        for i, hash in enumerate(hashes):
+            sha = str(hash)
+            if sha in self.also:
+                result[i] = True
+            else:
+                todo.setdefault(sha, []).append(i)
+        shas = sorted(todo)
+        joined = ''.join(shas)
+        left = len(shas)
+        hit = False
+        for p in self.packs:
+            if not left:
+                break
+            found_here = 0
+            for n, idx in p._find_sorted(joined):
+                positions = todo.pop(shas[n], None)
+                if positions:  # not already found in another pack
+                    found = want_source and p._source(idx) or True
+                    for i in positions:
+                        result[i] = found
+                    left -= 1
+                    found_here += 1
+            if found_here:
+                self.hits[p] = self.hits.get(p, 0) + found_here
+                hit = True
+        if hit:
+            # so that the packs that had the most of them are searched first
+            self.packs.sort(key=lambda p: -self.hits.get(p, 0))
+        return result
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -449,6 +662,15 @@ class PackIdxList:
         """
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
+        if self._merged is not None:
+            # Its idxs are reopened below, and merged again if need be.
+            self.packs.remove(self._merged)
+            self._merged.close()
+            self._merged = None
+        self._last = None
+        self._recent = {}
+        self._recent_old = {}
+        self._slow = 0
         skip_midx = skip_midx or ignore_midx
         d = dict((p.name, p) for p in self.packs
                  if not skip_midx or not isinstance(p, midx.PackMidx))
@@ -506,7 +728,9 @@ class PackIdxList:
             if self.bloom is None and os.path.exists(bfull):
                 self.bloom = bloom.ShaBloom(bfull)
             self.packs = list(set(d.values()))
-            self.packs.sort(lambda x,y: -cmp(len(x),len(y)))
+            self.hits = dict((p, self.hits.get(p, 0)) for p in self.packs)
+            # the busiest first, then the biggest
+            self.packs.sort(key=lambda p: (-self.hits[p], -len(p)))
             if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
                 self.do_bloom = True
             else:
@@ -555,9 +779,130 @@ def idxmerge(idxlist, final_progress=True):
 def _make_objcache():
     return PackIdxList(repo('objects/pack'))
 
+
+class _EncodeJob:
+    def __init__(self, sha, type, content):
+        self.sha = sha
+        self.type = type
+        self.content = content
+        self.data = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class _PackObjEncoder:
+    """Compress pack objects on a pool of worker threads.
+
+    Objects are handed back to write(sha, datalist) strictly in the
+    order they were submitted, and always from the submitting thread,
+    so the resulting pack is byte-for-byte what a serial writer would
+    have produced.  zlib releases the GIL while deflating, so the
+    workers really do run in parallel with the caller's splitting.
+    """
+    def __init__(self, jobs, compression_level, write):
+        self.compression_level = compression_level
+        self.write = write
+        self.window = jobs * 4
+        self.pending = deque()
+        self.pending_shas = set()
+        self.writing = False
+        self.todo = Queue.Queue()
+        self.threads = []
+        for i in xrange(jobs):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        while 1:
+            job = self.todo.get()
+            if job is None:
+                return
+            try:
+                job.data = ''.join(_encode_packobj(job.type, job.content,
+                                                   self.compression_level))
+            except:
+                job.exc_info = sys.exc_info()
+            job.content = None
+            job.done.set()
+
+    def submit(self, sha, type, content):
+        # content may be a view into the splitter's read buffer, which
+        # will be reused before the workers get to it.
+        job = _EncodeJob(sha, type, str(content))
+        self.pending.append(job)
+        self.pending_shas.add(sha)
+        self.todo.put(job)
+        self._write_ready(self.window)
+
+    def _write_ready(self, limit):
+        # Write out every finished job at the head of the queue, and wait
+        # for the oldest ones while more than 'limit' are still in flight.
+        if self.writing:
+            return  # write() ended the pack; the outer loop will continue
+        self.writing = True
+        try:
+            while self.pending:
+                job = self.pending[0]
+                if len(self.pending) <= limit and not job.done.is_set():
+                    break
+                job.done.wait()
+                self.pending.popleft()
+                if job.exc_info:
+                    raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+                self.write(job.sha, (job.data,))
+                self.pending_shas.discard(job.sha)
+        finally:
+            self.writing = False
+
+    def flush(self):
+        """Write out all submitted objects."""
+        self._write_ready(0)
+
+    def discard(self):
+        """Forget about all submitted objects without writing them."""
+        while 1:
+            try:
+                self.todo.get_nowait()
+            except Queue.Empty:
+                break
+        self.pending.clear()
+        self.pending_shas.clear()
+
+    def close(self):
+        for t in self.threads:
+            self.todo.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+def _pack_sha1(f):
+    # A running sum can't be kept as the objects are written: SHA-1 is
+    # chained from the first block, and that's where the object count
+    # only known at the end goes.  But the pack was just written, so it's
+    # most likely still cached; hash it straight from a map, in a single
+    # call that doesn't hold the GIL, rather than copying it through
+    # python a chunk at a time.  Nobody reads the pack again soon, so
+    # drop it from the cache to make room for the data being saved.
+    m = mmap_read(f, close=False)
+    try:
+        sum = Sha1(m)
+    finally:
+        m.close()
+    _helpers.fadvise_done(f.fileno(), os.fstat(f.fileno()).st_size)
+    return sum.digest()
+
+
 class PackWriter:
-    """Writes Git objects inside a pack file."""
-    def __init__(self, objcache_maker=_make_objcache, compression_level=1):
+    """Writes Git objects inside a pack file.
+
+    If jobs is greater than one, objects are compressed by that many
+    worker threads while the caller continues splitting and hashing.
+    """
+    def __init__(self, objcache_maker=_make_objcache, compression_level=1,
+                 jobs=1):
         self.count = 0
         self.outbytes = 0
         self.filename = None
@@ -566,6 +911,8 @@ class PackWriter:
         self.objcache_maker = objcache_maker
         self.objcache = None
         self.compression_level = compression_level
+        self.jobs = jobs
+        self.encoder = None
 
     def __del__(self):
         self.close()
@@ -609,12 +956,25 @@ class PackWriter:
             log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        if self.jobs > 1:
+            if not self.encoder:
+                self.encoder = _PackObjEncoder(self.jobs,
+                                               self.compression_level,
+                                               self._write_encoded)
+            self.encoder.submit(sha, type, content)
+        else:
+            self._write_encoded(sha, _encode_packobj(type, content,
+                                                     self.compression_level))
+        return sha
+
+    def _write_encoded(self, sha, datalist):
+        size, crc = self._raw_write(datalist, sha=sha)
         if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
             self.breakpoint()
-        return sha
+
+    def _flush_encoder(self):
+        if self.encoder:
+            self.encoder.flush()
 
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
@@ -632,8 +992,20 @@ class PackWriter:
     def exists(self, id, want_source=False):
         """Return non-empty if an object is found in the object cache."""
         self._require_objcache()
+        if self.encoder and id in self.encoder.pending_shas:
+            return True
         return self.objcache.exists(id, want_source=want_source)
 
+    def exists_many(self, ids, want_source=False):
+        """Return a list of what exists() would return for each of ids."""
+        self._require_objcache()
+        found = self.objcache.exists_many(ids, want_source=want_source)
+        if self.encoder:
+            pending = self.encoder.pending_shas
+            found = [f or (id in pending) or None
+                     for id, f in zip(ids, found)]
+        return found
+
     def maybe_write(self, type, content):
         """Write an object to the pack file if not present and return its id."""
         sha = calc_hash(type, content)
@@ -647,6 +1019,19 @@ class PackWriter:
         """Create a blob object in the pack with the supplied content."""
         return self.maybe_write('blob', blob)
 
+    def new_blobs(self, blobs):
+        """Like new_blob() for each of blobs, but look them all up at once,
+        with exists_many().  Return the list of their ids."""
+        ids = [calc_hash('blob', blob) for blob in blobs]
+        written = set()
+        for id, blob, found in zip(ids, blobs, self.exists_many(ids)):
+            if not found and id not in written:
+                self._write(id, 'blob', blob)
+                self._require_objcache()
+                self.objcache.add(id)
+                written.add(id)
+        return ids
+
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
         content = tree_encode(shalist)
@@ -672,6 +1057,10 @@ class PackWriter:
 
     def abort(self):
         """Remove the pack file from disk."""
+        if self.encoder:
+            self.encoder.discard()
+            self.encoder.close()
+            self.encoder = None
         f = self.file
         if f:
             self.idx = None
@@ -680,6 +1069,7 @@ class PackWriter:
             os.unlink(self.filename + '.pack')
 
     def _end(self, run_midx=True):
+        self._flush_encoder()
         f = self.file
         if not f: return None
         self.file = None
@@ -692,31 +1082,39 @@ class PackWriter:
         cp = struct.pack('!i', self.count)
         assert(len(cp) == 4)
         f.write(cp)
+        f.flush()
 
         # calculate the pack sha1sum
-        f.seek(0)
-        sum = Sha1()
-        for b in chunkyreader(f):
-            sum.update(b)
-        packbin = sum.digest()
+        packbin = _pack_sha1(f)
+        f.seek(0, 2)
         f.write(packbin)
         f.close()
 
         obj_list_sha = self._write_pack_idx_v2(self.filename + '.idx', idx, packbin)
 
-        nameprefix = repo('objects/pack/pack-%s' % obj_list_sha)
+        objdir = repo('objects/pack')
+        nameprefix = os.path.join(objdir, 'pack-%s' % obj_list_sha)
         if os.path.exists(self.filename + '.map'):
             os.unlink(self.filename + '.map')
         os.rename(self.filename + '.pack', nameprefix + '.pack')
         os.rename(self.filename + '.idx', nameprefix + '.idx')
 
+        # Otherwise PackIdxList won't use the filter until `bup bloom` has
+        # caught up with the new pack.
+        too_full = add_to_bloom(objdir, nameprefix + '.idx')
+        if too_full:
+            rebuild_bloom_in_background(objdir)
         if run_midx:
-            auto_midx(repo('objects/pack'))
+            auto_midx(objdir, run_bloom=(too_full is None))
         return nameprefix
 
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
-        return self._end(run_midx=run_midx)
+        id = self._end(run_midx=run_midx)
+        if self.encoder:
+            self.encoder.close()
+            self.encoder = None
+        return id
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
         ofs64_count = 0
@@ -930,6 +1328,28 @@ def init_repo(path=None):
     _git_wait('git config', p)
 
 
+def git_config_get(option, repo_dir=None):
+    """Return the value of the git config option in the repository, or
+    None if it isn't set."""
+    p = subprocess.Popen(['git', 'config', '--get', option],
+                         stdout=subprocess.PIPE,
+                         preexec_fn=_gitenv(repo_dir))
+    r = p.stdout.read()
+    rc = p.wait()
+    if rc == 1:
+        return None
+    if rc != 0:
+        raise GitError('git config --get %s returned error %d' % (option, rc))
+    return r.rstrip('\n')
+
+
+def git_config_set(option, value, repo_dir=None):
+    """Set the git config option to value in the repository."""
+    p = subprocess.Popen(['git', 'config', option, value],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+
+
 def check_repo_or_die(path=None):
     """Make sure a bup repository exists, and abort if not.
     If the path to a particular repository was not specified, this function
@@ -1018,8 +1438,48 @@ class _AbortableIter:
         self.abort()
 
 
+class _ObjectReader:
+    """What's common to the ways of reading objects: a subclass provides
+    get(id), which generates the object's type and then its content."""
+    def join(self, id):
+        """Generate a list of the content of all blobs that can be reached
+        from an object.  The hash given in 'id' must point to a blob, a tree
+        or a commit. The content of all blobs that can be seen from trees or
+        commits will be added to the list.
+        """
+        todo = deque([id])  # what's left to read, in order
+        try:
+            while todo:
+                id = todo.popleft()
+                entries = _cached_tree(id)
+                if entries is not None:
+                    todo.extendleft(reversed([sha.encode('hex') for
+                                              (mode, name, sha) in entries]))
+                    continue
+                it = self.get(id)
+                type = it.next()
+                if type == 'blob':
+                    for blob in it:
+                        yield blob
+                elif type == 'tree':
+                    entries = tuple(tree_decode(''.join(it)))
+                    if _hex_rx.match(id):
+                        tree_cache.put(id.decode('hex'), entries)
+                    todo.extendleft(reversed([sha.encode('hex') for
+                                              (mode, name, sha) in entries]))
+                elif type == 'commit':
+                    treeline = ''.join(it).split('\n')[0]
+                    assert(treeline.startswith('tree '))
+                    todo.appendleft(treeline[5:])
+                else:
+                    raise GitError('invalid object type %r: expected '
+                                   'blob/tree/commit' % type)
+        except StopIteration:
+            log('booger!\n')
+
+
 _ver_warned = 0
-class CatPipe:
+class CatPipe(_ObjectReader):
     """Link to 'git cat-file' that is used to retrieve blob data."""
     def __init__(self, repo_dir = None):
         global _ver_warned
@@ -1048,7 +1508,7 @@ class CatPipe:
                                   stdin=subprocess.PIPE,
                                   stdout=subprocess.PIPE,
                                   close_fds = True,
-                                  bufsize = 4096,
+                                  bufsize = 65536,
                                   preexec_fn = _gitenv(self.repo_dir))
 
     def _fast_get(self, id):
@@ -1103,53 +1563,346 @@ class CatPipe:
             yield blob
         _git_wait('git cat-file', p)
 
-    def _join(self, it):
-        type = it.next()
-        if type == 'blob':
-            for blob in it:
-                yield blob
-        elif type == 'tree':
-            treefile = ''.join(it)
-            for (mode, name, sha) in tree_decode(treefile):
-                for blob in self.join(sha.encode('hex')):
-                    yield blob
-        elif type == 'commit':
-            treeline = ''.join(it).split('\n')[0]
-            assert(treeline.startswith('tree '))
-            for blob in self.join(treeline[5:]):
-                yield blob
-        else:
-            raise GitError('invalid object type %r: expected blob/tree/commit'
-                           % type)
+_OFS_DELTA = 6
+_REF_DELTA = 7
+_hex_rx = re.compile(r'^[0-9a-fA-F]{40}$')
 
-    def join(self, id):
-        """Generate a list of the content of all blobs that can be reached
-        from an object.  The hash given in 'id' must point to a blob, a tree
-        or a commit. The content of all blobs that can be seen from trees or
-        commits will be added to the list.
-        """
+class PackReader(_ObjectReader):
+    """Read objects straight out of the mmapped packs of a repository.
+
+    Objects are found with the repository's idx and midx files, and
+    inflated from the .pack without a round trip through 'git cat-file'.
+    Anything that isn't in a pack (loose objects, or names like 'HEAD'
+    rather than hashes) is passed on to a CatPipe.
+    """
+    def __init__(self, repo_dir = None):
+        self.repo_dir = repo_dir
+        self.packdir = repo('objects/pack', repo_dir=repo_dir)
+        self.catpipe = None
+        self.idxs = {}  # idx basename -> PackIdx
+        self.midxs = []
+        self.search = []  # the midxs, then the idxs none of them cover
+        self.maps = {}  # idx basename -> mmap of its pack
+        self._last = None  # the idx the last object was in
+        self._mtime = None  # of packdir, when it was last read
+        self._bases = {}  # (idx basename, ofs) -> (type, content)
+        self._bases_size = 0
+        self.refresh()
+
+    def close(self):
+        for m in self.maps.itervalues():
+            m.close()
+        self.maps = {}
+        for mx in self.midxs:
+            mx.close()
+        self.midxs = []
+        self.idxs = {}
+        self.search = []
+        self._last = None
+        self._bases = {}
+        self._bases_size = 0
+
+    def refresh(self):
+        """Pick up any idx and midx files that have appeared since the
+        last time, and forget about any that are gone."""
         try:
-            for d in self._join(self.get(id)):
-                yield d
-        except StopIteration:
-            log('booger!\n')
+            self._mtime = os.stat(self.packdir).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._mtime = None
+        idxs = {}
+        for full in glob.glob(os.path.join(self.packdir, '*.idx')):
+            name = os.path.basename(full)
+            ix = self.idxs.get(name)
+            if ix is None:
+                try:
+                    ix = open_idx(full)
+                except GitError, e:
+                    add_error(e)
+                    continue
+            idxs[name] = ix
+        for name in self.idxs:
+            if name not in idxs and name in self.maps:
+                self.maps.pop(name).close()
+        self.idxs = idxs
+        for mx in self.midxs:
+            mx.close()
+        self.midxs = []
+        if not ignore_midx:
+            for full in glob.glob(os.path.join(self.packdir, '*.midx')):
+                mx = midx.PackMidx(full)
+                if mx.idxnames:
+                    self.midxs.append(mx)
+                else:
+                    mx.close()
+        self.midxs.sort(key=lambda mx: -len(mx))
+        covered = set()
+        for mx in self.midxs:
+            covered.update(mx.idxnames)
+        self.search = self.midxs + [ix for name, ix in sorted(idxs.items())
+                                    if name not in covered]
+        self._last = None
+
+    def _changed(self):
+        try:
+            return os.stat(self.packdir).st_mtime != self._mtime
+        except OSError:
+            return self._mtime is not None
+
+    def _find(self, sha):
+        """Return (idx basename, offset in the pack) of sha, or None."""
+        # Objects that were written together are usually read together.
+        last = self._last
+        if last is not None:
+            ofs = last.find_offset(sha)
+            if ofs is not None:
+                return os.path.basename(last.name), ofs
+        for ix in self.search:
+            if isinstance(ix, midx.PackMidx):
+                name = ix.exists(sha, want_source=True)
+                if not name:
+                    continue
+                sub = self.idxs.get(name)
+                if sub is None:  # the midx is out of date
+                    continue
+            else:
+                sub = ix
+            ofs = sub.find_offset(sha)
+            if ofs is not None:
+                self._last = sub
+                return os.path.basename(sub.name), ofs
+        return None
+
+    def _map(self, name):
+        m = self.maps.get(name)
+        if m is None:
+            packname = os.path.join(self.packdir, name[:-len('.idx')] + '.pack')
+            m = self.maps[name] = mmap_read(open(packname, 'rb'))
+        return m
+
+    def _header(self, m, ofs):
+        """Return the type, size and the offset of the data of the object
+        at ofs in the pack map m."""
+        hdr = m[ofs:ofs+16]  # much more than any size needs
+        c = ord(hdr[0])
+        type = (c & 0x70) >> 4
+        size = c & 0x0f
+        shift = 4
+        i = 0
+        while c & 0x80:
+            i += 1
+            c = ord(hdr[i])
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, ofs + i + 1
+
+    def _inflate(self, m, ofs, size):
+        """Generate the size bytes that the zlib stream at ofs in the pack
+        map m inflates to, in chunks of at most 64k."""
+        d = zlib.decompressobj()
+        left = size
+        tail = ''
+        while left:
+            if not tail:
+                # Only a little more than the data itself, so that zlib
+                # doesn't copy the rest of the pack as its unused_data.
+                tail = buffer(m, ofs, min(65536, left + left//1000 + 64))
+                if not tail:
+                    raise GitError('%r: object at %d is truncated'
+                                   % (m, ofs))
+                ofs += len(tail)
+            out = d.decompress(tail, min(left, 65536))
+            tail = d.unconsumed_tail
+            if len(out) > left or (d.unused_data and len(out) < left):
+                raise GitError('object is %d bytes, not the expected %d'
+                               % (size - left + len(out), size))
+            left -= len(out)
+            if out:
+                yield out
+
+    def _object(self, name, ofs):
+        """Return the type and content of the object at ofs in the pack of
+        the idx called name, applying any deltas."""
+        deltas = []
+        while 1:
+            base = self._bases.get((name, ofs))
+            if base is not None:
+                type, content = base
+                break
+            m = self._map(name)
+            t, size, pos = self._header(m, ofs)
+            if t == _OFS_DELTA:
+                c = ord(m[pos])
+                pos += 1
+                back = c & 0x7f
+                while c & 0x80:
+                    c = ord(m[pos])
+                    pos += 1
+                    back = ((back + 1) << 7) | (c & 0x7f)
+                deltas.append((name, ofs, ''.join(self._inflate(m, pos, size))))
+                ofs -= back
+            elif t == _REF_DELTA:
+                sha = m[pos:pos+20]
+                deltas.append((name, ofs,
+                               ''.join(self._inflate(m, pos + 20, size))))
+                found = self._find(sha)
+                if found is None:
+                    raise GitError('delta base %s is missing'
+                                   % sha.encode('hex'))
+                name, ofs = found
+            elif t in _typermap:
+                type = _typermap[t]
+                content = ''.join(self._inflate(m, pos, size))
+                break
+            else:
+                raise GitError('unknown object type %d at %d in %s'
+                               % (t, ofs, name))
+        while deltas:
+            name, ofs, delta = deltas.pop()
+            content = _helpers.apply_delta(content, delta)
+            if deltas:
+                self._remember_base(name, ofs, type, content)
+        return type, content
+
+    def _remember_base(self, name, ofs, type, content):
+        # Objects deltified against the same base tend to be read one after
+        # the other; keep the bases (to a limit) so the chain isn't redone.
+        if self._bases_size + len(content) > BASE_CACHE_MAX:
+            self._bases = {}
+            self._bases_size = 0
+        self._bases[(name, ofs)] = (type, content)
+        self._bases_size += len(content)
+
+    def _read(self, name, ofs):
+        m = self._map(name)
+        t, size, pos = self._header(m, ofs)
+        if t in _typermap:
+            # The common case: stream it, however big it is.
+            yield _typermap[t]
+            for data in self._inflate(m, pos, size):
+                yield data
+        else:
+            type, content = self._object(name, ofs)
+            yield type
+            yield content
+
+    def get(self, id):
+        """Generate the type of the object named id, and then its content.
+        Raise KeyError if it's missing."""
+        found = None
+        if _hex_rx.match(id):
+            sha = id.decode('hex')
+            found = self._find(sha)
+            if found is None and self._changed():
+                self.refresh()
+                found = self._find(sha)
+        if found is None:
+            if not self.catpipe:
+                self.catpipe = CatPipe(self.repo_dir)
+            for data in self.catpipe.get(id):
+                yield data
+            return
+        for data in self._read(*found):
+            yield data
+
+    def _delta_size(self, m, pos, size):
+        """Return the size of the object made by the delta of size bytes
+        at pos in the pack map m."""
+        # It's the second number in the header of the delta, so only the
+        # start of the delta is inflated, unless the stream is odd.
+        d = zlib.decompressobj()
+        delta = d.decompress(buffer(m, pos, 1024), 20)
+        if len(delta) < min(size, 20):
+            delta = ''.join(self._inflate(m, pos, size))
+        i = 0
+        for n in range(2):  # the size of the base, and then of the object
+            c = 0x80
+            shift = 0
+            size = 0
+            while c & 0x80:
+                c = ord(delta[i])
+                i += 1
+                size |= (c & 0x7f) << shift
+                shift += 7
+        return size
+
+    def locate(self, sha):
+        """Return (idx basename, offset in the pack, size) of the object
+        with the binary hash sha, or None if it isn't in any pack.  The
+        size is that of its content, even if it's stored as a delta.
+        Reading objects in the order of their locations reads each pack
+        from the start to the end."""
+        found = self._find(sha)
+        if found is None and self._changed():
+            self.refresh()
+            found = self._find(sha)
+        if found is None:
+            return None
+        (name, ofs) = found
+        m = self._map(name)
+        t, size, pos = self._header(m, ofs)
+        if t == _OFS_DELTA:
+            while ord(m[pos]) & 0x80:
+                pos += 1
+            size = self._delta_size(m, pos + 1, size)
+        elif t == _REF_DELTA:
+            size = self._delta_size(m, pos + 20, size)
+        return (name, ofs, size)
 
 
 _cp = {}
 
 def cp(repo_dir=None):
-    """Create a CatPipe object or reuse the already existing one."""
+    """Create a PackReader object or reuse the already existing one."""
     global _cp
     if not repo_dir:
         repo_dir = repo()
     repo_dir = os.path.abspath(repo_dir)
     cp = _cp.get(repo_dir)
     if not cp:
-        cp = CatPipe(repo_dir)
+        cp = PackReader(repo_dir)
         _cp[repo_dir] = cp
     return cp
 
 
+def _tree_size(entries):
+    # roughly what the tuple, and the int and strings in it, take per entry
+    return sum(200 + len(name) for mode, name, sha in entries)
+
+# The decoded trees that were read last, by sha.  They're the same in every
+# repository, so one cache serves them all.
+tree_cache = LRUCache(TREE_CACHE_MAX, _tree_size)
+
+def read_tree(sha, repo_dir=None):
+    """Return the (mode, name, hash) entries of the tree with the binary
+    hash sha, or of the tree of that commit."""
+    entries = tree_cache.get(sha)
+    if entries is None:
+        it = cp(repo_dir).get(sha.encode('hex'))
+        type = it.next()
+        buf = ''.join(it)
+        if type == 'commit':
+            treeline = buf.split('\n')[0]
+            assert(treeline.startswith('tree '))
+            return read_tree(treeline[5:].decode('hex'), repo_dir)
+        if type != 'tree':
+            raise GitError('%s is a %s, not a tree' % (sha.encode('hex'), type))
+        entries = tuple(tree_decode(buf))
+        tree_cache.put(sha, entries)
+    return entries
+
+
+def _cached_tree(id):
+    """Return the entries of the tree with the hex hash id if they're in
+    tree_cache, or None."""
+    if _hex_rx.match(id):
+        sha = id.decode('hex')
+        if sha in tree_cache:
+            return tree_cache.get(sha)
+    return None
+
+
 def tags(repo_dir = None):
     """Return a dictionary of all tags in the form {hash: [tag_names, ...]}."""
     tags = {}
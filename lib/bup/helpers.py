@@ -1,11 +1,11 @@
 """Helper functions and classes for bup."""
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from ctypes import sizeof, c_void_p
 from os import environ
 from contextlib import contextmanager
 import sys, os, pwd, subprocess, errno, socket, select, mmap, stat, re, struct
-import hashlib, heapq, math, operator, time, grp, tempfile
+import hashlib, heapq, math, operator, time, grp, tempfile, threading
 
 from bup import _helpers
 
@@ -270,6 +270,63 @@ def is_superuser():
         return os.geteuid() == 0
 
 
+class LRUCache:
+    """A mapping that holds at most max_size worth of values, as measured
+    by sizefn(value), and evicts the least recently used ones to make room,
+    calling evict(key, value) for each if it's given.  hits and misses
+    count the get() calls that found a value or didn't.  It can be shared
+    between threads.
+    """
+    def __init__(self, max_size, sizefn=len, evict=None):
+        self.max_size = max_size
+        self.sizefn = sizefn
+        self.evict = evict
+        self.size = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict()  # key -> (value, size), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = self.sizefn(value)
+        evicted = []
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                return  # it would only push everything else out
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                k, (v, s) = self._items.popitem(last=False)
+                self.size -= s
+                evicted.append((k, v))
+        if self.evict:
+            for (k, v) in evicted:
+                self.evict(k, v)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
 def _cache_key_value(get_value, key, cache):
     """Return (value, was_cached).  If there is a value in the cache
     for key, use that, otherwise, call get_value(key) which should
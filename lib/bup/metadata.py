@@ -784,6 +784,18 @@ class Metadata:
         except EOFError:
             raise Exception("EOF while reading Metadata")
 
+    @staticmethod
+    def skip(port):
+        # Move past the next record in port, like read(), but without
+        # decoding any of it.
+        tag = vint.read_vuint(port)
+        try:
+            while tag != _rec_tag_end:
+                vint.skip_bvec(port)
+                tag = vint.read_vuint(port)
+        except EOFError:
+            raise Exception("EOF while reading Metadata")
+
     def isdir(self):
         return stat.S_ISDIR(self.mode)
 
@@ -1,8 +1,10 @@
-import mmap
+import mmap, math, tempfile
+from array import array
 from bup import _helpers
 from bup.helpers import *
 
 MIDX_VERSION = 4
+SHA_PER_PAGE = 4096/20.
 
 extract_bits = _helpers.extract_bits
 _total_searches = 0
@@ -15,12 +17,12 @@ class PackMidx:
     and make it possible for bup to expand Git's indexing capabilities to vast
     amounts of files.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, map=None):
         self.name = filename
         self.force_keep = False
         self.map = None
         assert(filename.endswith('.midx'))
-        self.map = mmap_read(open(filename))
+        self.map = map or mmap_read(open(filename))
         if str(self.map[0:4]) != 'MIDX':
             log('Warning: skipping: invalid MIDX header in %r\n' % filename)
             self.force_keep = True
@@ -62,9 +64,6 @@ class PackMidx:
         s = self.fanout[start:start+4]
         return _helpers.firstword(s)
 
-    def _get(self, i):
-        return str(self.shatable[i*20:(i+1)*20])
-
     def _get_idx_i(self, i):
         return struct.unpack('!I', self.whichlist[i*4:(i+1)*4])[0]
 
@@ -80,35 +79,29 @@ class PackMidx:
         """Return nonempty if the object exists in the index files."""
         global _total_searches, _total_steps
         _total_searches += 1
-        want = str(hash)
-        el = extract_bits(want, self.bits)
-        if el:
-            start = self._fanget(el-1)
-            startv = el << (32-self.bits)
-        else:
-            start = 0
-            startv = 0
-        end = self._fanget(el)
-        endv = (el+1) << (32-self.bits)
-        _total_steps += 1   # lookup table is a step
-        hashv = _helpers.firstword(hash)
-        #print '(%08x) %08x %08x %08x' % (extract_bits(want, 32), startv, hashv, endv)
-        while start < end:
-            _total_steps += 1
-            #print '! %08x %08x %08x   %d - %d' % (startv, hashv, endv, start, end)
-            mid = start + (hashv-startv)*(end-start-1)/(endv-startv)
-            #print '  %08x %08x %08x   %d %d %d' % (startv, hashv, endv, start, mid, end)
-            v = self._get(mid)
-            #print '    %08x' % self._num(v)
-            if v < want:
-                start = mid+1
-                startv = _helpers.firstword(v)
-            elif v > want:
-                end = mid
-                endv = _helpers.firstword(v)
-            else: # got it!
-                return want_source and self._get_idxname(mid) or True
-        return None
+        idx, steps = _helpers.midx_find_sha(self.shatable, self.fanout,
+                                            self.bits, str(hash))
+        _total_steps += steps
+        if idx is None:
+            return None
+        return want_source and self._get_idxname(idx) or True
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes."""
+        shas = sorted(set(str(h) for h in hashes))
+        found = dict((shas[n], want_source and self._source(i) or True)
+                     for n, i in self._find_sorted(''.join(shas)))
+        return [found.get(str(h)) for h in hashes]
+
+    def _find_sorted(self, shas):
+        """Return an (n, index) pair for each of the concatenated sorted
+        shas that's in the midx, where it's the nth of them."""
+        found = array('i', _helpers.find_shas(self.shatable, 20, len(self),
+                                              shas))
+        return zip(found[::2], found[1::2])
+
+    def _source(self, idx):
+        return self._get_idxname(idx)
 
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
@@ -118,3 +111,36 @@ class PackMidx:
         return int(self._fanget(self.entries-1))
 
 
+
+
+def table_bits(total):
+    """Return the number of sha bits a midx of total objects is indexed by,
+    so that each entry of its table covers about a page of shas."""
+    pages = int(total/SHA_PER_PAGE) or 1
+    return int(math.ceil(math.log(pages, 2)))
+
+
+def merge(name, ixs):
+    """Return a PackMidx called name holding all the objects of the
+    (non-empty, version 2) PackIdxs in ixs.
+
+    Nothing is written to name; the midx lives in an unlinked temporary
+    file, so it goes away with the PackMidx.  That file takes 24 bytes
+    per object, so it's up to the caller to keep ixs small enough.
+    """
+    total = sum(len(ix) for ix in ixs)
+    bits = table_bits(total)
+    names = '\0'.join(os.path.basename(ix.name) for ix in ixs)
+    names_ofs = 12 + 4*2**bits + 24*total
+    f = tempfile.TemporaryFile()
+    f.write('MIDX')
+    f.write(struct.pack('!II', MIDX_VERSION, bits))
+    f.truncate(names_ofs + len(names))
+    f.flush()
+    map = mmap_readwrite(f)
+    # merge_into wants them in descending order of their first sha.
+    inp = [(ix.map, len(ix), ix.sha_ofs, 0, i) for i, ix in enumerate(ixs)]
+    inp.sort(key=lambda x: str(x[0][x[2]:x[2]+20]), reverse=True)
+    _helpers.merge_into(map, bits, total, inp, False)
+    map[names_ofs:] = names
+    return PackMidx(name, map)
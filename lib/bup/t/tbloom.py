@@ -1,4 +1,4 @@
-import errno, platform, tempfile
+import errno, platform, tempfile, threading
 from bup import bloom
 from bup.helpers import *
 from wvtest import *
@@ -16,8 +16,9 @@ def test_bloom():
     ix = Idx()
     ix.name='dummy.idx'
     ix.shatable = ''.join(hashes)
-    for k in (4, 5):
-        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+    for version, k in ((2, 4), (2, 5), (3, 5), (3, 7), (3, 14)):
+        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                         version=version)
         b.add_idx(ix)
         WVPASSLT(b.pfalse_positive(), .1)
         b.close()
@@ -38,6 +39,41 @@ def test_bloom():
     WVPASSEQ(b.rwfile, tf)
     WVPASSEQ(b.k, 5)
 
+    b = bloom.create(tmpdir + '/blocked.bloom', expected=100, version=3)
+    WVPASSEQ((b.version, b.headerlen, b.k), (3, 64, bloom.BLOCKED_K))
+    b.add_idx(ix)
+    b.close()
+    b = bloom.ShaBloom(tmpdir + '/blocked.bloom')
+    WVPASSEQ(b.version, 3)
+    WVPASSEQ(len(b), 100)
+    WVPASSEQ(b.idxnames, ['dummy.idx'])
+    WVPASS(b.exists(hashes[0]))
+    WVEXCEPT(ValueError, bloom.blocked_bloom_contains, b.map, hashes[0],
+             b.bits + 1, b.k)
+    WVEXCEPT(ValueError, bloom.blocked_bloom_contains, b.map, hashes[0],
+             b.bits, bloom.BLOCKED_MAX_K + 1)
+
+    # A writer that waits for the lock while bup bloom renames a new
+    # filter over the old one adds to the new one.
+    name = tmpdir + '/bup.bloom'
+    bloom.create(name, expected=100).close()
+    held = bloom.lock(name)
+    def add():
+        b = bloom.ShaBloom(name, readwrite=True, expected=1)
+        b.add_idx(ix)
+        b.close()
+    t = threading.Thread(target=add)
+    t.start()
+    time.sleep(0.2)  # long enough for it to be waiting
+    b = bloom.create(tmpdir + '/new.bloom', expected=100)
+    b.close()
+    os.rename(tmpdir + '/new.bloom', name)
+    held.close()
+    t.join()
+    b = bloom.ShaBloom(name)
+    WVPASSEQ(b.idxnames, ['dummy.idx'])
+    WVPASSEQ(len(b), 100)
+
     # Test large (~1GiB) filter.  This may fail on s390 (31-bit
     # architecture), and anywhere else where the address space is
     # sufficiently limited.
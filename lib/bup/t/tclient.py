@@ -162,3 +162,20 @@ def test_remote_parsing():
         WVFAIL()
     except client.ClientError:
         WVPASS()
+
+
+@wvtest
+def test_config_get():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tclient-')
+    os.environ['BUP_MAIN_EXE'] = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    c = client.Client(bupdir, create=True)
+    WVPASSEQ(c.config_get('bup.split.chunker'), None)
+    git.git_config_set('bup.split.chunker', 'fastcdc', bupdir)
+    WVPASSEQ(c.config_get('bup.split.chunker'), 'fastcdc')
+    WVPASSEQ(git.git_config_get('bup.split.chunker', bupdir), 'fastcdc')
+    c.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -0,0 +1,80 @@
+import os, tempfile
+from bup import git, commitgraph
+from bup.helpers import *
+from wvtest import *
+
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
+
+
+def _merge(w, tree, parents, date, msg):
+    l = ['tree %s' % tree.encode('hex')]
+    l += ['parent %s' % p.encode('hex') for p in parents]
+    l += ['author a <a@b> %d +0000' % date,
+          'committer a <a@b> %d +0000' % date, '', msg]
+    return w.maybe_write('commit', '\n'.join(l))
+
+
+@wvtest
+def test_commit_graph():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tcommitgraph-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter()
+    blob = w.new_blob('x')
+    tree = w.new_tree([(0100644, 'x', blob)])
+    c1 = w.new_commit(None, tree, 1000, 'one\n')
+    c2 = w.new_commit(c1, tree, 2000, 'two\n')
+    c3 = w.new_commit(c1, tree, 3000, 'three\n')
+    c4 = _merge(w, tree, [c2, c3], 4000, 'merge\n')
+    w.close(run_midx=False)
+
+    g = commitgraph.CommitGraph()
+    g.update([c2, blob])  # blobs are ignored
+    WVPASSEQ(len(g), 2)
+    WVPASSEQ(g.get(c2), commitgraph.Commit(tree, 2000, (c1,)))
+    WVPASSEQ(g.get(c1), commitgraph.Commit(tree, 1000, ()))
+    WVPASSEQ(list(g.history([c2])), [(2000, c2), (1000, c1)])
+    size = os.path.getsize(g.name)
+
+    # New commits are appended, after their parents.
+    g.update([c4])
+    WVPASSEQ(len(g), 4)
+    WVPASSEQ(g.get(c4).parents, (c2, c3))
+    WVPASSEQ(list(g.history([c4])),
+             [(4000, c4), (3000, c3), (2000, c2), (1000, c1)])
+    WVPASSEQ(list(g.history([c2, c3])),
+             [(2000, c2), (3000, c3), (1000, c1)])
+    WVPASS(os.path.getsize(g.name) > size)
+
+    g2 = commitgraph.CommitGraph()
+    g2.refresh()
+    WVPASS(g2.commits == g.commits)
+
+    # A record that was cut short is dropped, and written again.
+    f = open(g.name, 'r+b')
+    f.truncate(os.path.getsize(g.name) - 5)
+    f.close()
+    g3 = commitgraph.CommitGraph()
+    g3.refresh()
+    WVPASSEQ(len(g3), 3)
+    WVFAIL(c4 in g3)
+    g3.update([c4])
+    g4 = commitgraph.CommitGraph()
+    g4.refresh()
+    WVPASS(g4.commits == g.commits)
+
+    # A file in some other format is rebuilt.
+    open(g.name, 'wb').write('something else')
+    g5 = commitgraph.CommitGraph()
+    g5.update([c3])
+    WVPASSEQ(len(g5), 2)
+    g6 = commitgraph.CommitGraph()
+    g6.update([c4])
+    WVPASS(g6.commits == g.commits)
+    g7 = commitgraph.CommitGraph()
+    g7.refresh()
+    WVPASS(g7.commits == g.commits)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -1,5 +1,5 @@
-import struct, os, tempfile, time
-from bup import git
+import struct, os, tempfile, time, glob
+from bup import git, bloom, _helpers
 from bup.helpers import *
 from wvtest import *
 
@@ -89,13 +89,58 @@ def testpacks():
 
     WVFAIL(r.find_offset('\0'*20))
 
+    missing = ['\0'*20, '\xff'*20, hashes[7][:19] + '\0']
+    WVPASSEQ(r.exists_many(hashes[:10] + missing + hashes[:3]),
+             [True] * 10 + [None] * 3 + [True] * 3)
+    WVPASSEQ(r.exists_many([]), [])
+
     r = git.PackIdxList(bupdir + '/objects/pack')
     WVPASS(r.exists(hashes[5]))
     WVPASS(r.exists(hashes[6]))
     WVFAIL(r.exists('\0'*20))
+    WVPASSEQ(r.exists_many(hashes + missing),
+             [True] * nobj + [None] * len(missing))
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
 
+@wvtest
+def test_parallel_packwriter():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    blobs = [os.urandom(1000) for i in range(50)] + [str(i) for i in range(50)]
+    blobs += blobs[:10]  # duplicates must still only be written once
+    old_max_pack_objects = git.max_pack_objects
+    git.max_pack_objects = 30
+    try:
+        packs = {}
+        for jobs in (1, 4):
+            os.environ['BUP_DIR'] = bupdir = '%s/bup-%d' % (tmpdir, jobs)
+            git.init_repo(bupdir)
+            w = git.PackWriter(jobs=jobs)
+            hashes = [w.new_blob(b) for b in blobs]
+            w.close()
+            WVPASSEQ(hashes, [git.calc_hash('blob', b) for b in blobs])
+            packs[jobs] = sorted(open(p).read() for p in
+                                 glob.glob(bupdir + '/objects/pack/*.pack'))
+        WVPASSEQ(len(packs[1]), 4)
+        WVPASS(packs[1] == packs[4])
+
+        # Aborting stops the workers, and leaves no pack behind.
+        w = git.PackWriter(jobs=4)
+        for i in range(20):
+            w.new_blob(os.urandom(1000))
+        threads = w.encoder.threads
+        w.abort()
+        WVPASSEQ(w.encoder, None)
+        WVPASSEQ([t for t in threads if t.is_alive()], [])
+        WVPASSEQ(len(glob.glob(bupdir + '/objects/pack/*.pack')), 4)
+    finally:
+        git.max_pack_objects = old_max_pack_objects
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_pack_name_lookup():
     initial_failures = wvfailure_count()
@@ -117,10 +162,346 @@ def test_pack_name_lookup():
         idxnames.append(os.path.basename(w.close() + '.idx'))
 
     r = git.PackIdxList(packdir)
-    WVPASSEQ(len(r.packs), 2)
+    # The 14 packs were merged 4 at a time: 3 midxes and 2 lone idxes.
+    WVPASSEQ(len(r.packs), 5)
     for e,idxname in enumerate(idxnames):
         for i in range(e*2, (e+1)*2):
             WVPASSEQ(r.exists(hashes[i], want_source=True), idxname)
+    want = [idxnames[i // 2] for i in range(len(hashes))]
+    WVPASSEQ(r.exists_many(hashes + ['\0'*20], want_source=True),
+             want + [None])
+    WVPASSEQ(r.exists_many(list(reversed(hashes)), want_source=True),
+             list(reversed(want)))
+    del r  # PackWriter needs its own PackIdxList
+    w = git.PackWriter()
+    new = [str(i) for i in range(20, 40)]
+    new += new[:5]  # duplicates must still only be written once
+    ids = w.new_blobs(new)
+    WVPASSEQ(ids, [git.calc_hash('blob', b) for b in new])
+    WVPASSEQ(w.count, 12)  # 20..27 were already there
+    w.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_adaptive_lookup():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+
+    idxnames = []
+    hashes = []
+    for start in range(0, 40, 5):
+        w = git.PackWriter()
+        for i in range(start, start+5):
+            hashes.append(w.new_blob(str(i)))
+        idxnames.append(os.path.basename(w.close(run_midx=False) + '.idx'))
+    missing = ['\xff' * 20, '\0' * 20]
+
+    saved = (git.RECENT_MAX, git.MERGE_MIN_IDXS, git.MERGE_AFTER,
+             git.MERGE_MAX_OBJECTS)
+    git.RECENT_MAX, git.MERGE_MIN_IDXS, git.MERGE_AFTER = 4, 100, 2
+    try:
+        r = git.PackIdxList(packdir)
+        r.bloom = None
+        WVPASSEQ(len(r.packs), 8)
+        last = [p for p in r.packs if p.name.endswith(idxnames[-1])][0]
+        pos = r.packs.index(last)
+        for i in range(3):
+            WVPASSEQ(r.exists(hashes[-1], want_source=True), idxnames[-1])
+        WVPASSEQ(r._last, last)
+        WVPASSEQ(r.packs.index(last), max(pos - 1, 0))  # the busier moves up
+        WVPASSEQ(r.hits[last], 1)  # the other two were in the cache
+        for h in hashes[:6]:
+            WVPASS(r.exists(h))
+        WVPASS(len(r._recent) < 4)
+        WVPASS(r._recent_old)
+        WVPASSEQ(r._merged, None)
+        git.MERGE_MIN_IDXS = 3
+        for h in missing:
+            WVPASSEQ(r.exists(h), None)
+        WVPASS(r._merged)
+        WVPASSEQ(r.packs, [r._merged])
+        WVPASSEQ(len(r), len(hashes))
+        for e, idxname in enumerate(idxnames):
+            for h in hashes[e*5:(e+1)*5]:
+                WVPASSEQ(r.exists(h, want_source=True), idxname)
+        for h in missing:
+            WVPASSEQ(r.exists(h), None)
+        WVPASSEQ(r.exists_many(hashes + missing, want_source=True),
+                 [idxnames[i // 5] for i in range(len(hashes))] + [None, None])
+        r.refresh()
+        WVPASSEQ(r._merged, None)
+        WVPASSEQ(len(r.packs), 8)
+        WVPASSEQ(r.exists(hashes[0], want_source=True), idxnames[0])
+
+        # A lookup that merges the idxs part way, and then finds the object.
+        git.MERGE_AFTER = 1
+        p = [p for p in r.packs[git.MERGE_MIN_IDXS:] if p is not r._last][0]
+        h = str(iter(p).next())
+        WVPASSEQ(r.exists(h, want_source=True), os.path.basename(p.name))
+        WVPASSEQ(r.packs, [r._merged])
+        WVPASS(r._last is r._merged)
+        WVPASSEQ(r.hits.keys(), [r._merged])
+        WVPASSEQ(r._recent.values(), [r._merged])
+
+        # Too many objects to merge them all in a temporary file: the
+        # smallest are merged, and the rest are left alone.
+        r.refresh()
+        git.MERGE_MAX_OBJECTS = 19
+        for h in missing:
+            WVPASSEQ(r.exists(h), None)
+        WVPASS(r._merged)
+        WVPASSEQ(len(r._merged), 15)
+        WVPASSEQ(len(r.packs), 6)
+        WVPASSEQ(r.exists_many(hashes, want_source=True),
+                 [idxnames[i // 5] for i in range(len(hashes))])
+        r.refresh()
+        git.MERGE_MAX_OBJECTS = 14
+        for h in missing:
+            WVPASSEQ(r.exists(h), None)
+        WVPASSEQ(r._merged, None)
+        WVPASSEQ(len(r.packs), 8)
+
+        # A bloom filter that knows it's missing is asked before any idx.
+        class Stub:
+            def exists(self, hash, want_source=False):
+                asked.append(hash)
+        asked = []
+        r._last = Stub()
+        r.bloom = Stub()
+        r.do_bloom = True
+        WVPASSEQ(r.exists(missing[0]), None)
+        WVPASSEQ(asked, [missing[0]])
+        del r
+    finally:
+        (git.RECENT_MAX, git.MERGE_MIN_IDXS, git.MERGE_AFTER,
+         git.MERGE_MAX_OBJECTS) = saved
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_bloom_update():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    bfull = packdir + '/bup.bloom'
+
+    def write_pack(start, count=5):
+        w = git.PackWriter()
+        for i in range(start, start + count):
+            w.new_blob(str(i))
+        return w.close(run_midx=False) + '.idx'
+
+    idx1 = write_pack(0)
+    WVPASSEQ(git.add_to_bloom(packdir, idx1), None)  # there's no filter
+    b = bloom.create(bfull, expected=1000)
+    b.add_idx(git.open_idx(idx1))
+    b.close()
+
+    idx2 = write_pack(5)  # added to it in place
+    b = bloom.ShaBloom(bfull)
+    WVPASSEQ(sorted(b.idxnames),
+             sorted(os.path.basename(n) for n in (idx1, idx2)))
+    WVPASSEQ(len(b), 10)
+    WVPASS(b.exists(git.calc_hash('blob', '7')))
+    b.close()
+    r = git.PackIdxList(packdir)
+    WVPASS(r.bloom)  # still covers all of the packs
+    del r
+    WVPASSEQ(git.add_to_bloom(packdir, idx2), False)  # already there
+
+    # The idx that's added is closed again.
+    b = bloom.create(bfull, expected=1000)
+    b.add_idx(git.open_idx(idx1))
+    b.close()
+    opened = []
+    open_idx = git.open_idx
+    def recording_open_idx(filename):
+        opened.append(open_idx(filename))
+        return opened[-1]
+    git.open_idx = recording_open_idx
+    try:
+        WVPASSEQ(git.add_to_bloom(packdir, idx2), False)
+    finally:
+        git.open_idx = open_idx
+    WVPASSEQ([ix.map for ix in opened], [None])
+    WVPASSEQ(len(bloom.ShaBloom(bfull)), 10)
+
+    b = bloom.create(bfull, expected=1000)
+    b.add_idx(git.open_idx(idx2))
+    b.close()
+    idx3 = write_pack(10)
+    WVPASSEQ(git.add_to_bloom(packdir, idx3), None)  # idx1 is missing
+    WVPASSEQ(len(bloom.ShaBloom(bfull)), 5)
+
+    b = bloom.create(bfull, expected=1)
+    for idx in (idx1, idx2, idx3):
+        b.add_idx(git.open_idx(idx))
+    b.close()
+    idx4 = write_pack(15, 100)  # it's much too small for all of these
+    p = git._bloom_rebuilds.get(packdir)
+    WVPASS(p)
+    WVPASSEQ(p.wait(), 0)
+    b = bloom.ShaBloom(bfull)
+    WVPASSEQ(len(b), 115)
+    WVPASS(b.pfalse_positive() < bloom.MAX_PFALSE_POSITIVE)
+    WVPASSEQ(glob.glob(packdir + '/*.tmp.*'), [])
+    b.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_pack_reader():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+
+    # Similar blobs, so that git repack makes deltas of them, and a big
+    # one that's inflated in more than one piece.
+    blobs = ['%d %s\n' % (i, 'abcdefgh' * 1000) for i in range(20)]
+    blobs.append(''.join(str(i) for i in xrange(100000)))
+    w = git.PackWriter()
+    shas = [w.new_blob(b) for b in blobs]
+    tree = w.new_tree([(0100644, 'b%02d' % i, sha)
+                       for i, sha in enumerate(shas)])
+    commit = w.new_commit(None, tree, time.time(), 'reader test\n')
+    w.close()
+    git.update_ref('refs/heads/main', commit, None)
+    objects = [('blob', sha, b) for sha, b in zip(shas, blobs)]
+    it = git.CatPipe().get(tree.encode('hex'))
+    it.next()
+    objects.append(('tree', tree, ''.join(it)))
+
+    def check(r):
+        for type, sha, content in objects:
+            it = r.get(sha.encode('hex'))
+            WVPASSEQ(it.next(), type)
+            WVPASS(''.join(it) == content)
+        WVPASS(''.join(r.join(commit.encode('hex'))) == ''.join(blobs))
+
+    r = git.PackReader()
+    check(r)
+    WVPASSEQ(r.catpipe, None)  # it was all read from the pack
+    # Names that aren't hashes go to git.
+    WVPASSEQ(list(r.get('refs/heads/main'))[0], 'commit')
+    WVPASS(r.catpipe)
+    WVEXCEPT(KeyError, list, r.get('0' * 40))
+    locs = [r.locate(sha) for sha in shas]
+    WVPASSEQ([ofs for name, ofs, size in locs],
+             sorted(ofs for name, ofs, size in locs))  # as they were written
+    WVPASSEQ([size for name, ofs, size in locs], [len(b) for b in blobs])
+    WVPASSEQ(r.locate('\0' * 20), None)
+
+    # A pack written after the reader was made is found.
+    w = git.PackWriter()
+    sha = w.new_blob('later')
+    w.close()
+    WVPASSEQ(r.locate(sha)[2], 5)
+    WVPASSEQ(list(r.get(sha.encode('hex'))), ['blob', 'later'])
+    r.close()
+
+    # Packs that git made, with both kinds of delta.
+    for offsets in ('true', 'false'):
+        subprocess.check_call(['git', '--git-dir', bupdir,
+                               '-c', 'repack.useDeltaBaseOffset=' + offsets,
+                               'repack', '-adfq'])
+        r = git.PackReader()
+        WVPASSEQ(len(r.idxs), 1)
+        name, = r.idxs
+        types = set(r._header(r._map(name), r._find(sha)[1])[0]
+                    for type, sha, content in objects)
+        WVPASS(offsets == 'true' and 6 in types or 7 in types)
+        check(r)
+        WVPASSEQ([r.locate(sha)[2] for type, sha, content in objects],
+                 [len(content) for type, sha, content in objects])
+        r.close()
+
+    WVEXCEPT(ValueError, _helpers.apply_delta, 'abc', '\x03\x03\x00')
+    WVEXCEPT(ValueError, _helpers.apply_delta, 'abc', '\x03\x03\x91\x01\x03')
+    WVPASSEQ(_helpers.apply_delta('abc', '\x03\x04\x91\x01\x02\x02xy'), 'bcxy')
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_catpipe_join():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter()
+    blobs = [str(i) * 10 for i in range(200)]
+    shas = [w.new_blob(b) for b in blobs]
+    # Blobs on both sides of subtrees.
+    sub = w.new_tree([(0100644, 'b%03d' % i, shas[i]) for i in range(10, 20)])
+    subsub = w.new_tree([(040000, 'sub', sub)])
+    tree = w.new_tree([(0100644, 'a%03d' % i, shas[i]) for i in range(10)]
+                      + [(040000, 'b', subsub)]
+                      + [(0100644, 'c%03d' % i, shas[i])
+                         for i in range(20, 200)])
+    missing = git.calc_hash('blob', 'missing')
+    broken = w.new_tree([(0100644, 'a', shas[0]), (0100644, 'b', missing),
+                         (0100644, 'c', shas[1])])
+    w.close()
+
+    cp = git.CatPipe()
+    WVPASSEQ(''.join(cp.join(tree.encode('hex'))), ''.join(blobs))
+    it = cp.join(broken.encode('hex'))
+    WVPASSEQ(it.next(), blobs[0])
+    WVEXCEPT(KeyError, it.next)
+    # Stop part way through a blob.
+    it = cp.join(tree.encode('hex'))
+    WVPASSEQ(it.next(), blobs[0])
+    it.close()
+    WVPASSEQ(list(cp.get(shas[5].encode('hex'))), ['blob', blobs[5]])
+    WVPASSEQ(''.join(cp.join(tree.encode('hex'))), ''.join(blobs))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_tree_cache():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter()
+    blob = w.new_blob('x')
+    sub = w.new_tree([(0100644, 'x', blob)])
+    tree = w.new_tree([(040000, 'sub', sub), (0100644, 'y', blob)])
+    commit = w.new_commit(None, tree, time.time(), 'tree cache test\n')
+    w.close()
+
+    git.tree_cache.clear()
+    hits, misses = git.tree_cache.hits, git.tree_cache.misses
+    entries = git.read_tree(tree)
+    WVPASSEQ(entries, ((040000, 'sub', sub), (0100644, 'y', blob)))
+    WVPASS(git.read_tree(tree) is entries)
+    WVPASS(git.read_tree(commit) is entries)  # a commit's tree
+    WVPASSEQ(git.tree_cache.hits - hits, 2)
+    WVPASSEQ(git.tree_cache.misses - misses, 2)  # tree, then commit
+    WVEXCEPT(git.GitError, git.read_tree, blob)
+
+    # Joins fill the cache, and use it.
+    git.tree_cache.clear()
+    for reader in (git.PackReader(), git.CatPipe()):
+        WVPASSEQ(''.join(reader.join(commit.encode('hex'))), 'xx')
+        WVPASS(sub in git.tree_cache)
+    hits = git.tree_cache.hits
+    WVPASSEQ(''.join(git.CatPipe().join(tree.encode('hex'))), 'xx')
+    WVPASSEQ(git.tree_cache.hits - hits, 2)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
 
@@ -1,3 +1,5 @@
+import hashlib, math, mmap, os, tempfile
+from array import array
 from bup import hashsplit, _helpers
 from wvtest import *
 from cStringIO import StringIO
@@ -51,3 +53,247 @@ def test_fanout_behaviour():
     hashsplit.BLOB_MAX = old_BLOB_MAX
     hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
     hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_buf_reuse():
+    # Force the ring buffer to wrap many times, and make sure readinto()
+    # and plain read() files split the same way.
+    old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
+    hashsplit.BLOB_READ_SIZE = hashsplit.BLOB_MAX * 3
+    try:
+        data = os.urandom(hashsplit.BLOB_MAX * 20)
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        for src in (f, StringIO(data)):
+            blobs = [str(b) for b, l in
+                     hashsplit.hashsplit_iter([src, StringIO(data)],
+                                              True, None)]
+            WVPASS(len(blobs) > 40)
+            WVPASS(''.join(blobs) == data + data)
+            WVPASS(max(len(b) for b in blobs) <= hashsplit.BLOB_MAX)
+    finally:
+        hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
+
+
+@wvtest
+def test_splitbuf_all():
+    # The batch splitter must find exactly the splits the per-blob loop does,
+    # including blobs capped at BLOB_MAX.
+    basebits = _helpers.blobbits()
+    fanbits = int(math.log(hashsplit.fanout, 2))
+    data = (os.urandom(200000) + '\0' * (hashsplit.BLOB_MAX * 3 + 17)
+            + os.urandom(100000))
+    def splits(splitter):
+        buf = hashsplit.Buf()
+        buf.put(data)
+        return [(str(b), level) for b, level in
+                splitter(buf, basebits, fanbits)]
+    ref = splits(hashsplit._splitbuf)
+    WVPASS(len(ref) > 20)
+    WVPASS(splits(lambda buf, basebits, fanbits:
+                  hashsplit._splitbuf_all(buf, basebits, fanbits,
+                                          hashsplit._find_bupsplit)) == ref)
+    WVPASSEQ(_helpers.splitbuf_all('', hashsplit.BLOB_MAX), '')
+    WVEXCEPT(ValueError, _helpers.splitbuf_all, data, 0)
+
+
+@wvtest
+def test_mmap_split():
+    old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
+    old_MMAP_MIN_SIZE = hashsplit.MMAP_MIN_SIZE
+    hashsplit.BLOB_READ_SIZE = hashsplit.BLOB_MAX * 3
+    hashsplit.MMAP_MIN_SIZE = 1
+    try:
+        data = os.urandom(hashsplit.BLOB_MAX * 20)
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+
+        f.seek(0)
+        buf = hashsplit.Buf()
+        WVPASSEQ(buf.fill(f, 100), 100)
+        WVPASS(buf.map is not None)
+        WVPASS(str(buf.get(100)) == data[:100])
+        buf.release()
+
+        def split(files, keep_boundaries=False):
+            return [(str(b), l) for b, l in
+                    hashsplit.hashsplit_iter(files, keep_boundaries, None)]
+        for keep_boundaries in (False, True):
+            f.seek(0)
+            blobs = split([f, StringIO(data)], keep_boundaries)
+            WVPASS(blobs == split([StringIO(data), StringIO(data)],
+                                  keep_boundaries))
+
+        # If the file grows while we split it, we read the rest.
+        f.seek(0)
+        it = hashsplit.hashsplit_iter([f], False, None)
+        first = str(it.next()[0])
+        f.seek(0, 2)
+        f.write(data)
+        f.flush()
+        rest = ''.join(str(b) for b, l in it)
+        WVPASS(first + rest == data + data)
+
+        # If it shrinks, we get what's left, instead of a SIGBUS.
+        f.seek(0)
+        f.truncate(len(data))
+        it = hashsplit.hashsplit_iter([f], False, None)
+        first = str(it.next()[0])
+        f.truncate(hashsplit.BLOB_MAX * 10)
+        rest = ''.join(str(b) for b, l in it)
+        WVPASS(first + rest == data[:hashsplit.BLOB_MAX * 10])
+        f.seek(0)
+        buf = hashsplit.Buf()
+        WVPASSEQ(buf.fill(f, 100000), 100000)
+        f.truncate(0)
+        WVPASS(str(buf.get(100000)) == data[:100000])
+        WVPASSEQ(buf.fill(f, 100000), 0)
+        buf.release()
+        f.seek(0)
+        f.write(data)
+        f.flush()
+
+        m = mmap.mmap(f.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
+        dest = bytearray(100)
+        WVPASSEQ(_helpers.copy_mapped(dest, 0, m, 10, 100), 100)
+        WVPASS(str(dest) == data[10:110])
+        f.truncate(0)
+        WVEXCEPT(IOError, _helpers.copy_mapped, dest, 0, m, 10, 100)
+        WVEXCEPT(ValueError, _helpers.copy_mapped, dest, 1, m, 10, 100)
+    finally:
+        hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
+        hashsplit.MMAP_MIN_SIZE = old_MMAP_MIN_SIZE
+
+
+@wvtest
+def test_read_blobs():
+    data = os.urandom(hashsplit.BLOB_MAX * 10)
+    written = []
+    def makeblob(b):
+        written.append(str(b))
+        return str(len(written))
+    def maketree(shalist):
+        written.append(shalist)
+        return 'tree%d' % len(written)
+    want = hashsplit.split_to_blob_or_tree(makeblob, maketree,
+                                           [StringIO(data)], False)
+    want_written = written[:]
+    del written[:]
+    blobs = hashsplit.read_blobs([StringIO(data)])
+    WVPASS(''.join(b for b, level in blobs) == data)
+    WVPASSEQ(written, [])
+    WVPASSEQ(hashsplit.blobs_to_blob_or_tree(makeblob, maketree, blobs), want)
+    WVPASS(written == want_written)
+
+
+@wvtest
+def test_fastcdc():
+    # Changing the gear table, or anything else about the splitting,
+    # changes every split and ruins dedup with existing repositories.
+    data = ''.join(hashlib.sha1(str(i)).digest() for i in xrange(10000))
+    splits = array('I', _helpers.fastcdc_splitbuf_all(data, 32768, 13))
+    WVPASSEQ(list(splits[:12]), [12768, 18, 21312, 15, 33856, 13,
+                                 49056, 14, 61071, 13, 72116, 13])
+    WVEXCEPT(ValueError, _helpers.fastcdc_splitbuf_all, data, 32768, 2)
+
+    old_chunker = hashsplit.chunker
+    old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
+    hashsplit.chunker = 'fastcdc'
+    try:
+        def split(data):
+            return [str(b) for b, level in
+                    hashsplit.hashsplit_iter([StringIO(data)], False, None)]
+        data = os.urandom(1024 * 1024)
+        blobs = split(data)
+        WVPASS(''.join(blobs) == data)
+        sizes = [len(b) for b in blobs[:-1]]
+        WVPASS(min(sizes) >= 2048)
+        WVPASS(max(sizes) <= hashsplit.BLOB_MAX)
+        WVPASS(4096 < len(data) / len(blobs) < 16384)
+        # The splits don't depend on how much we read at a time...
+        hashsplit.BLOB_READ_SIZE = hashsplit.BLOB_MAX + 1000
+        WVPASS(split(data) == blobs)
+        # ...and quickly resynchronize after an insertion.
+        moved = split('x' * 100 + data)
+        WVPASS(len(set(blobs) & set(moved)) >= len(blobs) - 2)
+    finally:
+        hashsplit.chunker = old_chunker
+        hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
+
+
+@wvtest
+def test_fadvise_willneed():
+    f = tempfile.NamedTemporaryFile()
+    f.write('x' * 100000)
+    f.flush()
+    hashsplit.fadvise_willneed(f.name, 100000)
+    hashsplit.fadvise_willneed(f.name, 1 << 40)  # past the end is fine
+    hashsplit.fadvise_willneed(os.path.dirname(f.name), 4096)  # so is a dir
+    hashsplit.fadvise_willneed(f.name + '-missing', 0)  # nothing to do
+    WVEXCEPT(OSError, hashsplit.fadvise_willneed, f.name + '-missing', 1)
+
+
+@wvtest
+def test_configure():
+    old_params = hashsplit.params()
+    try:
+        hashsplit.configure({}.get)
+        WVPASSEQ(hashsplit.chunker, 'bupsplit')
+        WVPASSEQ(hashsplit.params(), old_params)
+        hashsplit.configure({'bup.split.chunker': 'fastcdc'}.get)
+        WVPASSEQ(hashsplit.chunker, 'fastcdc')
+        WVEXCEPT(ValueError, hashsplit.configure,
+                 {'bup.split.chunker': 'nope'}.get)
+        WVPASSEQ(hashsplit.chunker, 'fastcdc')
+
+        config = {'bup.split.chunker': 'fastcdc',
+                  'bup.split.blobbits': '16',
+                  'bup.split.fanout': '4',
+                  'bup.split.treemax': '64'}
+        hashsplit.configure(config.get)
+        WVPASSEQ(hashsplit.params(), [('bup.split.chunker', 'fastcdc'),
+                                      ('bup.split.blobbits', '16'),
+                                      ('bup.split.maxblob', '262144'),
+                                      ('bup.split.fanout', '4'),
+                                      ('bup.split.treemax', '64')])
+        hashsplit.configure(dict(hashsplit.params()).get)
+        WVPASSEQ(dict(hashsplit.params()), dict(config,
+                                                **{'bup.split.maxblob':
+                                                   '262144'}))
+        config['bup.split.maxblob'] = '100k'
+        hashsplit.configure(config.get)
+        WVPASSEQ(hashsplit.BLOB_MAX, 100 * 1024)
+        for option, value in (('bup.split.blobbits', '17'),  # bupsplit
+                              ('bup.split.blobbits', '9'),
+                              ('bup.split.blobbits', 'x'),
+                              ('bup.split.maxblob', '4k'),
+                              ('bup.split.maxblob', '1M'),
+                              ('bup.split.fanout', '1')):
+            WVEXCEPT(ValueError, hashsplit.configure,
+                     {option: value}.get)
+        WVPASSEQ(hashsplit.BLOB_MAX, 100 * 1024)
+    finally:
+        hashsplit.configure(dict(old_params).get)
+
+
+@wvtest
+def test_blobbits():
+    old_params = hashsplit.params()
+    try:
+        data = os.urandom(4 * 1024 * 1024)
+        for chunker in sorted(hashsplit.CHUNKERS):
+            for bits in (12, 15):
+                hashsplit.configure({'bup.split.chunker': chunker,
+                                     'bup.split.blobbits': str(bits)}.get)
+                blobs = [str(b) for b, level in
+                         hashsplit.hashsplit_iter([StringIO(data)],
+                                                  False, None)]
+                WVPASS(''.join(blobs) == data)
+                WVPASS(max(len(b) for b in blobs) <= 4 << bits)
+                avg = len(data) / len(blobs)
+                WVPASS((1 << bits) / 2 < avg < (1 << bits) * 2)
+    finally:
+        hashsplit.configure(dict(old_params).get)
@@ -179,3 +179,29 @@ def test_atomically_replaced_file():
 
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_lru_cache():
+    c = LRUCache(10)
+    c.put('a', 'aaaa')
+    c.put('b', 'bbbb')
+    WVPASSEQ(c.get('a'), 'aaaa')  # so 'b' is now the oldest
+    c.put('c', 'cccc')
+    WVPASSEQ((len(c), c.size), (2, 8))
+    WVPASSEQ(c.get('b'), None)
+    WVPASSEQ(c.get('c'), 'cccc')
+    WVPASSEQ((c.hits, c.misses), (2, 1))
+    c.put('c', 'cc')
+    WVPASSEQ(c.size, 6)
+    c.put('d', 'd' * 11)  # bigger than the whole cache
+    WVFAIL('d' in c)
+    WVPASS('a' in c)
+    c.clear()
+    WVPASSEQ((len(c), c.size), (0, 0))
+
+    evicted = []
+    c = LRUCache(2, lambda v: 1, lambda k, v: evicted.append((k, v)))
+    for k in 'abc':
+        c.put(k, k.upper())
+    WVPASSEQ(evicted, [('a', 'A')])
@@ -0,0 +1,212 @@
+import os, tempfile, time, random
+from cStringIO import StringIO
+from bup import git, hashsplit, metadata, vfs
+from bup.helpers import *
+from wvtest import *
+
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
+
+
+@wvtest
+def test_file_reads():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tvfs-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    rand = random.Random(1)
+    data = ''.join(chr(rand.randrange(256)) for i in xrange(1024*1024))
+    small = data[:5000]
+
+    old_fanout = hashsplit.fanout
+    hashsplit.fanout = 2  # for trees of both chunks and subtrees, many deep
+    try:
+        w = git.PackWriter()
+        mode, sha = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
+                                                    [StringIO(data)],
+                                                    keep_boundaries=False)
+        WVPASSEQ(mode, hashsplit.GIT_MODE_TREE)
+        tree = w.new_tree([(mode, git.mangle_name('big', 0100644, mode), sha),
+                           (0100644, 'small', w.new_blob(small))])
+        commit = w.new_commit(None, tree, time.time(), 'vfs test\n')
+        w.close(run_midx=False)
+    finally:
+        hashsplit.fanout = old_fanout
+    git.update_ref('refs/heads/test', commit, None)
+
+    top = vfs.RefList(None)
+    for name, content in (('big', data), ('small', small)):
+        n = top.lresolve('/test/latest/' + name)
+        WVPASSEQ(n.size(), len(content))
+        f = n.open()
+        WVPASS(f.read() == content)
+        WVPASSEQ(f.read(), '')
+        ok = True
+        for i in xrange(200):
+            ofs = rand.randrange(len(content))
+            count = rand.choice((1, 100, 4096, 20000))
+            f.seek(ofs)
+            ok = ok and f.read(count) == content[ofs:ofs+count]
+            ok = ok and f.tell() == min(ofs + count, len(content))
+        WVPASS(ok)
+        f.seek(len(content) - 10)
+        WVPASSEQ(len(f.read(100)), 10)
+        f.seek(12345)
+        out = []
+        while 1:
+            b = f.read(3000)
+            if not b:
+                break
+            out.append(b)
+        WVPASS(''.join(out) == content[12345:])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_dir_cache():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tvfs-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter()
+    blob = w.new_blob('x')
+    subs = [w.new_tree([(0100644, 'f%d' % j, blob) for j in xrange(10)]
+                       + [(0100644, 'only%d' % i, blob)])
+            for i in xrange(20)]
+    tree = w.new_tree([(040000, 'd%02d' % i, sha)
+                       for (i, sha) in enumerate(subs)])
+    commit = w.new_commit(None, tree, time.time(), 'vfs test\n')
+    w.close(run_midx=False)
+    git.update_ref('refs/heads/test', commit, None)
+
+    old_cache = vfs._dir_cache
+    vfs._dir_cache = LRUCache(50, old_cache.sizefn, old_cache.evict)
+    try:
+        top = vfs.RefList(None)
+        d = top.resolve('/test/latest')
+        WVFAIL(hasattr(d, '__dict__'))
+        WVEXCEPT(vfs.NoSuchFile, d.sub, 'nope')
+        WVPASSEQ(len(d._subs), 20)
+        WVPASS(isinstance(d._subs['d05'], tuple))  # not made until needed
+        d5 = d.sub('d05')
+        WVPASS(d._subs['d05'] is d5)
+        WVPASS(d.sub('d05') is d5)
+
+        ok = True
+        for rounds in xrange(2):
+            for i in xrange(20):
+                names = [n.name for n in d.sub('d%02d' % i)]
+                ok = ok and names == sorted(['f%d' % j for j in xrange(10)]
+                                            + ['only%d' % i])
+                ok = ok and vfs._dir_cache.size <= 50
+        WVPASS(ok)
+        WVPASS(d5._subs is None)  # released, and made again when needed
+        WVPASSEQ(d5.sub('only5').size(), 1)
+        WVPASSEQ(top.lresolve('/test/latest/d07/only7').open().read(), 'x')
+    finally:
+        vfs._dir_cache = old_cache
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_metadata():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tvfs-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    src = tmpdir + '/src'
+    mkdirp(src + '/sub')
+    names = ['f%03d' % i for i in xrange(100)]
+    for i, name in enumerate(names):
+        open(src + '/' + name, 'w').write('x')
+        os.chmod(src + '/' + name, 0600 + (i % 8))
+    os.symlink('f000', src + '/link')
+
+    w = git.PackWriter()
+    blob = w.new_blob('x')
+    meta = StringIO()
+    metadata.from_path(src).write(meta, include_path=False)
+    entries = []
+    for name in sorted(names + ['link']):
+        metadata.from_path(src + '/' + name).write(meta, include_path=False)
+        mode = name == 'link' and 0120000 or 0100644
+        entries.append((mode, name, blob))
+    entries.append((0100644, '.bupm', w.new_blob(meta.getvalue())))
+    entries.append((040000, 'sub', w.new_tree([])))
+    tree = w.new_tree(entries)
+    commit = w.new_commit(None, tree, time.time(), 'vfs test\n')
+    w.close(run_midx=False)
+    git.update_ref('refs/heads/test', commit, None)
+
+    port = StringIO(meta.getvalue())
+    n = 0
+    while port.tell() < len(meta.getvalue()):
+        metadata.Metadata.skip(port)
+        n += 1
+    WVPASSEQ(n, 102)
+
+    d = vfs.RefList(None).resolve('/test/latest')
+    WVPASSEQ(d.metadata().mode, os.lstat(src).st_mode)
+    m = d.sub('link').metadata()
+    WVPASSEQ(m.symlink_target, 'f000')
+    ok = True
+    for name in reversed(names):
+        m = d.sub(name).metadata()
+        ok = ok and m.mode == os.stat(src + '/' + name).st_mode
+    WVPASS(ok)
+    WVPASSEQ(d.sub('sub').metadata(), None)  # it has no .bupm
+    vfs._bupm_indexes.clear()
+    d.release()
+    WVPASSEQ(d.sub('f042').metadata().mode, os.stat(src + '/f042').st_mode)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_path_cache():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tvfs-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter()
+    blob = w.new_blob('x')
+    tree = w.new_tree([(040000, 'd', w.new_tree([(0100644, 'a', blob),
+                                                  (0100644, 'b', blob)]))])
+    commit = w.new_commit(None, tree, time.time(), 'vfs test\n')
+    w.close(run_midx=False)
+    git.update_ref('refs/heads/test', commit, None)
+
+    top = vfs.RefList(None)
+    a = top.lresolve('/test/latest/d/a')
+    WVPASSEQ(a.name, 'a')
+    WVPASS(top.lresolve('/test/latest/d/a') is a)
+    WVPASS(top.lresolve('test//latest/d/a') is a)
+    WVPASS(top.resolve('/test/latest/d/b').parent is a.parent)
+    WVPASS(top.resolve('/test/latest/d/a/..') is a.parent)
+    WVEXCEPT(vfs.NoSuchFile, top.lresolve, '/test/latest/d/c')
+    WVPASS(isinstance(top._paths.get(('test', 'latest', 'd', 'c')),
+                      vfs.NoSuchFile))
+    WVEXCEPT(vfs.NoSuchFile, top.lresolve, '/test/latest/d/c')
+    WVEXCEPT(vfs.NoSuchFile, top.lresolve, '/other/latest')
+
+    # A change to the refs drops everything that was resolved.
+    git.update_ref('refs/heads/other', commit, None)
+    b = top.lresolve('/other/latest/d/a')
+    WVPASSEQ(b.open().read(), 'x')
+    WVFAIL(top.lresolve('/test/latest/d/a') is a)
+
+    # Even a change to a ref in a subdirectory, which doesn't touch
+    # refs/heads itself.
+    git.update_ref('refs/heads/nested/x', commit, None)
+    a = top.lresolve('/test/latest/d/a')
+    WVPASS(top.lresolve('/test/latest/d/a') is a)
+    w = git.PackWriter()
+    commit2 = w.new_commit(commit, tree, time.time(), 'nested\n')
+    w.close(run_midx=False)
+    git.update_ref('refs/heads/nested/x', commit2, commit)
+    WVFAIL(top.lresolve('/test/latest/d/a') is a)
+    WVPASSEQ(top.sub('nested/x').hash, commit2)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
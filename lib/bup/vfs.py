@@ -3,13 +3,18 @@
 The vfs.py library makes it possible to expose contents from bup's repository
 and abstracts internal name mangling and storage from the exposition layer.
 """
-import os, re, stat, time
-from bup import git, metadata
+import os, re, stat, time, bisect
+from cStringIO import StringIO
+from bup import git, metadata, commitgraph
 from helpers import *
 from bup.git import BUP_NORMAL, BUP_CHUNKED, cp
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
 
 EMPTY_SHA='\0'*20
+CHUNK_INDEX_MAX = 16*1024*1024  # bytes of chunk tree offsets to keep
+DIR_CACHE_MAX = 200000  # directory entries to keep nodes for
+BUPM_INDEX_MAX = 16*1024*1024  # bytes of indexed .bupm files to keep
+PATH_CACHE_MAX = 10000  # resolved paths to keep, for each RefList
 
 
 class NodeError(Exception):
@@ -33,17 +38,10 @@ class TooManySymlinks(NodeError):
     pass
 
 
-def _treeget(hash, repo_dir=None):
-    it = cp(repo_dir).get(hash.encode('hex'))
-    type = it.next()
-    assert(type == 'tree')
-    return git.tree_decode(''.join(it))
-
-
 def _tree_decode(hash, repo_dir=None):
     tree = [(int(name,16),stat.S_ISDIR(mode),sha)
             for (mode,name,sha)
-            in _treeget(hash, repo_dir)]
+            in git.read_tree(hash, repo_dir)]
     assert(tree == list(sorted(tree)))
     return tree
 
@@ -68,56 +66,44 @@ def _total_size(hash, repo_dir=None):
     return lastofs + lastsize
 
 
-def _chunkiter(hash, startofs, repo_dir=None):
-    assert(startofs >= 0)
-    tree = _tree_decode(hash, repo_dir)
-
-    # skip elements before startofs
-    for i in xrange(len(tree)):
-        if i+1 >= len(tree) or tree[i+1][0] > startofs:
-            break
-    first = i
-
-    # iterate through what's left
-    for i in xrange(first, len(tree)):
-        (ofs,isdir,sha) = tree[i]
-        skipmore = startofs-ofs
-        if skipmore < 0:
-            skipmore = 0
-        if isdir:
-            for b in _chunkiter(sha, skipmore, repo_dir):
-                yield b
-        else:
-            yield ''.join(cp(repo_dir).join(sha.encode('hex')))[skipmore:]
-
-
-class _ChunkReader:
-    def __init__(self, hash, isdir, startofs, repo_dir=None):
-        if isdir:
-            self.it = _chunkiter(hash, startofs, repo_dir)
-            self.blob = None
-        else:
-            self.it = None
-            self.blob = ''.join(cp(repo_dir).join(hash.encode('hex')))[startofs:]
-        self.ofs = startofs
-
-    def next(self, size):
-        out = ''
-        while len(out) < size:
-            if self.it and not self.blob:
-                try:
-                    self.blob = self.it.next()
-                except StopIteration:
-                    self.it = None
-            if self.blob:
-                want = size - len(out)
-                out += self.blob[:want]
-                self.blob = self.blob[want:]
-            if not self.it:
-                break
-        debug2('next(%d) returned %d\n' % (size, len(out)))
-        self.ofs += len(out)
-        return out
+def _chunk_level_size(level):
+    # the offset, the sha and the subtree flag of each entry
+    return len(level[0]) * 64
+
+# The offsets of the entries of the chunk trees of files, by tree sha.
+_chunk_levels = LRUCache(CHUNK_INDEX_MAX, _chunk_level_size)
+
+def _chunk_level(hash, repo_dir=None):
+    """Return the offsets of the entries of the chunk tree hash, whether
+    each is a subtree (as a string of '\\0' or '\\1'), and their shas (all
+    in one string)."""
+    level = _chunk_levels.get(hash)
+    if level is None:
+        tree = _tree_decode(hash, repo_dir)
+        level = ([ofs for (ofs,isdir,sha) in tree],
+                 ''.join(isdir and '\1' or '\0' for (ofs,isdir,sha) in tree),
+                 ''.join(sha for (ofs,isdir,sha) in tree))
+        _chunk_levels.put(hash, level)
+    return level
+
+
+def _find_chunk(tree, ofs, repo_dir=None):
+    """Find the chunk that holds ofs, starting from tree, which is a chunk
+    tree of a file as (_chunk_level(), where it starts in the file, where
+    it ends or None at the end of the file).  Return the same for the tree
+    that the chunk is in, and the chunk's index in it."""
+    (level, start, end) = tree
+    while 1:
+        (offsets, isdirs, shas) = level
+        assert(offsets)
+        # each entry's offset is from the start of its tree
+        i = max(bisect.bisect_right(offsets, ofs - start) - 1, 0)
+        if isdirs[i] == '\0':
+            return ((level, start, end), i)
+        if i + 1 < len(offsets):
+            end = start + offsets[i+1]
+        start += offsets[i]
+        level = _chunk_level(shas[i*20 : i*20+20], repo_dir)
 
 
 class _FileReader(object):
@@ -126,7 +112,8 @@ class _FileReader(object):
         self.ofs = 0
         self.size = size
         self.isdir = isdir
-        self.reader = None
+        self._chunk = None  # (sha, offset, content) of the last chunk read
+        self._tree = None  # the chunk tree of the last chunk read
         self._repo_dir = repo_dir
 
     def seek(self, ofs):
@@ -140,29 +127,68 @@ class _FileReader(object):
     def tell(self):
         return self.ofs
 
+    def _chunk_at(self, ofs):
+        chunk = self._chunk
+        if chunk and chunk[1] <= ofs < chunk[1] + len(chunk[2]):
+            return chunk
+        if self.isdir:
+            # Reads mostly go on from where the last one stopped, so the
+            # next chunk is likely in the same tree.
+            tree = self._tree
+            if (not tree or ofs < tree[1]
+                or (tree[2] is not None and ofs >= tree[2])):
+                tree = (_chunk_level(self.hash, self._repo_dir), 0, None)
+            (tree, i) = _find_chunk(tree, ofs, self._repo_dir)
+            self._tree = tree
+            ((offsets, isdirs, shas), start, end) = tree
+            start += offsets[i]
+            sha = shas[i*20 : i*20+20]
+        else:
+            (sha, start) = (self.hash, 0)
+        it = cp(self._repo_dir).get(sha.encode('hex'))
+        type = it.next()
+        assert(type == 'blob')
+        self._chunk = chunk = (sha, start, ''.join(it))
+        return chunk
+
     def read(self, count = -1):
-        if count < 0:
+        if count < 0 or count > self.size - self.ofs:
             count = self.size - self.ofs
-        if not self.reader or self.reader.ofs != self.ofs:
-            self.reader = _ChunkReader(self.hash, self.isdir, self.ofs,
-                                       self._repo_dir)
-        try:
-            buf = self.reader.next(count)
-        except:
-            self.reader = None
-            raise  # our offsets will be all screwed up otherwise
-        self.ofs += len(buf)
-        return buf
+        out = []
+        while count > 0:
+            (sha, start, content) = self._chunk_at(self.ofs)
+            pos = self.ofs - start
+            buf = content[pos : pos+count]
+            if not buf:
+                break  # the file is shorter than its size said
+            out.append(buf)
+            self.ofs += len(buf)
+            count -= len(buf)
+        debug2('read() returned %d\n' % sum(len(buf) for buf in out))
+        return ''.join(out)
 
     def close(self):
         pass
 
 
+def _release_node(key, node):
+    node.release()
+
+# The nodes whose children have been listed, sized by how many there are.
+# Those that haven't been used for a while are released, and will list
+# them again if they're needed.
+_dir_cache = LRUCache(DIR_CACHE_MAX, lambda node: len(node._subs) + 1,
+                      _release_node)
+
+
 class Node(object):
     """Base class for file representation."""
+    __slots__ = ('parent', 'name', 'mode', 'hash', 'ctime', 'mtime', 'atime',
+                 '_repo_dir', '_subs', '_metadata')
+
     def __init__(self, parent, name, mode, hash, repo_dir=None):
         self.parent = parent
-        self.name = name
+        self.name = intern(name)  # the same names come up in every save
         self.mode = mode
         self.hash = hash
         self.ctime = self.mtime = self.atime = 0
@@ -197,20 +223,37 @@ class Node(object):
     def _mksubs(self):
         self._subs = {}
 
+    def _mksub(self, name, entry):
+        """Make the node for name from the entry _mksubs() left for it."""
+        raise NotImplementedError
+
+    def _getsubs(self):
+        subs = self._subs
+        if subs == None:
+            self._mksubs()
+            subs = self._subs
+            _dir_cache.put(id(self), self)
+        else:
+            _dir_cache.get(id(self))
+        return subs
+
+    def _node(self, subs, name):
+        n = subs[name]
+        if isinstance(n, tuple):
+            n = subs[name] = self._mksub(name, n)
+        return n
+
     def subs(self):
         """Get a list of nodes that are contained in this node."""
-        if self._subs == None:
-            self._mksubs()
-        return sorted(self._subs.values())
+        subs = self._getsubs()
+        return [self._node(subs, name) for name in sorted(subs)]
 
     def sub(self, name):
         """Get node named 'name' that is contained in this node."""
-        if self._subs == None:
-            self._mksubs()
-        ret = self._subs.get(name)
-        if not ret:
+        subs = self._getsubs()
+        if name not in subs:
             raise NoSuchFile("no file %r in %r" % (name, self.name))
-        return ret
+        return self._node(subs, name)
 
     def top(self):
         """Return the very top node of the tree."""
@@ -294,14 +337,14 @@ class Node(object):
         """Open the current node. It is an error to open a non-file node."""
         raise NotFile('%s is not a regular file' % self.name)
 
-    def _populate_metadata(self, force=False):
-        # Only Dirs contain .bupm files, so by default, do nothing.
-        pass
+    def _sub_metadata(self, name):
+        # Only Dirs contain .bupm files, so by default, there's nothing.
+        return None
 
     def metadata(self):
         """Return this Node's Metadata() object, if any."""
         if not self._metadata and self.parent:
-            self.parent._populate_metadata(force=True)
+            self._metadata = self.parent._sub_metadata(self.name)
         return self._metadata
 
     def release(self):
@@ -312,6 +355,8 @@ class Node(object):
 
 class File(Node):
     """A normal file from bup's repository."""
+    __slots__ = ('bupmode', '_cached_size', '_filereader')
+
     def __init__(self, parent, name, mode, hash, bupmode, repo_dir=None):
         Node.__init__(self, parent, name, mode, hash, repo_dir)
         self.bupmode = bupmode
@@ -348,6 +393,8 @@ class File(Node):
 _symrefs = 0
 class Symlink(File):
     """A symbolic link from bup's repository."""
+    __slots__ = ()
+
     def __init__(self, parent, name, hash, bupmode, repo_dir=None):
         File.__init__(self, parent, name, 0120000, hash, bupmode,
                       repo_dir = repo_dir)
@@ -388,6 +435,8 @@ class Symlink(File):
 
 class FakeSymlink(Symlink):
     """A symlink that is not stored in the bup repository."""
+    __slots__ = ('toname',)
+
     def __init__(self, parent, name, toname, repo_dir=None):
         Symlink.__init__(self, parent, name, EMPTY_SHA, git.BUP_NORMAL,
                          repo_dir = repo_dir)
@@ -398,37 +447,73 @@ class FakeSymlink(Symlink):
         return self.toname
 
 
+def _bupm_index_size(index):
+    (content, offsets, names) = index
+    return len(content) + len(offsets) * 8 + sum(len(n) for n in names)
+
+# The .bupm of each Dir, by tree sha: its content, where each record
+# starts, and the (sorted) names of the entries that have one.
+_bupm_indexes = LRUCache(BUPM_INDEX_MAX, _bupm_index_size)
+
+
 class Dir(Node):
     """A directory stored inside of bup's repository."""
+    __slots__ = ('_bupm',)
 
     def __init__(self, *args, **kwargs):
         Node.__init__(self, *args, **kwargs)
         self._bupm = None
 
-    def _populate_metadata(self, force=False):
-        if self._metadata and not force:
-            return
-        if not self._subs:
-            self._mksubs()
-        if not self._bupm:
-            return
-        meta_stream = self._bupm.open()
-        dir_meta = metadata.Metadata.read(meta_stream)
-        for sub in self:
-            if not stat.S_ISDIR(sub.mode):
-                sub._metadata = metadata.Metadata.read(meta_stream)
-        self._metadata = dir_meta
+    def _bupm_index(self):
+        index = _bupm_indexes.get(self.hash)
+        if index is None:
+            bupm = self.metadata_file()
+            if not bupm:
+                return None
+            content = bupm.open().read()
+            # The first record is the directory's own, then there's one
+            # for each entry that isn't a directory, in name order.
+            # Only find where each starts; they're decoded when needed.
+            port = StringIO(content)
+            offsets = []
+            while port.tell() < len(content):
+                offsets.append(port.tell())
+                metadata.Metadata.skip(port)
+            names = sorted(name for (name, n) in self._getsubs().iteritems()
+                           if not stat.S_ISDIR(isinstance(n, tuple)
+                                               and n[0] or n.mode))
+            index = (content, offsets, names)
+            _bupm_indexes.put(self.hash, index)
+        return index
+
+    def _read_metadata(self, i):
+        """Decode record i of the .bupm, if there is one."""
+        index = self._bupm_index()
+        if not index:
+            return None
+        (content, offsets, names) = index
+        if i >= len(offsets):
+            return None
+        port = StringIO(content)
+        port.seek(offsets[i])
+        return metadata.Metadata.read(port)
+
+    def _sub_metadata(self, name):
+        index = self._bupm_index()
+        if not index:
+            return None
+        names = index[2]
+        i = bisect.bisect_left(names, name)
+        if i == len(names) or names[i] != name:
+            return None
+        return self._read_metadata(i + 1)
 
     def _mksubs(self):
+        # The nodes are only made when they're asked for; until then, each
+        # name just has its entry.
         self._subs = {}
-        it = cp(self._repo_dir).get(self.hash.encode('hex'))
-        type = it.next()
-        if type == 'commit':
-            del it
-            it = cp(self._repo_dir).get(self.hash.encode('hex') + ':')
-            type = it.next()
-        assert(type == 'tree')
-        for (mode,mangled_name,sha) in git.tree_decode(''.join(it)):
+        for (mode,mangled_name,sha) in git.read_tree(self.hash,
+                                                     self._repo_dir):
             if mangled_name == '.bupm':
                 bupmode = stat.S_ISDIR(mode) and BUP_CHUNKED or BUP_NORMAL
                 self._bupm = File(self, mangled_name, GIT_MODE_FILE, sha,
@@ -437,24 +522,26 @@ class Dir(Node):
             (name,bupmode) = git.demangle_name(mangled_name)
             if bupmode == git.BUP_CHUNKED:
                 mode = GIT_MODE_FILE
-            if stat.S_ISDIR(mode):
-                self._subs[name] = Dir(self, name, mode, sha, self._repo_dir)
-            elif stat.S_ISLNK(mode):
-                self._subs[name] = Symlink(self, name, sha, bupmode,
-                                           self._repo_dir)
-            else:
-                self._subs[name] = File(self, name, mode, sha, bupmode,
-                                        self._repo_dir)
+            self._subs[name] = (mode, sha, bupmode)
+
+    def _mksub(self, name, entry):
+        (mode, sha, bupmode) = entry
+        if stat.S_ISDIR(mode):
+            return Dir(self, name, mode, sha, self._repo_dir)
+        elif stat.S_ISLNK(mode):
+            return Symlink(self, name, sha, bupmode, self._repo_dir)
+        else:
+            return File(self, name, mode, sha, bupmode, self._repo_dir)
 
     def metadata(self):
         """Return this Dir's Metadata() object, if any."""
-        self._populate_metadata()
+        if not self._metadata:
+            self._metadata = self._read_metadata(0)
         return self._metadata
 
     def metadata_file(self):
         """Return this Dir's .bupm File, if any."""
-        if not self._subs:
-            self._mksubs()
+        self._getsubs()
         return self._bupm
 
     def release(self):
@@ -463,6 +550,13 @@ class Dir(Node):
         super(Dir, self).release()
 
 
+def _commit_date(sha, repo_dir):
+    c = commitgraph.graph(repo_dir).get(sha)
+    if c:
+        return c.date
+    return git.get_commit_dates([sha.encode('hex')], repo_dir=repo_dir)[0]
+
+
 class CommitDir(Node):
     """A directory that contains all commits that are reachable by a ref.
 
@@ -473,63 +567,65 @@ class CommitDir(Node):
     separation helps us avoid having too much directories on the same level as
     the number of commits grows big.
     """
+    __slots__ = ()
+
     def __init__(self, parent, name, repo_dir=None):
         Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
 
     def _mksubs(self):
         self._subs = {}
-        refs = git.list_refs(repo_dir = self._repo_dir)
-        for ref in refs:
-            #debug2('ref name: %s\n' % ref[0])
-            revs = git.rev_list(ref[1].encode('hex'), repo_dir = self._repo_dir)
-            for (date, commit) in revs:
-                #debug2('commit: %s  date: %s\n' % (commit.encode('hex'), date))
-                commithex = commit.encode('hex')
-                containername = commithex[:2]
-                dirname = commithex[2:]
-                n1 = self._subs.get(containername)
-                if not n1:
-                    n1 = CommitList(self, containername, self._repo_dir)
-                    self._subs[containername] = n1
-
-                if n1.commits.get(dirname):
-                    # Stop work for this ref, the rest should already be present
-                    break
-
-                n1.commits[dirname] = (commit, date)
+        tips = [sha for (name, sha) in git.list_refs(repo_dir=self._repo_dir)]
+        g = commitgraph.graph(self._repo_dir)
+        g.update(tips)
+        for (date, commit) in g.history(tips):
+            commithex = commit.encode('hex')
+            containername = commithex[:2]
+            dirname = commithex[2:]
+            n1 = self._subs.get(containername)
+            if not n1:
+                n1 = CommitList(self, containername, self._repo_dir)
+                self._subs[containername] = n1
+            n1.commits[dirname] = (commit, date)
 
 
 class CommitList(Node):
     """A list of commits with hashes that start with the current node's name."""
+    __slots__ = ('commits',)
+
     def __init__(self, parent, name, repo_dir=None):
         Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
         self.commits = {}
 
     def _mksubs(self):
-        self._subs = {}
-        for (name, (hash, date)) in self.commits.items():
-            n1 = Dir(self, name, GIT_MODE_TREE, hash, self._repo_dir)
-            n1.ctime = n1.mtime = date
-            self._subs[name] = n1
+        self._subs = dict(self.commits)
+
+    def _mksub(self, name, entry):
+        (hash, date) = entry
+        n1 = Dir(self, name, GIT_MODE_TREE, hash, self._repo_dir)
+        n1.ctime = n1.mtime = date
+        return n1
 
 
 class TagDir(Node):
     """A directory that contains all tags in the repository."""
+    __slots__ = ()
+
     def __init__(self, parent, name, repo_dir = None):
         Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
 
     def _mksubs(self):
         self._subs = {}
-        for (name, sha) in git.list_refs(repo_dir = self._repo_dir):
-            if name.startswith('refs/tags/'):
-                name = name[10:]
-                date = git.get_commit_dates([sha.encode('hex')],
-                                            repo_dir=self._repo_dir)[0]
-                commithex = sha.encode('hex')
-                target = '../.commit/%s/%s' % (commithex[:2], commithex[2:])
-                tag1 = FakeSymlink(self, name, target, repo_dir, self._repo_dir)
-                tag1.ctime = tag1.mtime = date
-                self._subs[name] = tag1
+        tags = [(name[10:], sha) for (name, sha)
+                in git.list_refs(repo_dir=self._repo_dir)
+                if name.startswith('refs/tags/')]
+        commitgraph.graph(self._repo_dir).update([sha for (name, sha) in tags])
+        for (name, sha) in tags:
+            date = _commit_date(sha, self._repo_dir)
+            commithex = sha.encode('hex')
+            target = '../.commit/%s/%s' % (commithex[:2], commithex[2:])
+            tag1 = FakeSymlink(self, name, target, repo_dir, self._repo_dir)
+            tag1.ctime = tag1.mtime = date
+            self._subs[name] = tag1
 
 
 class BranchList(Node):
@@ -538,6 +634,8 @@ class BranchList(Node):
     Represents each commit as a symlink that points to the commit directory in
     /.commit/??/ . The symlink is named after the commit date.
     """
+    __slots__ = ()
+
     def __init__(self, parent, name, hash, repo_dir=None):
         Node.__init__(self, parent, name, GIT_MODE_TREE, hash, repo_dir)
 
@@ -546,8 +644,9 @@ class BranchList(Node):
 
         tags = git.tags(repo_dir = self._repo_dir)
 
-        revs = list(git.rev_list(self.hash.encode('hex'),
-                                 repo_dir=self._repo_dir))
+        g = commitgraph.graph(self._repo_dir)
+        g.update([self.hash])
+        revs = list(g.history([self.hash]))
         latest = revs[0]
         for (date, commit) in revs:
             l = time.localtime(date)
@@ -579,9 +678,70 @@ class RefList(Node):
 
     Also, a special sub-node named '.commit' contains all commit directories
     that are reachable via a ref (e.g. a branch).  See CommitDir for details.
+
+    The paths that are resolved from here are remembered, whether they were
+    found or not, until the refs change.
     """
+    __slots__ = ('_paths', '_refs_dirs', '_packed_refs', '_refs_stamp')
+
     def __init__(self, parent, repo_dir=None):
         Node.__init__(self, parent, '/', GIT_MODE_TREE, EMPTY_SHA, repo_dir)
+        self._paths = LRUCache(PATH_CACHE_MAX, lambda n: 1)
+        self._refs_dirs = [git.repo(name, repo_dir)
+                           for name in ('refs/heads', 'refs/tags')]
+        self._packed_refs = git.repo('packed-refs', repo_dir)
+        self._refs_stamp = None
+
+    def _check_refs(self):
+        # git updates a ref (or packed-refs) by renaming a new file over
+        # it, so the inode changes even when the mtime doesn't.  The refs
+        # can be nested in directories of any depth.
+        def file_id(name):
+            try:
+                st = os.stat(name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+            return (st.st_ino, st.st_mtime)
+        stamp = [file_id(self._packed_refs)]
+        for top in self._refs_dirs:
+            for (dirpath, dirnames, filenames) in os.walk(top):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    stamp.append((path, file_id(path)))
+        if stamp != self._refs_stamp:
+            if self._refs_stamp is not None:
+                self._paths.clear()
+                self.release()
+            self._refs_stamp = stamp
+
+    def _lresolve(self, parts):
+        self._check_refs()
+        key = tuple(parts)
+        # Start from the longest part of the path that's known.
+        i = len(key)
+        while i > 0:
+            n = self._paths.get(key[:i])
+            if n is not None:
+                break
+            i -= 1
+        else:
+            n = self
+        if isinstance(n, NoSuchFile):
+            raise n
+        try:
+            for j in xrange(i, len(key)):
+                if n is self:
+                    n = Node._lresolve(self, key[j:j+1])
+                else:
+                    n = n._lresolve(key[j:j+1])
+                self._paths.put(key[:j+1], n)
+        except NoSuchFile, e:
+            self._paths.put(key, e)
+            raise
+        return n
 
     def _mksubs(self):
         self._subs = {}
@@ -595,10 +755,10 @@ class RefList(Node):
         refs_info = [(name[11:], sha) for (name,sha)
                      in git.list_refs(repo_dir=self._repo_dir)
                      if name.startswith('refs/heads/')]
-        dates = git.get_commit_dates([sha.encode('hex')
-                                      for (name, sha) in refs_info],
-                                     repo_dir=self._repo_dir)
-        for (name, sha), date in zip(refs_info, dates):
+        commitgraph.graph(self._repo_dir).update([sha for (name, sha)
+                                                  in refs_info])
+        for (name, sha) in refs_info:
+            date = _commit_date(sha, self._repo_dir)
             n1 = BranchList(self, name, sha, self._repo_dir)
             n1.ctime = n1.mtime = date
             self._subs[name] = n1
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import sys, glob, tempfile
+from bup import options, git, bloom
+from bup.helpers import *
+
+optspec = """
+bup bloom [options...]
+--
+ruin       ruin the specified bloom file (clearing the bitfield)
+f,force    ignore existing bloom file and regenerate it from scratch
+o,output=  output bloom filename (default: auto)
+d,dir=     input directory to look for idx files (default: auto)
+k,hashes=  number of hash functions to use (4 or 5) (default: auto)
+format=    2, or 3 for a blocked filter (default: the existing one's, or 2)
+c,check=   check the given .idx file against the bloom filter
+"""
+
+
+def ruin_bloom(bloomfilename):
+    rbloomfilename = git.repo_rel(bloomfilename)
+    if not os.path.exists(bloomfilename):
+        log("%s\n" % bloomfilename)
+        add_error("bloom: %s not found to ruin\n" % rbloomfilename)
+        return
+    b = bloom.ShaBloom(bloomfilename, readwrite=True, expected=1)
+    b.map[b.headerlen:b.headerlen+2**b.bits] = '\0' * 2**b.bits
+
+
+def check_bloom(path, bloomfilename, idx):
+    rbloomfilename = git.repo_rel(bloomfilename)
+    ridx = git.repo_rel(idx)
+    if not os.path.exists(bloomfilename):
+        log("bloom: %s: does not exist.\n" % rbloomfilename)
+        return
+    b = bloom.ShaBloom(bloomfilename)
+    if not b.valid():
+        add_error("bloom: %r is invalid.\n" % rbloomfilename)
+        return
+    base = os.path.basename(idx)
+    if base not in b.idxnames:
+        log("bloom: %s does not contain the idx.\n" % rbloomfilename)
+        return
+    if base == idx:
+        idx = os.path.join(path, idx)
+    log("bloom: bloom file: %s\n" % rbloomfilename)
+    log("bloom:   checking %s\n" % ridx)
+    for objsha in git.open_idx(idx):
+        if not b.exists(objsha):
+            add_error("bloom: ERROR: object %s missing" 
+                      % str(objsha).encode('hex'))
+
+
+_first = None
+def do_bloom(path, outfilename):
+    global _first
+    b = None
+    if os.path.exists(outfilename):
+        b = bloom.ShaBloom(outfilename)
+        if not b.valid():
+            debug1("bloom: Existing invalid bloom found, regenerating.\n")
+            b = None
+    # Even when it's regenerated, keep the kind of filter there was.
+    version = opt.format or (b and b.version) or 2
+    if version == bloom.BLOCKED_VERSION:
+        if opt.k and not 1 <= opt.k <= bloom.BLOCKED_MAX_K:
+            o.fatal('k must be between 1 and %d for a blocked filter'
+                    % bloom.BLOCKED_MAX_K)
+    elif opt.k and opt.k not in (4,5):
+        o.fatal('only k values of 4 and 5 are supported')
+    if b and opt.force:
+        b = None
+    elif b and b.version != version:
+        debug1("bloom: regenerating: version %d != %d.\n"
+               % (b.version, version))
+        b = None
+
+    add = []
+    rest = []
+    add_count = 0
+    rest_count = 0
+    for i,name in enumerate(glob.glob('%s/*.idx' % path)):
+        progress('bloom: counting: %d\r' % i)
+        ix = git.open_idx(name)
+        ixbase = os.path.basename(name)
+        if b and (ixbase in b.idxnames):
+            rest.append(name)
+            rest_count += len(ix)
+        else:
+            add.append(name)
+            add_count += len(ix)
+    total = add_count + rest_count
+
+    if not add:
+        debug1("bloom: nothing to do.\n")
+        return
+
+    if b:
+        if len(b) != rest_count:
+            debug1("bloom: size %d != idx total %d, regenerating\n"
+                   % (len(b), rest_count))
+            b = None
+        elif (b.bits < bloom.MAX_BLOOM_BITS and
+              b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
+            debug1("bloom: regenerating: adding %d entries gives "
+                   "%.2f%% false positives.\n"
+                   % (add_count, b.pfalse_positive(add_count)))
+            b = None
+        else:
+            b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
+            # A save may have added some of them in place meanwhile.
+            add = [name for name in add
+                   if os.path.basename(name) not in b.idxnames]
+    if not b: # Need all idxs to build from scratch
+        add += rest
+        add_count += rest_count
+    del rest
+    del rest_count
+
+    msg = b is None and 'creating from' or 'adding'
+    if not _first: _first = path
+    dirprefix = (_first != path) and git.repo_rel(path)+': ' or ''
+    progress('bloom: %s%s %d file%s (%d object%s).\n'
+        % (dirprefix, msg,
+           len(add), len(add)!=1 and 's' or '',
+           add_count, add_count!=1 and 's' or ''))
+
+    tfname = None
+    if b is None:
+        # A bup bloom started in the background by a save may be
+        # regenerating it too, so don't share the temporary file.
+        tfname = os.path.join(path, 'bup.tmp.%d.bloom' % os.getpid())
+        b = bloom.create(tfname, expected=add_count, k=opt.k, version=version)
+    count = 0
+    icount = 0
+    for name in add:
+        ix = git.open_idx(name)
+        qprogress('bloom: writing %.2f%% (%d/%d objects)\r' 
+                  % (icount*100.0/add_count, icount, add_count))
+        b.add_idx(ix)
+        count += 1
+        icount += len(ix)
+
+    if not tfname:
+        b.close()
+        return
+
+    # Saves add their packs to the old filter in place (see
+    # git.add_to_bloom()).  Hold its lock while the packs that were
+    # written meanwhile are added to the new one too, and it's renamed
+    # over the old one; writers that were waiting then find the new one.
+    old = os.path.exists(outfilename) and bloom.lock(outfilename)
+    try:
+        have = set(b.idxnames)
+        for name in glob.glob('%s/*.idx' % path):
+            if os.path.basename(name) not in have:
+                debug1('bloom: adding %s, written meanwhile\n'
+                       % os.path.basename(name))
+                b.add_idx(git.open_idx(name))
+        # Currently, there's an open file object for tfname inside b.
+        # Make sure it's closed before rename.
+        b.close()
+        os.rename(tfname, outfilename)
+    finally:
+        if old:
+            old.close()
+
+
+handle_ctrl_c()
+
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal('no positional parameters expected')
+
+git.check_repo_or_die()
+
+if opt.format and opt.format not in (2, bloom.BLOCKED_VERSION):
+    o.fatal('only formats 2 and 3 are supported')
+
+paths = opt.dir and [opt.dir] or git.all_packdirs()
+for path in paths:
+    debug1('bloom: scanning %s\n' % path)
+    outfilename = opt.output or os.path.join(path, 'bup.bloom')
+    if opt.check:
+        check_bloom(path, outfilename, opt.check)
+    elif opt.ruin:
+        ruin_bloom(outfilename)
+    else:
+        do_bloom(path, outfilename)
+
+if saved_errors:
+    log('WARNING: %d errors encountered during bloom.\n' % len(saved_errors))
+    sys.exit(1)
+elif opt.check:
+    log('All tests passed.\n')
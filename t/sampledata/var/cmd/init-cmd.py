@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import sys, os, glob
+
+from bup import git, options, client, hashsplit
+from bup.helpers import *
+
+
+optspec = """
+[BUP_DIR=...] bup init [-r host:path] [--chunker=name] [--blob-bits=n]
+--
+r,remote=  remote repository path
+chunker=   how to split files into blobs (bupsplit or fastcdc)
+blob-bits= make blobs 2^n bytes long on average
+max-blob=  never make blobs bigger than this
+fanout=    average number of blobs in a single tree
+tree-max=  maximum number of entries in a single tree
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal("no arguments expected")
+
+settings = {}
+for option, value in (('bup.split.chunker', opt.chunker),
+                      ('bup.split.blobbits', opt.blob_bits),
+                      ('bup.split.maxblob', opt.max_blob),
+                      ('bup.split.fanout', opt.fanout),
+                      ('bup.split.treemax', opt.tree_max)):
+    if value is not None:
+        settings[option] = str(value)
+if settings and opt.remote:
+    o.fatal("the chunking options only apply to a local repository")
+
+git.guess_repo()
+have_repo = os.path.exists(git.repo('config'))
+
+def current_get(option):
+    return have_repo and git.git_config_get(option) or None
+
+def configured_get(option):
+    # The repository's configuration, with our settings applied.
+    return settings.get(option) or current_get(option)
+
+if settings:
+    try:
+        hashsplit.configure(current_get)
+        old_params = hashsplit.params()
+    except ValueError:
+        old_params = None  # nothing can be saved with it anyway
+    try:
+        hashsplit.configure(configured_get)
+    except ValueError, e:
+        o.fatal(str(e))
+    if (have_repo and old_params and old_params != hashsplit.params()
+        and glob.glob(git.repo('objects/pack/*.pack'))):
+        log('error: %r already has data; new saves with different'
+            ' chunking wouldn\'t deduplicate against it\n' % git.repo())
+        sys.exit(1)
+
+try:
+    git.init_repo()  # local repo
+    for option, value in sorted(settings.items()):
+        git.git_config_set(option, value)
+except git.GitError, e:
+    log("bup: error: could not init repository: %s" % e)
+    sys.exit(1)
+
+if opt.remote:
+    git.check_repo_or_die()
+    cli = client.Client(opt.remote, create=True)
+    cli.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import sys, re, struct, time, resource, glob, tempfile, shutil
+from bup import git, bloom, midx, options, _helpers
+from bup.helpers import *
+
+handle_ctrl_c()
+
+_linux_warned = 0
+def linux_memstat():
+    global _linux_warned
+    #fields = ['VmSize', 'VmRSS', 'VmData', 'VmStk', 'ms']
+    d = {}
+    try:
+        f = open('/proc/self/status')
+    except IOError, e:
+        if not _linux_warned:
+            log('Warning: %s\n' % e)
+            _linux_warned = 1
+        return {}
+    for line in f:
+        # Note that on Solaris, this file exists but is binary.  If that
+        # happens, this split() might not return two elements.  We don't
+        # really need to care about the binary format since this output
+        # isn't used for much and report() can deal with missing entries.
+        t = re.split(r':\s*', line.strip(), 1)
+        if len(t) == 2:
+            k,v = t
+            d[k] = v
+    return d
+
+
+last = last_u = last_s = start = 0
+def report(count):
+    global last, last_u, last_s, start
+    headers = ['RSS', 'MajFlt', 'user', 'sys', 'ms']
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    now = time.time()
+    rss = int(ru.ru_maxrss/1024)
+    if not rss:
+        rss = linux_memstat().get('VmRSS', '??')
+    fields = [rss,
+              ru.ru_majflt,
+              int((ru.ru_utime - last_u) * 1000),
+              int((ru.ru_stime - last_s) * 1000),
+              int((now - last) * 1000)]
+    fmt = '%9s  ' + ('%10s ' * len(fields))
+    if count >= 0:
+        print fmt % tuple([count] + fields)
+    else:
+        start = now
+        print fmt % tuple([''] + headers)
+    sys.stdout.flush()
+    
+    # don't include time to run report() in usage counts
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    last_u = ru.ru_utime
+    last_s = ru.ru_stime
+    last = time.time()
+
+
+def compare_blooms():
+    # Build each kind of bloom filter from the repository's idxs, then see
+    # how many random (so almost certainly missing) objects they let
+    # through, and how long it takes to ask them.
+    names = glob.glob(git.repo('objects/pack/*.idx'))
+    count = sum(len(git.open_idx(name)) for name in names)
+    if not count:
+        o.fatal('no objects in the repository')
+    tmpdir = tempfile.mkdtemp(prefix='bup-memtest-')
+    try:
+        for version in (2, bloom.BLOCKED_VERSION):
+            b = bloom.create(os.path.join(tmpdir, 'v%d.bloom' % version),
+                             expected=count, version=version)
+            for name in names:
+                b.add_idx(git.open_idx(name))
+            expected = b.pfalse_positive()
+            b.close()
+            b = bloom.ShaBloom(b.name)
+            positives = 0
+            secs = 0
+            for c in xrange(opt.cycles):
+                shas = [_helpers.random_sha() for n in xrange(opt.number)]
+                start = time.time()
+                for sha in shas:
+                    if b.exists(sha):
+                        positives += 1
+                secs += time.time() - start
+            lookups = opt.cycles * opt.number
+            print ('bloom v%d, k=%d, 2^%d bytes: %.4f%% false positives'
+                   ' (%.4f%% expected), %.3f us/lookup'
+                   % (version, b.k, b.bits, positives * 100.0 / lookups,
+                      expected, secs * 1e6 / lookups))
+            b.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+optspec = """
+bup memtest [-n elements] [-c cycles]
+--
+n,number=  number of objects per cycle [10000]
+c,cycles=  number of cycles to run [100]
+ignore-midx  ignore .midx files, use only .idx files
+existing   test with existing objects instead of fake ones
+bloom      compare the false positives and speed of each bloom filter format
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal('no arguments expected')
+
+git.ignore_midx = opt.ignore_midx
+
+git.check_repo_or_die()
+
+if opt.bloom:
+    compare_blooms()
+    sys.exit(0)
+
+m = git.PackIdxList(git.repo('objects/pack'))
+
+report(-1)
+_helpers.random_sha()
+report(0)
+
+if opt.existing:
+    def foreverit(mi):
+        while 1:
+            for e in mi:
+                yield e
+    objit = iter(foreverit(m))
+    
+for c in xrange(opt.cycles):
+    for n in xrange(opt.number):
+        if opt.existing:
+            bin = objit.next()
+            assert(m.exists(bin))
+        else:
+            bin = _helpers.random_sha()
+
+            # technically, a randomly generated object id might exist.
+            # but the likelihood of that is the likelihood of finding
+            # a collision in sha-1 by accident, which is so unlikely that
+            # we don't care.
+            assert(not m.exists(bin))
+    report((c+1)*opt.number)
+
+if bloom._total_searches:
+    print ('bloom: %d objects searched in %d steps: avg %.3f steps/object' 
+           % (bloom._total_searches, bloom._total_steps,
+              bloom._total_steps*1.0/bloom._total_searches))
+if midx._total_searches:
+    print ('midx: %d objects searched in %d steps: avg %.3f steps/object' 
+           % (midx._total_searches, midx._total_steps,
+              midx._total_steps*1.0/midx._total_searches))
+if git._total_searches:
+    print ('idx: %d objects searched in %d steps: avg %.3f steps/object' 
+           % (git._total_searches, git._total_steps,
+              git._total_steps*1.0/git._total_searches))
+print 'Total time: %.3fs' % (time.time() - start)
@@ -0,0 +1,4 @@
+
+COMMIT='14b385c71afe7d42018676b50adcf1709e922ecf'
+NAMES='(tag: bup-14b385c)'
+DATE='2026-10-18 19:38:43 +0000'
@@ -0,0 +1,228 @@
+"""A cache of the commit history of a bup repository.
+
+Listing the commits of a branch used to mean running 'git rev-list' each
+time, which gets slower as the history grows.  Instead, the tree, date and
+parents of every commit that's reachable from a ref are kept in the
+repository's commitgraph file, and only the commits that are new since the
+last time are read from the repository.
+
+The file is a header followed by one record per commit, each written after
+the records of all of the commit's parents.  So every commit in the file
+has its whole history there too, a ref whose tip is in it needs nothing
+more, and a file that was cut short is still good up to its last whole
+record.  New commits are appended, with the file locked.
+"""
+import os, errno, struct, fcntl, heapq
+from collections import namedtuple
+from bup import git
+from bup.helpers import *
+
+GRAPH_MAGIC = 'BCGR'
+GRAPH_VERSION = 1
+_HEADER = struct.Struct('!4sI')
+_RECORD = struct.Struct('!20s20sqH')  # commit, tree, date, parent count
+
+Commit = namedtuple('Commit', ['tree', 'date', 'parents'])
+
+
+class CommitGraph:
+    """The commits of a repository that are known so far, by sha.  Each
+    is a Commit: its tree, its (author) date and its parents, all as
+    binary shas."""
+    def __init__(self, repo_dir=None):
+        self.repo_dir = repo_dir
+        self.name = git.repo('commitgraph', repo_dir=repo_dir)
+        self.commits = {}
+        self._loaded = 0  # how much of the file has been read
+
+    def __len__(self):
+        return len(self.commits)
+
+    def __contains__(self, commit):
+        return commit in self.commits
+
+    def get(self, commit):
+        """Return the Commit for commit, or None if it isn't known."""
+        return self.commits.get(commit)
+
+    def _read(self, f):
+        """Read the records that are in f after the ones already read, and
+        return how much of f is good and the commits that were read."""
+        read = set()
+        if not self._loaded:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return (0, read)
+            if _HEADER.unpack(header) != (GRAPH_MAGIC, GRAPH_VERSION):
+                log('warning: %s: unknown format; rebuilding it.\n'
+                    % self.name)
+                return (0, read)
+            self._loaded = _HEADER.size
+        f.seek(self._loaded)
+        buf = f.read()
+        ofs = 0
+        while ofs + _RECORD.size <= len(buf):
+            (commit, tree, date, n) = _RECORD.unpack_from(buf, ofs)
+            end = ofs + _RECORD.size + n*20
+            if end > len(buf):
+                break
+            parents = tuple(buf[i:i+20]
+                            for i in xrange(ofs + _RECORD.size, end, 20))
+            self.commits[commit] = Commit(tree, date, parents)
+            read.add(commit)
+            ofs = end
+        self._loaded += ofs
+        return (self._loaded, read)
+
+    def refresh(self):
+        """Pick up whatever other processes have added to the file."""
+        try:
+            f = open(self.name, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            self._read(f)
+        finally:
+            f.close()
+
+    def _parse(self, commit):
+        it = git.cp(self.repo_dir).get(commit.encode('hex'))
+        type = it.next()
+        content = ''.join(it)
+        if type != 'commit':
+            return None
+        (tree, date, parents) = (None, None, [])
+        for line in content.split('\n'):
+            if not line:
+                break  # the end of the headers
+            if line.startswith('tree '):
+                tree = line[5:].decode('hex')
+            elif line.startswith('parent '):
+                parents.append(line[7:].decode('hex'))
+            elif line.startswith('author '):
+                date = int(line.rsplit(' ', 2)[1])
+        if tree is None or date is None:
+            raise git.GitError('cannot parse commit %s' % commit.encode('hex'))
+        return Commit(tree, date, tuple(parents))
+
+    def update(self, tips):
+        """Make sure the history of each of the commits in tips is known,
+        adding any that isn't to the file.  Tips that aren't commits are
+        ignored."""
+        self.refresh()
+        new = []  # (commit, Commit), each after its parents
+        read = {}
+        for tip in tips:
+            stack = [tip]
+            while stack:
+                commit = stack[-1]
+                if commit in self.commits:
+                    stack.pop()
+                    continue
+                c = read.get(commit)
+                if c is None:
+                    c = read[commit] = self._parse(commit)
+                    if c is None:
+                        stack.pop()
+                        continue
+                    missing = [p for p in c.parents if p not in self.commits]
+                    if missing:
+                        stack.extend(missing)
+                        continue
+                stack.pop()
+                self.commits[commit] = c
+                new.append((commit, c))
+        if new:
+            self._append(new)
+
+    def _ordered(self):
+        """Return all the known commits as (commit, Commit), each after
+        its parents."""
+        out = []
+        done = set()
+        for sha in self.commits:
+            stack = [sha]
+            while stack:
+                commit = stack[-1]
+                if commit in done:
+                    stack.pop()
+                    continue
+                todo = [p for p in self.commits[commit].parents
+                        if p not in done]
+                if todo:
+                    stack.extend(todo)
+                else:
+                    stack.pop()
+                    done.add(commit)
+                    out.append((commit, self.commits[commit]))
+        return out
+
+    def _append(self, new):
+        try:
+            fd = os.open(self.name, os.O_RDWR|os.O_CREAT, 0666)
+        except OSError, e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            return  # a read-only repository; just keep them in memory
+        f = os.fdopen(fd, 'r+b')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Pick up whatever another process appended since refresh(),
+            # so that it's not written twice, and drop a record that was
+            # cut short.
+            (good, read) = self._read(f)
+            f.seek(good)
+            f.truncate()
+            if not good:
+                f.write(_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION))
+                new = self._ordered()
+            elif read:
+                new = [(commit, c) for (commit, c) in new
+                       if commit not in read]
+            f.write(''.join(_RECORD.pack(commit, c.tree, c.date,
+                                         len(c.parents)) + ''.join(c.parents)
+                            for (commit, c) in new))
+            f.flush()
+            self._loaded = f.tell()
+        finally:
+            f.close()  # which unlocks it
+
+    def history(self, tips):
+        """Generate (date, commit) for every commit that's reachable from
+        any of tips (which must have been update()d), once each: each tip
+        first, and then newest first."""
+        seen = set()
+        heap = []
+        for tip in tips:
+            if tip in self.commits and tip not in seen:
+                seen.add(tip)
+                yield (self.commits[tip].date, tip)
+                heap.append(tip)
+        heap = [(-self.commits[p].date, p) for c in heap
+                for p in self.commits[c].parents]
+        heapq.heapify(heap)
+        while heap:
+            (negdate, commit) = heapq.heappop(heap)
+            if commit in seen:
+                continue
+            seen.add(commit)
+            c = self.commits[commit]
+            yield (c.date, commit)
+            for p in c.parents:
+                if p not in seen:
+                    heapq.heappush(heap, (-self.commits[p].date, p))
+
+
+_graphs = {}
+
+def graph(repo_dir=None):
+    """Create a CommitGraph object or reuse the already existing one."""
+    if not repo_dir:
+        repo_dir = git.repo()
+    repo_dir = os.path.abspath(repo_dir)
+    g = _graphs.get(repo_dir)
+    if not g:
+        g = _graphs[repo_dir] = CommitGraph(repo_dir)
+    return g
@@ -0,0 +1,1863 @@
+"""Git interaction library.
+bup repositories are in Git format. This library allows us to
+interact with the Git data structures.
+"""
+import os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
+import threading, Queue
+from array import array
+from collections import namedtuple, deque
+
+from bup.helpers import *
+from bup import _helpers, path, midx, bloom, xstat
+
+max_pack_size = 1000*1000*1000  # larger packs will slow down pruning
+max_pack_objects = 200*1000  # cache memory usage is about 83 bytes per object
+
+verbose = 0
+ignore_midx = 0
+repodir = None
+
+_typemap =  { 'blob':3, 'tree':2, 'commit':1, 'tag':4 }
+_typermap = { 3:'blob', 2:'tree', 1:'commit', 4:'tag' }
+
+_total_searches = 0
+_total_steps = 0
+
+# PackIdxList remembers which packs the last RECENT_MAX to 2*RECENT_MAX
+# objects it found were in.  Once MERGE_AFTER lookups have had to ask more
+# than MERGE_MIN_IDXS indexes, it merges its idxs into a temporary midx,
+# unless they hold more than MERGE_MAX_OBJECTS (24 bytes each in $TMPDIR).
+RECENT_MAX = 4096
+MERGE_MIN_IDXS = 32
+MERGE_AFTER = 256
+MERGE_MAX_OBJECTS = 4*1024*1024
+BASE_CACHE_MAX = 16*1024*1024  # bytes of delta bases kept by PackReader
+TREE_CACHE_MAX = 16*1024*1024  # bytes of decoded trees kept by read_tree()
+
+
+class GitError(Exception):
+    pass
+
+
+def parse_tz_offset(s):
+    """UTC offset in seconds."""
+    tz_off = (int(s[1:3]) * 60 * 60) + (int(s[3:5]) * 60)
+    if s[0] == '-':
+        return - tz_off
+    return tz_off
+
+
+# FIXME: derived from http://git.rsbx.net/Documents/Git_Data_Formats.txt
+# Make sure that's authoritative.
+_start_end_char = r'[^ .,:;<>"\'\0\n]'
+_content_char = r'[^\0\n<>]'
+_safe_str_rx = '(?:%s{1,2}|(?:%s%s*%s))' \
+    % (_start_end_char,
+       _start_end_char, _content_char, _start_end_char)
+_tz_rx = r'[-+]\d\d[0-5]\d'
+_parent_rx = r'(?:parent [abcdefABCDEF0123456789]{40}\n)'
+_commit_rx = re.compile(r'''tree (?P<tree>[abcdefABCDEF0123456789]{40})
+(?P<parents>%s*)author (?P<author_name>%s) <(?P<author_mail>%s)> (?P<asec>\d+) (?P<atz>%s)
+committer (?P<committer_name>%s) <(?P<committer_mail>%s)> (?P<csec>\d+) (?P<ctz>%s)
+
+(?P<message>(?:.|\n)*)''' % (_parent_rx,
+                             _safe_str_rx, _safe_str_rx, _tz_rx,
+                             _safe_str_rx, _safe_str_rx, _tz_rx))
+_parent_hash_rx = re.compile(r'\s*parent ([abcdefABCDEF0123456789]{40})\s*')
+
+
+# Note that the author_sec and committer_sec values are (UTC) epoch seconds.
+CommitInfo = namedtuple('CommitInfo', ['tree', 'parents',
+                                       'author_name', 'author_mail',
+                                       'author_sec', 'author_offset',
+                                       'committer_name', 'committer_mail',
+                                       'committer_sec', 'committer_offset',
+                                       'message'])
+
+def parse_commit(content):
+    commit_match = re.match(_commit_rx, content)
+    if not commit_match:
+        raise Exception('cannot parse commit %r' % content)
+    matches = commit_match.groupdict()
+    return CommitInfo(tree=matches['tree'],
+                      parents=re.findall(_parent_hash_rx, matches['parents']),
+                      author_name=matches['author_name'],
+                      author_mail=matches['author_mail'],
+                      author_sec=int(matches['asec']),
+                      author_offset=parse_tz_offset(matches['atz']),
+                      committer_name=matches['committer_name'],
+                      committer_mail=matches['committer_mail'],
+                      committer_sec=int(matches['csec']),
+                      committer_offset=parse_tz_offset(matches['ctz']),
+                      message=matches['message'])
+
+
+def get_commit_items(id, cp):
+    commit_it = cp.get(id)
+    assert(commit_it.next() == 'commit')
+    commit_content = ''.join(commit_it)
+    return parse_commit(commit_content)
+
+
+def repo(sub = '', repo_dir=None):
+    """Get the path to the git repository or one of its subdirectories."""
+    global repodir
+    repo_dir = repo_dir or repodir
+    if not repo_dir:
+        raise GitError('You should call check_repo_or_die()')
+
+    # If there's a .git subdirectory, then the actual repo is in there.
+    gd = os.path.join(repo_dir, '.git')
+    if os.path.exists(gd):
+        repodir = gd
+
+    return os.path.join(repo_dir, sub)
+
+
+def shorten_hash(s):
+    return re.sub(r'([^0-9a-z]|\b)([0-9a-z]{7})[0-9a-z]{33}([^0-9a-z]|\b)',
+                  r'\1\2*\3', s)
+
+
+def repo_rel(path):
+    full = os.path.abspath(path)
+    fullrepo = os.path.abspath(repo(''))
+    if not fullrepo.endswith('/'):
+        fullrepo += '/'
+    if full.startswith(fullrepo):
+        path = full[len(fullrepo):]
+    if path.startswith('index-cache/'):
+        path = path[len('index-cache/'):]
+    return shorten_hash(path)
+
+
+def all_packdirs():
+    paths = [repo('objects/pack')]
+    paths += glob.glob(repo('index-cache/*/.'))
+    return paths
+
+
+def _run_bup(args, wait=True, stderr=None):
+    args = [path.exe()] + args
+    try:
+        p = subprocess.Popen(args, stdout=open('/dev/null', 'w'),
+                             stderr=stderr)
+    except OSError, e:
+        # make sure 'args' gets printed to help with debugging
+        add_error('%r: exception: %s' % (args, e))
+        raise
+    if wait:
+        rv = p.wait()
+        if rv:
+            add_error('%r: returned %d' % (args, rv))
+    return p
+
+
+def auto_midx(objdir, run_bloom=True):
+    _run_bup(['midx', '--auto', '--dir', objdir])
+    if run_bloom:
+        _run_bup(['bloom', '--dir', objdir])
+
+
+def add_to_bloom(objdir, idxname):
+    """Add the objects of the idx called idxname to the bloom filter of
+    objdir in place.
+
+    Return None if there's no usable filter, or it doesn't have the other
+    idxs of objdir either, in which case `bup bloom` should bring it up to
+    date.  Otherwise, return true if the filter has become too full and
+    should be regenerated.
+    """
+    bfull = os.path.join(objdir, 'bup.bloom')
+    if not os.path.exists(bfull):
+        return None
+    ix = open_idx(idxname)
+    # Asking for a single entry gets a shared mapping, so only the pages
+    # that change are written back, rather than the whole table.
+    b = bloom.ShaBloom(bfull, readwrite=True, expected=1)
+    try:
+        if not b.valid():
+            return None
+        base = os.path.basename(idxname)
+        have = set(b.idxnames)
+        have.add(base)
+        for name in glob.glob(os.path.join(objdir, '*.idx')):
+            if os.path.basename(name) not in have:
+                return None
+        if base not in b.idxnames:
+            b.add_idx(ix)
+        return bloom.needs_resize(b)
+    finally:
+        b.close()
+
+
+_bloom_rebuilds = {}  # objdir -> the bup bloom regenerating its filter
+
+def rebuild_bloom_in_background(objdir):
+    """Start regenerating the bloom filter of objdir from scratch, unless
+    that's already under way.
+
+    Meanwhile, the old filter is still used, and new packs are added to
+    it in place.  bup bloom adds those to the new filter too, under the
+    old one's lock, before it renames the new one over it.
+    """
+    p = _bloom_rebuilds.get(objdir)
+    if p and p.poll() is None:
+        return
+    debug1('bloom: regenerating %s in the background\n' % repo_rel(objdir))
+    # Nobody waits for it, so it has to keep quiet; if it fails, the old
+    # filter stays, and this is tried again after the next pack.
+    _bloom_rebuilds[objdir] = _run_bup(['bloom', '--force', '--dir', objdir],
+                                       wait=False,
+                                       stderr=open('/dev/null', 'w'))
+
+
+def mangle_name(name, mode, gitmode):
+    """Mangle a file name to present an abstract name for segmented files.
+    Mangled file names will have the ".bup" extension added to them. If a
+    file's name already ends with ".bup", a ".bupl" extension is added to
+    disambiguate normal files from segmented ones.
+    """
+    if stat.S_ISREG(mode) and not stat.S_ISREG(gitmode):
+        assert(stat.S_ISDIR(gitmode))
+        return name + '.bup'
+    elif name.endswith('.bup') or name[:-1].endswith('.bup'):
+        return name + '.bupl'
+    else:
+        return name
+
+
+(BUP_NORMAL, BUP_CHUNKED) = (0,1)
+def demangle_name(name):
+    """Remove name mangling from a file name, if necessary.
+
+    The return value is a tuple (demangled_filename,mode), where mode is one of
+    the following:
+
+    * BUP_NORMAL  : files that should be read as-is from the repository
+    * BUP_CHUNKED : files that were chunked and need to be reassembled
+
+    For more information on the name mangling algorithm, see mangle_name()
+    """
+    if name.endswith('.bupl'):
+        return (name[:-5], BUP_NORMAL)
+    elif name.endswith('.bup'):
+        return (name[:-4], BUP_CHUNKED)
+    else:
+        return (name, BUP_NORMAL)
+
+
+def calc_hash(type, content):
+    """Calculate some content's hash in the Git fashion."""
+    header = '%s %d\0' % (type, len(content))
+    sum = Sha1(header)
+    sum.update(content)
+    return sum.digest()
+
+
+def shalist_item_sort_key(ent):
+    (mode, name, id) = ent
+    assert(mode+0 == mode)
+    if stat.S_ISDIR(mode):
+        return name + '/'
+    else:
+        return name
+
+
+def tree_encode(shalist):
+    """Generate a git tree object from (mode,name,hash) tuples."""
+    shalist = sorted(shalist, key = shalist_item_sort_key)
+    l = []
+    for (mode,name,bin) in shalist:
+        assert(mode)
+        assert(mode+0 == mode)
+        assert(name)
+        assert(len(bin) == 20)
+        s = '%o %s\0%s' % (mode,name,bin)
+        assert(s[0] != '0')  # 0-padded octal is not acceptable in a git tree
+        l.append(s)
+    return ''.join(l)
+
+
+def tree_decode(buf):
+    """Generate a list of (mode,name,hash) from the git tree object in buf."""
+    ofs = 0
+    while ofs < len(buf):
+        z = buf.find('\0', ofs)
+        assert(z > ofs)
+        spl = buf[ofs:z].split(' ', 1)
+        assert(len(spl) == 2)
+        mode,name = spl
+        sha = buf[z+1:z+1+20]
+        ofs = z+1+20
+        yield (int(mode, 8), name, sha)
+
+
+def _encode_packobj(type, content, compression_level=1):
+    szout = ''
+    sz = len(content)
+    szbits = (sz & 0x0f) | (_typemap[type]<<4)
+    sz >>= 4
+    while 1:
+        if sz: szbits |= 0x80
+        szout += chr(szbits)
+        if not sz:
+            break
+        szbits = sz & 0x7f
+        sz >>= 7
+    if compression_level > 9:
+        compression_level = 9
+    elif compression_level < 0:
+        compression_level = 0
+    z = zlib.compressobj(compression_level)
+    yield szout
+    yield z.compress(content)
+    yield z.flush()
+
+
+def _encode_looseobj(type, content, compression_level=1):
+    z = zlib.compressobj(compression_level)
+    yield z.compress('%s %d\0' % (type, len(content)))
+    yield z.compress(content)
+    yield z.flush()
+
+
+def _decode_looseobj(buf):
+    assert(buf);
+    s = zlib.decompress(buf)
+    i = s.find('\0')
+    assert(i > 0)
+    l = s[:i].split(' ')
+    type = l[0]
+    sz = int(l[1])
+    content = s[i+1:]
+    assert(type in _typemap)
+    assert(sz == len(content))
+    return (type, content)
+
+
+def _decode_packobj(buf):
+    assert(buf)
+    c = ord(buf[0])
+    type = _typermap[(c & 0x70) >> 4]
+    sz = c & 0x0f
+    shift = 4
+    i = 0
+    while c & 0x80:
+        i += 1
+        c = ord(buf[i])
+        sz |= (c & 0x7f) << shift
+        shift += 7
+        if not (c & 0x80):
+            break
+    return (type, zlib.decompress(buf[i+1:]))
+
+
+class PackIdx:
+    def __init__(self):
+        assert(0)
+
+    def find_offset(self, hash):
+        """Get the offset of an object inside the index file."""
+        idx = self._idx_from_hash(hash)
+        if idx != None:
+            return self._ofs_from_idx(idx)
+        return None
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object exists in this index."""
+        if hash and (self._idx_from_hash(hash) != None):
+            return want_source and os.path.basename(self.name) or True
+        return None
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes."""
+        shas = sorted(set(str(h) for h in hashes))
+        found = dict((shas[n], want_source and self._source(i) or True)
+                     for n, i in self._find_sorted(''.join(shas)))
+        return [found.get(str(h)) for h in hashes]
+
+    def _find_sorted(self, shas):
+        """Return an (n, index) pair for each of the concatenated sorted
+        shas that's in the index, where it's the nth of them."""
+        found = array('i', _helpers.find_shas(self._shas, self._sha_stride,
+                                              len(self), shas))
+        return zip(found[::2], found[1::2])
+
+    def _source(self, idx):
+        return os.path.basename(self.name)
+
+    def __len__(self):
+        return int(self.fanout[255])
+
+    def _idx_from_hash(self, hash):
+        global _total_searches, _total_steps
+        _total_searches += 1
+        assert(len(hash) == 20)
+        b1 = ord(hash[0])
+        start = self.fanout[b1-1] # range -1..254
+        end = self.fanout[b1] # range 0..255
+        if start >= end:
+            _total_steps += 1  # lookup table is a step
+            return None
+        idx, steps = _helpers.bsearch_sha(self._shas, self._sha_stride,
+                                          start, end, str(hash))
+        _total_steps += steps
+        return idx
+
+
+class PackIdxV1(PackIdx):
+    """Object representation of a Git pack index (version 1) file."""
+    def __init__(self, filename, f):
+        self.name = filename
+        self.idxnames = [self.name]
+        self.map = mmap_read(f)
+        self.fanout = list(struct.unpack('!256I',
+                                         str(buffer(self.map, 0, 256*4))))
+        self.fanout.append(0)  # entry "-1"
+        nsha = self.fanout[255]
+        self.sha_ofs = 256*4
+        self.shatable = buffer(self.map, self.sha_ofs, nsha*24)
+        self._shas = buffer(self.shatable, 4)  # each after a 4 byte offset
+        self._sha_stride = 24
+
+    def _ofs_from_idx(self, idx):
+        return struct.unpack('!I', str(self.shatable[idx*24 : idx*24+4]))[0]
+
+    def __iter__(self):
+        for i in xrange(self.fanout[255]):
+            yield buffer(self.map, 256*4 + 24*i + 4, 20)
+
+
+class PackIdxV2(PackIdx):
+    """Object representation of a Git pack index (version 2) file."""
+    def __init__(self, filename, f):
+        self.name = filename
+        self.idxnames = [self.name]
+        self.map = mmap_read(f)
+        assert(str(self.map[0:8]) == '\377tOc\0\0\0\2')
+        self.fanout = list(struct.unpack('!256I',
+                                         str(buffer(self.map, 8, 256*4))))
+        self.fanout.append(0)  # entry "-1"
+        nsha = self.fanout[255]
+        self.sha_ofs = 8 + 256*4
+        self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
+        self._shas = self.shatable
+        self._sha_stride = 20
+        self.ofstable = buffer(self.map,
+                               self.sha_ofs + nsha*20 + nsha*4,
+                               nsha*4)
+        self.ofs64table = buffer(self.map,
+                                 8 + 256*4 + nsha*20 + nsha*4 + nsha*4)
+
+    def _ofs_from_idx(self, idx):
+        ofs = struct.unpack('!I', str(buffer(self.ofstable, idx*4, 4)))[0]
+        if ofs & 0x80000000:
+            idx64 = ofs & 0x7fffffff
+            ofs = struct.unpack('!Q',
+                                str(buffer(self.ofs64table, idx64*8, 8)))[0]
+        return ofs
+
+    def __iter__(self):
+        for i in xrange(self.fanout[255]):
+            yield buffer(self.map, 8 + 256*4 + 20*i, 20)
+
+
+_mpi_count = 0
+_merge_warned = 0
+class PackIdxList:
+    def __init__(self, dir):
+        global _mpi_count
+        assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
+        _mpi_count += 1
+        self.dir = dir
+        self.also = set()
+        self.packs = []
+        self.do_bloom = False
+        self.bloom = None
+        self.hits = {}  # pack -> how many lookups were answered by it
+        self._last = None  # the pack the last hit was in
+        self._recent = {}  # sha -> pack, for the latest hits
+        self._recent_old = {}  # the generation before those
+        self._merged = None  # a midx of many of the idxs in self.packs
+        self._slow = 0  # lookups that had to ask too many idxs
+        self.refresh()
+
+    def __del__(self):
+        global _mpi_count
+        _mpi_count -= 1
+        assert(_mpi_count == 0)
+
+    def __iter__(self):
+        return iter(idxmerge(self.packs))
+
+    def __len__(self):
+        return sum(len(pack) for pack in self.packs)
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object exists in the index files."""
+        global _total_searches
+        _total_searches += 1
+        if hash in self.also:
+            return True
+        sha = str(hash)
+        p = self._recent.get(sha)
+        if p is None:
+            p = self._recent_old.get(sha)
+        if p is not None:
+            return want_source and p.exists(sha, want_source=True) or True
+        # Objects written together tend to be looked up together, so the
+        # pack that had the last one is the likeliest to have this one too.
+        last = self._last
+        if last is not None:
+            _total_searches -= 1  # will be incremented by sub-pack
+            ix = last.exists(sha, want_source=want_source)
+            if ix:
+                self._found(sha, last, None)
+                return ix
+        if self.do_bloom and self.bloom:
+            if self.bloom.exists(hash):
+                self.do_bloom = False
+            else:
+                _total_searches -= 1  # was counted by bloom
+                return None
+        packs = self.packs
+        for i in xrange(len(packs)):
+            if i == MERGE_MIN_IDXS:
+                self._slow += 1
+                if self._slow >= MERGE_AFTER and self._merge():
+                    # packs is gone; ask the new list from the start.
+                    _total_searches -= 1  # counted again
+                    return self.exists(hash, want_source=want_source)
+            p = packs[i]
+            if p is last:
+                continue
+            _total_searches -= 1  # will be incremented by sub-pack
+            ix = p.exists(sha, want_source=want_source)
+            if ix:
+                self._found(sha, p, i)
+                return ix
+        self.do_bloom = True
+        return None
+
+    def _found(self, sha, p, i):
+        """Account for sha having been found in p, which is self.packs[i]
+        (or somewhere in self.packs if i is None)."""
+        hits = self.hits[p] = self.hits.get(p, 0) + 1
+        if i:
+            # Move the pack up one place whenever it has had more hits than
+            # the one before it, so that the busiest packs are asked first
+            # without ever rebuilding the whole list.
+            packs = self.packs
+            prev = packs[i-1]
+            if hits > self.hits.get(prev, 0):
+                packs[i-1], packs[i] = p, prev
+        self._last = p
+        recent = self._recent
+        recent[sha] = p
+        if len(recent) >= RECENT_MAX:
+            self._recent_old = recent
+            self._recent = {}
+
+    def _merge(self):
+        """Replace the version 2 idxs in self.packs, which are too many to
+        ask one after the other, with a single midx of all of them, and
+        return true if that was done."""
+        global _merge_warned
+        self._slow = 0
+        ixs = [p for p in self.packs if isinstance(p, PackIdxV2) and len(p)]
+        if len(ixs) < MERGE_MIN_IDXS:
+            return False
+        total = sum(len(p) for p in ixs)
+        if total > MERGE_MAX_OBJECTS:
+            if not _merge_warned:
+                log('warning: %d indexes with %d objects are too many to'
+                    ' merge on the fly; run "bup midx" to merge them.\n'
+                    % (len(ixs), total))
+                _merge_warned = 1
+            return False
+        debug1('PackIdxList: merging %d indexes.\n' % len(ixs))
+        merged = midx.merge(os.path.join(self.dir, 'merged.midx'), ixs)
+        self.hits[merged] = sum(self.hits.pop(p, 0) for p in ixs)
+        ixs = set(ixs)
+        self.packs = [p for p in self.packs if p not in ixs] + [merged]
+        self.packs.sort(key=lambda p: -self.hits.get(p, 0))
+        if self._merged is not None:
+            self._merged.close()
+        self._merged = merged
+        self._last = None
+        self._recent = {}
+        self._recent_old = {}
+        return True
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes.
+
+        This is much faster than calling exists() for each of them, since
+        they're sorted once, and then found in a single pass over each of
+        the index files.
+        """
+        # The bloom filter isn't used: asking it about each hash costs
+        # more than the walk over each index does.
+        result = [None] * len(hashes)
+        todo = {}  # sha -> positions in hashes
+        for i, hash in enumerate(hashes):
+            sha = str(hash)
+            if sha in self.also:
+                result[i] = True
+            else:
+                todo.setdefault(sha, []).append(i)
+        shas = sorted(todo)
+        joined = ''.join(shas)
+        left = len(shas)
+        hit = False
+        for p in self.packs:
+            if not left:
+                break
+            found_here = 0
+            for n, idx in p._find_sorted(joined):
+                positions = todo.pop(shas[n], None)
+                if positions:  # not already found in another pack
+                    found = want_source and p._source(idx) or True
+                    for i in positions:
+                        result[i] = found
+                    left -= 1
+                    found_here += 1
+            if found_here:
+                self.hits[p] = self.hits.get(p, 0) + found_here
+                hit = True
+        if hit:
+            # so that the packs that had the most of them are searched first
+            self.packs.sort(key=lambda p: -self.hits.get(p, 0))
+        return result
+
+    def refresh(self, skip_midx = False):
+        """Refresh the index list.
+        This method verifies if .midx files were superseded (e.g. all of its
+        contents are in another, bigger .midx file) and removes the superseded
+        files.
+
+        If skip_midx is True, all work on .midx files will be skipped and .midx
+        files will be removed from the list.
+
+        The module-global variable 'ignore_midx' can force this function to
+        always act as if skip_midx was True.
+        """
+        self.bloom = None # Always reopen the bloom as it may have been relaced
+        self.do_bloom = False
+        if self._merged is not None:
+            # Its idxs are reopened below, and merged again if need be.
+            self.packs.remove(self._merged)
+            self._merged.close()
+            self._merged = None
+        self._last = None
+        self._recent = {}
+        self._recent_old = {}
+        self._slow = 0
+        skip_midx = skip_midx or ignore_midx
+        d = dict((p.name, p) for p in self.packs
+                 if not skip_midx or not isinstance(p, midx.PackMidx))
+        if os.path.exists(self.dir):
+            if not skip_midx:
+                midxl = []
+                for ix in self.packs:
+                    if isinstance(ix, midx.PackMidx):
+                        for name in ix.idxnames:
+                            d[os.path.join(self.dir, name)] = ix
+                for full in glob.glob(os.path.join(self.dir,'*.midx')):
+                    if not d.get(full):
+                        mx = midx.PackMidx(full)
+                        (mxd, mxf) = os.path.split(mx.name)
+                        broken = False
+                        for n in mx.idxnames:
+                            if not os.path.exists(os.path.join(mxd, n)):
+                                log(('warning: index %s missing\n' +
+                                    '  used by %s\n') % (n, mxf))
+                                broken = True
+                        if broken:
+                            mx.close()
+                            del mx
+                            unlink(full)
+                        else:
+                            midxl.append(mx)
+                midxl.sort(key=lambda ix:
+                           (-len(ix), -xstat.stat(ix.name).st_mtime))
+                for ix in midxl:
+                    any_needed = False
+                    for sub in ix.idxnames:
+                        found = d.get(os.path.join(self.dir, sub))
+                        if not found or isinstance(found, PackIdx):
+                            # doesn't exist, or exists but not in a midx
+                            any_needed = True
+                            break
+                    if any_needed:
+                        d[ix.name] = ix
+                        for name in ix.idxnames:
+                            d[os.path.join(self.dir, name)] = ix
+                    elif not ix.force_keep:
+                        debug1('midx: removing redundant: %s\n'
+                               % os.path.basename(ix.name))
+                        ix.close()
+                        unlink(ix.name)
+            for full in glob.glob(os.path.join(self.dir,'*.idx')):
+                if not d.get(full):
+                    try:
+                        ix = open_idx(full)
+                    except GitError, e:
+                        add_error(e)
+                        continue
+                    d[full] = ix
+            bfull = os.path.join(self.dir, 'bup.bloom')
+            if self.bloom is None and os.path.exists(bfull):
+                self.bloom = bloom.ShaBloom(bfull)
+            self.packs = list(set(d.values()))
+            self.hits = dict((p, self.hits.get(p, 0)) for p in self.packs)
+            # the busiest first, then the biggest
+            self.packs.sort(key=lambda p: (-self.hits[p], -len(p)))
+            if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
+                self.do_bloom = True
+            else:
+                self.bloom = None
+        debug1('PackIdxList: using %d index%s.\n'
+            % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
+
+    def add(self, hash):
+        """Insert an additional object in the list."""
+        self.also.add(hash)
+
+
+def open_idx(filename):
+    if filename.endswith('.idx'):
+        f = open(filename, 'rb')
+        header = f.read(8)
+        if header[0:4] == '\377tOc':
+            version = struct.unpack('!I', header[4:8])[0]
+            if version == 2:
+                return PackIdxV2(filename, f)
+            else:
+                raise GitError('%s: expected idx file version 2, got %d'
+                               % (filename, version))
+        elif len(header) == 8 and header[0:4] < '\377tOc':
+            return PackIdxV1(filename, f)
+        else:
+            raise GitError('%s: unrecognized idx file header' % filename)
+    elif filename.endswith('.midx'):
+        return midx.PackMidx(filename)
+    else:
+        raise GitError('idx filenames must end with .idx or .midx')
+
+
+def idxmerge(idxlist, final_progress=True):
+    """Generate a list of all the objects reachable in a PackIdxList."""
+    def pfunc(count, total):
+        qprogress('Reading indexes: %.2f%% (%d/%d)\r'
+                  % (count*100.0/total, count, total))
+    def pfinal(count, total):
+        if final_progress:
+            progress('Reading indexes: %.2f%% (%d/%d), done.\n'
+                     % (100, total, total))
+    return merge_iter(idxlist, 10024, pfunc, pfinal)
+
+
+def _make_objcache():
+    return PackIdxList(repo('objects/pack'))
+
+
+class _EncodeJob:
+    def __init__(self, sha, type, content):
+        self.sha = sha
+        self.type = type
+        self.content = content
+        self.data = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class _PackObjEncoder:
+    """Compress pack objects on a pool of worker threads.
+
+    Objects are handed back to write(sha, datalist) strictly in the
+    order they were submitted, and always from the submitting thread,
+    so the resulting pack is byte-for-byte what a serial writer would
+    have produced.  zlib releases the GIL while deflating, so the
+    workers really do run in parallel with the caller's splitting.
+    """
+    def __init__(self, jobs, compression_level, write):
+        self.compression_level = compression_level
+        self.write = write
+        self.window = jobs * 4
+        self.pending = deque()
+        self.pending_shas = set()
+        self.writing = False
+        self.todo = Queue.Queue()
+        self.threads = []
+        for i in xrange(jobs):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        while 1:
+            job = self.todo.get()
+            if job is None:
+                return
+            try:
+                job.data = ''.join(_encode_packobj(job.type, job.content,
+                                                   self.compression_level))
+            except:
+                job.exc_info = sys.exc_info()
+            job.content = None
+            job.done.set()
+
+    def submit(self, sha, type, content):
+        # content may be a view into the splitter's read buffer, which
+        # will be reused before the workers get to it.
+        job = _EncodeJob(sha, type, str(content))
+        self.pending.append(job)
+        self.pending_shas.add(sha)
+        self.todo.put(job)
+        self._write_ready(self.window)
+
+    def _write_ready(self, limit):
+        # Write out every finished job at the head of the queue, and wait
+        # for the oldest ones while more than 'limit' are still in flight.
+        if self.writing:
+            return  # write() ended the pack; the outer loop will continue
+        self.writing = True
+        try:
+            while self.pending:
+                job = self.pending[0]
+                if len(self.pending) <= limit and not job.done.is_set():
+                    break
+                job.done.wait()
+                self.pending.popleft()
+                if job.exc_info:
+                    raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+                self.write(job.sha, (job.data,))
+                self.pending_shas.discard(job.sha)
+        finally:
+            self.writing = False
+
+    def flush(self):
+        """Write out all submitted objects."""
+        self._write_ready(0)
+
+    def discard(self):
+        """Forget about all submitted objects without writing them."""
+        self.pending.clear()
+        self.pending_shas.clear()
+
+    def close(self):
+        for t in self.threads:
+            self.todo.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+def _pack_sha1(f):
+    # A running sum can't be kept as the objects are written: SHA-1 is
+    # chained from the first block, and that's where the object count
+    # only known at the end goes.  But the pack was just written, so it's
+    # most likely still cached; hash it straight from a map, in a single
+    # call that doesn't hold the GIL, rather than copying it through
+    # python a chunk at a time.  Nobody reads the pack again soon, so
+    # drop it from the cache to make room for the data being saved.
+    m = mmap_read(f, close=False)
+    try:
+        sum = Sha1(m)
+    finally:
+        m.close()
+    _helpers.fadvise_done(f.fileno(), os.fstat(f.fileno()).st_size)
+    return sum.digest()
+
+
+class PackWriter:
+    """Writes Git objects inside a pack file.
+
+    If jobs is greater than one, objects are compressed by that many
+    worker threads while the caller continues splitting and hashing.
+    """
+    def __init__(self, objcache_maker=_make_objcache, compression_level=1,
+                 jobs=1):
+        self.count = 0
+        self.outbytes = 0
+        self.filename = None
+        self.file = None
+        self.idx = None
+        self.objcache_maker = objcache_maker
+        self.objcache = None
+        self.compression_level = compression_level
+        self.jobs = jobs
+        self.encoder = None
+
+    def __del__(self):
+        self.close()
+
+    def _open(self):
+        if not self.file:
+            (fd,name) = tempfile.mkstemp(suffix='.pack', dir=repo('objects'))
+            self.file = os.fdopen(fd, 'w+b')
+            assert(name.endswith('.pack'))
+            self.filename = name[:-5]
+            self.file.write('PACK\0\0\0\2\0\0\0\0')
+            self.idx = list(list() for i in xrange(256))
+
+    def _raw_write(self, datalist, sha):
+        self._open()
+        f = self.file
+        # in case we get interrupted (eg. KeyboardInterrupt), it's best if
+        # the file never has a *partial* blob.  So let's make sure it's
+        # all-or-nothing.  (The blob shouldn't be very big anyway, thanks
+        # to our hashsplit algorithm.)  f.write() does its own buffering,
+        # but that's okay because we'll flush it in _end().
+        oneblob = ''.join(datalist)
+        try:
+            f.write(oneblob)
+        except IOError, e:
+            raise GitError, e, sys.exc_info()[2]
+        nw = len(oneblob)
+        crc = zlib.crc32(oneblob) & 0xffffffff
+        self._update_idx(sha, crc, nw)
+        self.outbytes += nw
+        self.count += 1
+        return nw, crc
+
+    def _update_idx(self, sha, crc, size):
+        assert(sha)
+        if self.idx:
+            self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
+
+    def _write(self, sha, type, content):
+        if verbose:
+            log('>')
+        if not sha:
+            sha = calc_hash(type, content)
+        if self.jobs > 1:
+            if not self.encoder:
+                self.encoder = _PackObjEncoder(self.jobs,
+                                               self.compression_level,
+                                               self._write_encoded)
+            self.encoder.submit(sha, type, content)
+        else:
+            self._write_encoded(sha, _encode_packobj(type, content,
+                                                     self.compression_level))
+        return sha
+
+    def _write_encoded(self, sha, datalist):
+        size, crc = self._raw_write(datalist, sha=sha)
+        if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
+            self.breakpoint()
+
+    def _flush_encoder(self):
+        if self.encoder:
+            self.encoder.flush()
+
+    def breakpoint(self):
+        """Clear byte and object counts and return the last processed id."""
+        id = self._end()
+        self.outbytes = self.count = 0
+        return id
+
+    def _require_objcache(self):
+        if self.objcache is None and self.objcache_maker:
+            self.objcache = self.objcache_maker()
+        if self.objcache is None:
+            raise GitError(
+                    "PackWriter not opened or can't check exists w/o objcache")
+
+    def exists(self, id, want_source=False):
+        """Return non-empty if an object is found in the object cache."""
+        self._require_objcache()
+        if self.encoder and id in self.encoder.pending_shas:
+            return True
+        return self.objcache.exists(id, want_source=want_source)
+
+    def exists_many(self, ids, want_source=False):
+        """Return a list of what exists() would return for each of ids."""
+        self._require_objcache()
+        found = self.objcache.exists_many(ids, want_source=want_source)
+        if self.encoder:
+            pending = self.encoder.pending_shas
+            found = [f or (id in pending) or None
+                     for id, f in zip(ids, found)]
+        return found
+
+    def maybe_write(self, type, content):
+        """Write an object to the pack file if not present and return its id."""
+        sha = calc_hash(type, content)
+        if not self.exists(sha):
+            self._write(sha, type, content)
+            self._require_objcache()
+            self.objcache.add(sha)
+        return sha
+
+    def new_blob(self, blob):
+        """Create a blob object in the pack with the supplied content."""
+        return self.maybe_write('blob', blob)
+
+    def new_blobs(self, blobs):
+        """Like new_blob() for each of blobs, but look them all up at once,
+        with exists_many().  Return the list of their ids."""
+        ids = [calc_hash('blob', blob) for blob in blobs]
+        written = set()
+        for id, blob, found in zip(ids, blobs, self.exists_many(ids)):
+            if not found and id not in written:
+                self._write(id, 'blob', blob)
+                self._require_objcache()
+                self.objcache.add(id)
+                written.add(id)
+        return ids
+
+    def new_tree(self, shalist):
+        """Create a tree object in the pack."""
+        content = tree_encode(shalist)
+        return self.maybe_write('tree', content)
+
+    def _new_commit(self, tree, parent, author, adate, committer, cdate, msg):
+        l = []
+        if tree: l.append('tree %s' % tree.encode('hex'))
+        if parent: l.append('parent %s' % parent.encode('hex'))
+        if author: l.append('author %s %s' % (author, _git_date(adate)))
+        if committer: l.append('committer %s %s' % (committer, _git_date(cdate)))
+        l.append('')
+        l.append(msg)
+        return self.maybe_write('commit', '\n'.join(l))
+
+    def new_commit(self, parent, tree, date, msg):
+        """Create a commit object in the pack."""
+        userline = '%s <%s@%s>' % (userfullname(), username(), hostname())
+        commit = self._new_commit(tree, parent,
+                                  userline, date, userline, date,
+                                  msg)
+        return commit
+
+    def abort(self):
+        """Remove the pack file from disk."""
+        if self.encoder:
+            self.encoder.discard()
+        f = self.file
+        if f:
+            self.idx = None
+            self.file = None
+            f.close()
+            os.unlink(self.filename + '.pack')
+
+    def _end(self, run_midx=True):
+        self._flush_encoder()
+        f = self.file
+        if not f: return None
+        self.file = None
+        self.objcache = None
+        idx = self.idx
+        self.idx = None
+
+        # update object count
+        f.seek(8)
+        cp = struct.pack('!i', self.count)
+        assert(len(cp) == 4)
+        f.write(cp)
+        f.flush()
+
+        # calculate the pack sha1sum
+        packbin = _pack_sha1(f)
+        f.seek(0, 2)
+        f.write(packbin)
+        f.close()
+
+        obj_list_sha = self._write_pack_idx_v2(self.filename + '.idx', idx, packbin)
+
+        objdir = repo('objects/pack')
+        nameprefix = os.path.join(objdir, 'pack-%s' % obj_list_sha)
+        if os.path.exists(self.filename + '.map'):
+            os.unlink(self.filename + '.map')
+        os.rename(self.filename + '.pack', nameprefix + '.pack')
+        os.rename(self.filename + '.idx', nameprefix + '.idx')
+
+        # Otherwise PackIdxList won't use the filter until `bup bloom` has
+        # caught up with the new pack.
+        too_full = add_to_bloom(objdir, nameprefix + '.idx')
+        if too_full:
+            rebuild_bloom_in_background(objdir)
+        if run_midx:
+            auto_midx(objdir, run_bloom=(too_full is None))
+        return nameprefix
+
+    def close(self, run_midx=True):
+        """Close the pack file and move it to its definitive path."""
+        id = self._end(run_midx=run_midx)
+        if self.encoder:
+            self.encoder.close()
+            self.encoder = None
+        return id
+
+    def _write_pack_idx_v2(self, filename, idx, packbin):
+        ofs64_count = 0
+        for section in idx:
+            for entry in section:
+                if entry[2] >= 2**31:
+                    ofs64_count += 1
+
+        # Length: header + fan-out + shas-and-crcs + overflow-offsets
+        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        idx_map = None
+        idx_f = open(filename, 'w+b')
+        try:
+            idx_f.truncate(index_len)
+            idx_map = mmap_readwrite(idx_f, close=False)
+            count = _helpers.write_idx(filename, idx_map, idx, self.count)
+            assert(count == self.count)
+        finally:
+            if idx_map: idx_map.close()
+            idx_f.close()
+
+        idx_f = open(filename, 'a+b')
+        try:
+            idx_f.write(packbin)
+            idx_f.seek(0)
+            idx_sum = Sha1()
+            b = idx_f.read(8 + 4*256)
+            idx_sum.update(b)
+
+            obj_list_sum = Sha1()
+            for b in chunkyreader(idx_f, 20*self.count):
+                idx_sum.update(b)
+                obj_list_sum.update(b)
+            namebase = obj_list_sum.hexdigest()
+
+            for b in chunkyreader(idx_f):
+                idx_sum.update(b)
+            idx_f.write(idx_sum.digest())
+            return namebase
+        finally:
+            idx_f.close()
+
+
+def _git_date(date):
+    return '%d %s' % (date, utc_offset_str(date))
+
+
+def _gitenv(repo_dir = None):
+    if not repo_dir:
+        repo_dir = repo()
+    def env():
+        os.environ['GIT_DIR'] = os.path.abspath(repo_dir)
+    return env
+
+
+def list_refs(refname = None, repo_dir = None):
+    """Generate a list of tuples in the form (refname,hash).
+    If a ref name is specified, list only this particular ref.
+    """
+    argv = ['git', 'show-ref', '--']
+    if refname:
+        argv += [refname]
+    p = subprocess.Popen(argv,
+                         preexec_fn = _gitenv(repo_dir),
+                         stdout = subprocess.PIPE)
+    out = p.stdout.read().strip()
+    rv = p.wait()  # not fatal
+    if rv:
+        assert(not out)
+    if out:
+        for d in out.split('\n'):
+            (sha, name) = d.split(' ', 1)
+            yield (name, sha.decode('hex'))
+
+
+def read_ref(refname, repo_dir = None):
+    """Get the commit id of the most recent commit made on a given ref."""
+    l = list(list_refs(refname, repo_dir))
+    if l:
+        assert(len(l) == 1)
+        return l[0][1]
+    else:
+        return None
+
+
+def rev_list(ref, count=None, repo_dir=None):
+    """Generate a list of reachable commits in reverse chronological order.
+
+    This generator walks through commits, from child to parent, that are
+    reachable via the specified ref and yields a series of tuples of the form
+    (date,hash).
+
+    If count is a non-zero integer, limit the number of commits to "count"
+    objects.
+    """
+    assert(not ref.startswith('-'))
+    opts = []
+    if count:
+        opts += ['-n', str(atoi(count))]
+    argv = ['git', 'rev-list', '--pretty=format:%at'] + opts + [ref, '--']
+    p = subprocess.Popen(argv,
+                         preexec_fn = _gitenv(repo_dir),
+                         stdout = subprocess.PIPE)
+    commit = None
+    for row in p.stdout:
+        s = row.strip()
+        if s.startswith('commit '):
+            commit = s[7:].decode('hex')
+        else:
+            date = int(s)
+            yield (date, commit)
+    rv = p.wait()  # not fatal
+    if rv:
+        raise GitError, 'git rev-list returned error %d' % rv
+
+
+def get_commit_dates(refs, repo_dir=None):
+    """Get the dates for the specified commit refs.  For now, every unique
+       string in refs must resolve to a different commit or this
+       function will fail."""
+    result = []
+    for ref in refs:
+        commit = get_commit_items(ref, cp(repo_dir))
+        result.append(commit.author_sec)
+    return result
+
+
+def rev_parse(committish, repo_dir=None):
+    """Resolve the full hash for 'committish', if it exists.
+
+    Should be roughly equivalent to 'git rev-parse'.
+
+    Returns the hex value of the hash if it is found, None if 'committish' does
+    not correspond to anything.
+    """
+    head = read_ref(committish, repo_dir=repo_dir)
+    if head:
+        debug2("resolved from ref: commit = %s\n" % head.encode('hex'))
+        return head
+
+    pL = PackIdxList(repo('objects/pack', repo_dir=repo_dir))
+
+    if len(committish) == 40:
+        try:
+            hash = committish.decode('hex')
+        except TypeError:
+            return None
+
+        if pL.exists(hash):
+            return hash
+
+    return None
+
+
+def update_ref(refname, newval, oldval, repo_dir=None):
+    """Update a repository reference."""
+    if not oldval:
+        oldval = ''
+    assert(refname.startswith('refs/heads/') \
+           or refname.startswith('refs/tags/'))
+    p = subprocess.Popen(['git', 'update-ref', refname,
+                          newval.encode('hex'), oldval.encode('hex')],
+                         preexec_fn = _gitenv(repo_dir))
+    _git_wait('git update-ref', p)
+
+
+def delete_ref(refname):
+    """Delete a repository reference."""
+    assert(refname.startswith('refs/'))
+    p = subprocess.Popen(['git', 'update-ref', '-d', refname],
+                         preexec_fn = _gitenv())
+    _git_wait('git update-ref', p)
+
+
+def guess_repo(path=None):
+    """Set the path value in the global variable "repodir".
+    This makes bup look for an existing bup repository, but not fail if a
+    repository doesn't exist. Usually, if you are interacting with a bup
+    repository, you would not be calling this function but using
+    check_repo_or_die().
+    """
+    global repodir
+    if path:
+        repodir = path
+    if not repodir:
+        repodir = os.environ.get('BUP_DIR')
+        if not repodir:
+            repodir = os.path.expanduser('~/.bup')
+
+
+def init_repo(path=None):
+    """Create the Git bare repository for bup in a given path."""
+    guess_repo(path)
+    d = repo()  # appends a / to the path
+    parent = os.path.dirname(os.path.dirname(d))
+    if parent and not os.path.exists(parent):
+        raise GitError('parent directory "%s" does not exist\n' % parent)
+    if os.path.exists(d) and not os.path.isdir(os.path.join(d, '.')):
+        raise GitError('"%s" exists but is not a directory\n' % d)
+    p = subprocess.Popen(['git', '--bare', 'init'], stdout=sys.stderr,
+                         preexec_fn = _gitenv())
+    _git_wait('git init', p)
+    # Force the index version configuration in order to ensure bup works
+    # regardless of the version of the installed Git binary.
+    p = subprocess.Popen(['git', 'config', 'pack.indexVersion', '2'],
+                         stdout=sys.stderr, preexec_fn = _gitenv())
+    _git_wait('git config', p)
+    # Enable the reflog
+    p = subprocess.Popen(['git', 'config', 'core.logAllRefUpdates', 'true'],
+                         stdout=sys.stderr, preexec_fn = _gitenv())
+    _git_wait('git config', p)
+
+
+def git_config_get(option, repo_dir=None):
+    """Return the value of the git config option in the repository, or
+    None if it isn't set."""
+    p = subprocess.Popen(['git', 'config', '--get', option],
+                         stdout=subprocess.PIPE,
+                         preexec_fn=_gitenv(repo_dir))
+    r = p.stdout.read()
+    rc = p.wait()
+    if rc == 1:
+        return None
+    if rc != 0:
+        raise GitError('git config --get %s returned error %d' % (option, rc))
+    return r.rstrip('\n')
+
+
+def git_config_set(option, value, repo_dir=None):
+    """Set the git config option to value in the repository."""
+    p = subprocess.Popen(['git', 'config', option, value],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+
+
+def check_repo_or_die(path=None):
+    """Make sure a bup repository exists, and abort if not.
+    If the path to a particular repository was not specified, this function
+    initializes the default repository automatically.
+    """
+    guess_repo(path)
+    try:
+        os.stat(repo('objects/pack/.'))
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            log('error: %r is not a bup repository; run "bup init"\n'
+                % repo())
+            sys.exit(15)
+        else:
+            log('error: %s\n' % e)
+            sys.exit(14)
+
+
+_ver = None
+def ver():
+    """Get Git's version and ensure a usable version is installed.
+
+    The returned version is formatted as an ordered tuple with each position
+    representing a digit in the version tag. For example, the following tuple
+    would represent version 1.6.6.9:
+
+        ('1', '6', '6', '9')
+    """
+    global _ver
+    if not _ver:
+        p = subprocess.Popen(['git', '--version'],
+                             stdout=subprocess.PIPE)
+        gvs = p.stdout.read()
+        _git_wait('git --version', p)
+        m = re.match(r'git version (\S+.\S+)', gvs)
+        if not m:
+            raise GitError('git --version weird output: %r' % gvs)
+        _ver = tuple(m.group(1).split('.'))
+    needed = ('1','5', '3', '1')
+    if _ver < needed:
+        raise GitError('git version %s or higher is required; you have %s'
+                       % ('.'.join(needed), '.'.join(_ver)))
+    return _ver
+
+
+def _git_wait(cmd, p):
+    rv = p.wait()
+    if rv != 0:
+        raise GitError('%s returned %d' % (cmd, rv))
+
+
+def _git_capture(argv):
+    p = subprocess.Popen(argv, stdout=subprocess.PIPE, preexec_fn = _gitenv())
+    r = p.stdout.read()
+    _git_wait(repr(argv), p)
+    return r
+
+
+class _AbortableIter:
+    def __init__(self, it, onabort = None):
+        self.it = it
+        self.onabort = onabort
+        self.done = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.it.next()
+        except StopIteration, e:
+            self.done = True
+            raise
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Abort iteration and call the abortion callback, if needed."""
+        if not self.done:
+            self.done = True
+            if self.onabort:
+                self.onabort()
+
+    def __del__(self):
+        self.abort()
+
+
+class _ObjectReader:
+    """What's common to the ways of reading objects: a subclass provides
+    get(id), which generates the object's type and then its content."""
+    def join(self, id):
+        """Generate a list of the content of all blobs that can be reached
+        from an object.  The hash given in 'id' must point to a blob, a tree
+        or a commit. The content of all blobs that can be seen from trees or
+        commits will be added to the list.
+        """
+        todo = deque([id])  # what's left to read, in order
+        try:
+            while todo:
+                id = todo.popleft()
+                entries = _cached_tree(id)
+                if entries is not None:
+                    todo.extendleft(reversed([sha.encode('hex') for
+                                              (mode, name, sha) in entries]))
+                    continue
+                it = self.get(id)
+                type = it.next()
+                if type == 'blob':
+                    for blob in it:
+                        yield blob
+                elif type == 'tree':
+                    entries = tuple(tree_decode(''.join(it)))
+                    if _hex_rx.match(id):
+                        tree_cache.put(id.decode('hex'), entries)
+                    todo.extendleft(reversed([sha.encode('hex') for
+                                              (mode, name, sha) in entries]))
+                elif type == 'commit':
+                    treeline = ''.join(it).split('\n')[0]
+                    assert(treeline.startswith('tree '))
+                    todo.appendleft(treeline[5:])
+                else:
+                    raise GitError('invalid object type %r: expected '
+                                   'blob/tree/commit' % type)
+        except StopIteration:
+            log('booger!\n')
+
+
+_ver_warned = 0
+class CatPipe(_ObjectReader):
+    """Link to 'git cat-file' that is used to retrieve blob data."""
+    def __init__(self, repo_dir = None):
+        global _ver_warned
+        self.repo_dir = repo_dir
+        wanted = ('1','5','6')
+        if ver() < wanted:
+            if not _ver_warned:
+                log('warning: git version < %s; bup will be slow.\n'
+                    % '.'.join(wanted))
+                _ver_warned = 1
+            self.get = self._slow_get
+        else:
+            self.p = self.inprogress = None
+            self.get = self._fast_get
+
+    def _abort(self):
+        if self.p:
+            self.p.stdout.close()
+            self.p.stdin.close()
+        self.p = None
+        self.inprogress = None
+
+    def _restart(self):
+        self._abort()
+        self.p = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  close_fds = True,
+                                  bufsize = 65536,
+                                  preexec_fn = _gitenv(self.repo_dir))
+
+    def _fast_get(self, id):
+        if not self.p or self.p.poll() != None:
+            self._restart()
+        assert(self.p)
+        poll_result = self.p.poll()
+        assert(poll_result == None)
+        if self.inprogress:
+            log('_fast_get: opening %r while %r is open\n'
+                % (id, self.inprogress))
+        assert(not self.inprogress)
+        assert(id.find('\n') < 0)
+        assert(id.find('\r') < 0)
+        assert(not id.startswith('-'))
+        self.inprogress = id
+        self.p.stdin.write('%s\n' % id)
+        self.p.stdin.flush()
+        hdr = self.p.stdout.readline()
+        if hdr.endswith(' missing\n'):
+            self.inprogress = None
+            raise KeyError('blob %r is missing' % id)
+        spl = hdr.split(' ')
+        if len(spl) != 3 or len(spl[0]) != 40:
+            raise GitError('expected blob, got %r' % spl)
+        (hex, type, size) = spl
+
+        it = _AbortableIter(chunkyreader(self.p.stdout, int(spl[2])),
+                           onabort = self._abort)
+        try:
+            yield type
+            for blob in it:
+                yield blob
+            readline_result = self.p.stdout.readline()
+            assert(readline_result == '\n')
+            self.inprogress = None
+        except Exception, e:
+            it.abort()
+            raise
+
+    def _slow_get(self, id):
+        assert(id.find('\n') < 0)
+        assert(id.find('\r') < 0)
+        assert(id[0] != '-')
+        type = _git_capture(['git', 'cat-file', '-t', id]).strip()
+        yield type
+
+        p = subprocess.Popen(['git', 'cat-file', type, id],
+                             stdout=subprocess.PIPE,
+                             preexec_fn = _gitenv(self.repo_dir))
+        for blob in chunkyreader(p.stdout):
+            yield blob
+        _git_wait('git cat-file', p)
+
+_OFS_DELTA = 6
+_REF_DELTA = 7
+_hex_rx = re.compile(r'^[0-9a-fA-F]{40}$')
+
+class PackReader(_ObjectReader):
+    """Read objects straight out of the mmapped packs of a repository.
+
+    Objects are found with the repository's idx and midx files, and
+    inflated from the .pack without a round trip through 'git cat-file'.
+    Anything that isn't in a pack (loose objects, or names like 'HEAD'
+    rather than hashes) is passed on to a CatPipe.
+    """
+    def __init__(self, repo_dir = None):
+        self.repo_dir = repo_dir
+        self.packdir = repo('objects/pack', repo_dir=repo_dir)
+        self.catpipe = None
+        self.idxs = {}  # idx basename -> PackIdx
+        self.midxs = []
+        self.search = []  # the midxs, then the idxs none of them cover
+        self.maps = {}  # idx basename -> mmap of its pack
+        self._last = None  # the idx the last object was in
+        self._mtime = None  # of packdir, when it was last read
+        self._bases = {}  # (idx basename, ofs) -> (type, content)
+        self._bases_size = 0
+        self.refresh()
+
+    def close(self):
+        for m in self.maps.itervalues():
+            m.close()
+        self.maps = {}
+        for mx in self.midxs:
+            mx.close()
+        self.midxs = []
+        self.idxs = {}
+        self.search = []
+        self._last = None
+        self._bases = {}
+        self._bases_size = 0
+
+    def refresh(self):
+        """Pick up any idx and midx files that have appeared since the
+        last time, and forget about any that are gone."""
+        try:
+            self._mtime = os.stat(self.packdir).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._mtime = None
+        idxs = {}
+        for full in glob.glob(os.path.join(self.packdir, '*.idx')):
+            name = os.path.basename(full)
+            ix = self.idxs.get(name)
+            if ix is None:
+                try:
+                    ix = open_idx(full)
+                except GitError, e:
+                    add_error(e)
+                    continue
+            idxs[name] = ix
+        for name in self.idxs:
+            if name not in idxs and name in self.maps:
+                self.maps.pop(name).close()
+        self.idxs = idxs
+        for mx in self.midxs:
+            mx.close()
+        self.midxs = []
+        if not ignore_midx:
+            for full in glob.glob(os.path.join(self.packdir, '*.midx')):
+                mx = midx.PackMidx(full)
+                if mx.idxnames:
+                    self.midxs.append(mx)
+                else:
+                    mx.close()
+        self.midxs.sort(key=lambda mx: -len(mx))
+        covered = set()
+        for mx in self.midxs:
+            covered.update(mx.idxnames)
+        self.search = self.midxs + [ix for name, ix in sorted(idxs.items())
+                                    if name not in covered]
+        self._last = None
+
+    def _changed(self):
+        try:
+            return os.stat(self.packdir).st_mtime != self._mtime
+        except OSError:
+            return self._mtime is not None
+
+    def _find(self, sha):
+        """Return (idx basename, offset in the pack) of sha, or None."""
+        # Objects that were written together are usually read together.
+        last = self._last
+        if last is not None:
+            ofs = last.find_offset(sha)
+            if ofs is not None:
+                return os.path.basename(last.name), ofs
+        for ix in self.search:
+            if isinstance(ix, midx.PackMidx):
+                name = ix.exists(sha, want_source=True)
+                if not name:
+                    continue
+                sub = self.idxs.get(name)
+                if sub is None:  # the midx is out of date
+                    continue
+            else:
+                sub = ix
+            ofs = sub.find_offset(sha)
+            if ofs is not None:
+                self._last = sub
+                return os.path.basename(sub.name), ofs
+        return None
+
+    def _map(self, name):
+        m = self.maps.get(name)
+        if m is None:
+            packname = os.path.join(self.packdir, name[:-len('.idx')] + '.pack')
+            m = self.maps[name] = mmap_read(open(packname, 'rb'))
+        return m
+
+    def _header(self, m, ofs):
+        """Return the type, size and the offset of the data of the object
+        at ofs in the pack map m."""
+        hdr = m[ofs:ofs+16]  # much more than any size needs
+        c = ord(hdr[0])
+        type = (c & 0x70) >> 4
+        size = c & 0x0f
+        shift = 4
+        i = 0
+        while c & 0x80:
+            i += 1
+            c = ord(hdr[i])
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, ofs + i + 1
+
+    def _inflate(self, m, ofs, size):
+        """Generate the size bytes that the zlib stream at ofs in the pack
+        map m inflates to, in chunks of at most 64k."""
+        d = zlib.decompressobj()
+        left = size
+        tail = ''
+        while left:
+            if not tail:
+                # Only a little more than the data itself, so that zlib
+                # doesn't copy the rest of the pack as its unused_data.
+                tail = buffer(m, ofs, min(65536, left + left//1000 + 64))
+                if not tail:
+                    raise GitError('%r: object at %d is truncated'
+                                   % (m, ofs))
+                ofs += len(tail)
+            out = d.decompress(tail, min(left, 65536))
+            tail = d.unconsumed_tail
+            if len(out) > left or (d.unused_data and len(out) < left):
+                raise GitError('object is %d bytes, not the expected %d'
+                               % (size - left + len(out), size))
+            left -= len(out)
+            if out:
+                yield out
+
+    def _object(self, name, ofs):
+        """Return the type and content of the object at ofs in the pack of
+        the idx called name, applying any deltas."""
+        deltas = []
+        while 1:
+            base = self._bases.get((name, ofs))
+            if base is not None:
+                type, content = base
+                break
+            m = self._map(name)
+            t, size, pos = self._header(m, ofs)
+            if t == _OFS_DELTA:
+                c = ord(m[pos])
+                pos += 1
+                back = c & 0x7f
+                while c & 0x80:
+                    c = ord(m[pos])
+                    pos += 1
+                    back = ((back + 1) << 7) | (c & 0x7f)
+                deltas.append((name, ofs, ''.join(self._inflate(m, pos, size))))
+                ofs -= back
+            elif t == _REF_DELTA:
+                sha = m[pos:pos+20]
+                deltas.append((name, ofs,
+                               ''.join(self._inflate(m, pos + 20, size))))
+                found = self._find(sha)
+                if found is None:
+                    raise GitError('delta base %s is missing'
+                                   % sha.encode('hex'))
+                name, ofs = found
+            elif t in _typermap:
+                type = _typermap[t]
+                content = ''.join(self._inflate(m, pos, size))
+                break
+            else:
+                raise GitError('unknown object type %d at %d in %s'
+                               % (t, ofs, name))
+        while deltas:
+            name, ofs, delta = deltas.pop()
+            content = _helpers.apply_delta(content, delta)
+            if deltas:
+                self._remember_base(name, ofs, type, content)
+        return type, content
+
+    def _remember_base(self, name, ofs, type, content):
+        # Objects deltified against the same base tend to be read one after
+        # the other; keep the bases (to a limit) so the chain isn't redone.
+        if self._bases_size + len(content) > BASE_CACHE_MAX:
+            self._bases = {}
+            self._bases_size = 0
+        self._bases[(name, ofs)] = (type, content)
+        self._bases_size += len(content)
+
+    def _read(self, name, ofs):
+        m = self._map(name)
+        t, size, pos = self._header(m, ofs)
+        if t in _typermap:
+            # The common case: stream it, however big it is.
+            yield _typermap[t]
+            for data in self._inflate(m, pos, size):
+                yield data
+        else:
+            type, content = self._object(name, ofs)
+            yield type
+            yield content
+
+    def get(self, id):
+        """Generate the type of the object named id, and then its content.
+        Raise KeyError if it's missing."""
+        found = None
+        if _hex_rx.match(id):
+            sha = id.decode('hex')
+            found = self._find(sha)
+            if found is None and self._changed():
+                self.refresh()
+                found = self._find(sha)
+        if found is None:
+            if not self.catpipe:
+                self.catpipe = CatPipe(self.repo_dir)
+            for data in self.catpipe.get(id):
+                yield data
+            return
+        for data in self._read(*found):
+            yield data
+
+    def locate(self, sha):
+        """Return (idx basename, offset in the pack, size) of the object
+        with the binary hash sha, or None if it isn't in any pack.  The
+        size is that of its content, or of its delta if it's stored as
+        one.  Reading objects in the order of their locations reads each
+        pack from the start to the end."""
+        found = self._find(sha)
+        if found is None and self._changed():
+            self.refresh()
+            found = self._find(sha)
+        if found is None:
+            return None
+        (name, ofs) = found
+        return (name, ofs, self._header(self._map(name), ofs)[1])
+
+
+_cp = {}
+
+def cp(repo_dir=None):
+    """Create a PackReader object or reuse the already existing one."""
+    global _cp
+    if not repo_dir:
+        repo_dir = repo()
+    repo_dir = os.path.abspath(repo_dir)
+    cp = _cp.get(repo_dir)
+    if not cp:
+        cp = PackReader(repo_dir)
+        _cp[repo_dir] = cp
+    return cp
+
+
+def _tree_size(entries):
+    # roughly what the tuple, and the int and strings in it, take per entry
+    return sum(200 + len(name) for mode, name, sha in entries)
+
+# The decoded trees that were read last, by sha.  They're the same in every
+# repository, so one cache serves them all.
+tree_cache = LRUCache(TREE_CACHE_MAX, _tree_size)
+
+def read_tree(sha, repo_dir=None):
+    """Return the (mode, name, hash) entries of the tree with the binary
+    hash sha, or of the tree of that commit."""
+    entries = tree_cache.get(sha)
+    if entries is None:
+        it = cp(repo_dir).get(sha.encode('hex'))
+        type = it.next()
+        buf = ''.join(it)
+        if type == 'commit':
+            treeline = buf.split('\n')[0]
+            assert(treeline.startswith('tree '))
+            return read_tree(treeline[5:].decode('hex'), repo_dir)
+        if type != 'tree':
+            raise GitError('%s is a %s, not a tree' % (sha.encode('hex'), type))
+        entries = tuple(tree_decode(buf))
+        tree_cache.put(sha, entries)
+    return entries
+
+
+def _cached_tree(id):
+    """Return the entries of the tree with the hex hash id if they're in
+    tree_cache, or None."""
+    if _hex_rx.match(id):
+        sha = id.decode('hex')
+        if sha in tree_cache:
+            return tree_cache.get(sha)
+    return None
+
+
+def tags(repo_dir = None):
+    """Return a dictionary of all tags in the form {hash: [tag_names, ...]}."""
+    tags = {}
+    for (n,c) in list_refs(repo_dir = repo_dir):
+        if n.startswith('refs/tags/'):
+            name = n[10:]
+            if not c in tags:
+                tags[c] = []
+
+            tags[c].append(name)  # more than one tag can point at 'c'
+    return tags
@@ -0,0 +1,473 @@
+import math, os, stat
+from array import array
+from bup import _helpers
+from bup.helpers import *
+
+BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
+BLOB_READ_SIZE = 1024*1024
+MAX_PER_TREE = 256
+progress_callback = None
+fanout = 16
+blobbits = _helpers.blobbits()  # blobs average 2^blobbits bytes
+
+# Storage of finished Bufs, kept so that splitting many small files doesn't
+# allocate (and zero) a new read buffer for each one.
+_free_bufs = []
+_MAX_FREE_BUFS = 4
+
+# Regular files at least this big are split straight from an mmap().
+MMAP_MIN_SIZE = 16*1024*1024
+
+_native_splitbuf = _helpers.splitbuf
+
+# How files are split into blobs, ie. one of CHUNKERS.  Every client of a
+# repository must use the same one, or nothing they save will dedup, so
+# this comes from the repository's bup.split.chunker; see configure().
+# The same goes for blobbits, BLOB_MAX, fanout and MAX_PER_TREE.
+chunker = 'bupsplit'
+
+GIT_MODE_FILE = 0100644
+GIT_MODE_TREE = 040000
+GIT_MODE_SYMLINK = 0120000
+assert(GIT_MODE_TREE != 40000)  # 0xxx should be treated as octal
+
+# The purpose of this type of buffer is to avoid copying the data we split.
+# Input is read straight into a preallocated bytearray (with readinto() when
+# the file supports it), and peek(), get() and eat() only hand out buffer()
+# views into it.  When the free space at the end runs out, the (small)
+# unconsumed tail is moved back to the front and the space is reused, so
+# views returned earlier are only valid until the next fill() or put().
+#
+# Large regular files are mmap()ed instead of read, so that fill() only has
+# to move the end of the buffer forward.  Pages behind the cursor are
+# dropped from the mapping and the page cache as we go, just as
+# fadvise_done() does for files we read.
+class Buf:
+    def __init__(self):
+        try:
+            self.data = _free_bufs.pop()
+        except IndexError:
+            self.data = bytearray()
+        self.start = 0
+        self.end = 0
+        self.file = None
+        self.map = None
+        self.map_size = 0
+
+    def _map(self, f):
+        # Map f if it's a large regular file that we're at the start of.
+        try:
+            fd = f.fileno()
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_size < MMAP_MIN_SIZE:
+                return
+            if f.tell() != 0:
+                return
+            m = mmap_read(f, st.st_size, close=False)
+        except (AttributeError, EnvironmentError, ValueError):
+            return  # not a real file, or not mmap-able: just read() it
+        if len(_free_bufs) < _MAX_FREE_BUFS:
+            _free_bufs.append(self.data)
+        self.data = self.map = m
+        self.map_size = st.st_size
+
+    def _unmap(self, f):
+        # Go back to reading, keeping the unconsumed part of the map.  The
+        # map itself goes away once the last view into it does.
+        tail = self.map[self.start:self.end]
+        if f:
+            f.seek(self.end)
+        self.map = None
+        try:
+            self.data = _free_bufs.pop()
+        except IndexError:
+            self.data = bytearray()
+        self.start = self.end = 0
+        self.put(tail)
+
+    def _prepare(self, count):
+        # Make room for count more bytes at self.end.
+        if len(self.data) - self.end >= count:
+            return
+        used = self.end - self.start
+        if used + count > len(self.data):
+            # Leave room for a partial blob, which _splitbuf() can leave
+            # behind, so that the next read of the same size fits too.
+            data = bytearray(used + count + BLOB_MAX)
+        else:
+            data = self.data
+        data[0:used] = self.data[self.start:self.end]
+        self.data = data
+        self.start = 0
+        self.end = used
+
+    def put(self, s):
+        if self.map is not None:
+            self._unmap(None)
+        if s:
+            self._prepare(len(s))
+            self.data[self.end:self.end+len(s)] = s
+            self.end += len(s)
+
+    def fill(self, f, count):
+        """Read up to count bytes from f into the buffer.
+
+        Return the number of bytes read, which is 0 at EOF.
+        """
+        if f is not self.file:
+            if self.map is not None:
+                self._unmap(None)
+            self.file = f
+            if not self.used():
+                self._map(f)
+        if self.map is not None:
+            if os.fstat(f.fileno()).st_size == self.map_size:
+                n = min(count, self.map_size - self.end)
+                self.end += n
+                madvise_done(self.map, self.start)
+                return n
+            # The file changed size under us; read the rest of it.
+            self._unmap(f)
+        self._prepare(count)
+        readinto = getattr(f, 'readinto', None)
+        if readinto:
+            n = readinto(memoryview(self.data)[self.end:self.end+count])
+            self.end += n
+            return n
+        b = f.read(count)
+        self.put(b)
+        return len(b)
+
+    def peek(self, count):
+        return buffer(self.data, self.start, min(count, self.used()))
+
+    def eat(self, count):
+        self.start += count
+
+    def get(self, count):
+        v = self.peek(count)
+        self.start += len(v)
+        return v
+
+    def used(self):
+        return self.end - self.start
+
+    def release(self):
+        """Return the storage to the pool for the next Buf to reuse."""
+        if self.map is None and len(_free_bufs) < _MAX_FREE_BUFS:
+            _free_bufs.append(self.data)
+        self.data = bytearray()
+        self.map = self.file = None
+        self.start = self.end = 0
+
+
+def readfile_iter(files, buf, progress=None):
+    """Read each file in files into buf, BLOB_READ_SIZE bytes at a time.
+
+    Yield after every read so the caller can consume the buffer.
+    """
+    for filenum,f in enumerate(files):
+        ofs = 0
+        n = 0
+        while 1:
+            if progress:
+                progress(filenum, n)
+            n = buf.fill(f, BLOB_READ_SIZE)
+            ofs += n
+            # Warning: ofs == 0 means 'done with the whole file'
+            # This will only happen here when the file is empty
+            fadvise_done(f, ofs)
+            if not n:
+                break
+            yield n
+
+
+def _splitbuf(buf, basebits, fanbits):
+    while 1:
+        b = buf.peek(buf.used())
+        (ofs, bits) = _helpers.splitbuf(b)
+        if ofs:
+            if ofs > BLOB_MAX:
+                ofs = BLOB_MAX
+                level = 0
+            else:
+                level = (bits-basebits)//fanbits  # integer division
+            buf.eat(ofs)
+            yield buffer(b, 0, ofs), level
+        else:
+            break
+    while buf.used() >= BLOB_MAX:
+        # limit max blob size
+        yield buf.get(BLOB_MAX), 0
+
+
+def _find_bupsplit(b):
+    return _helpers.splitbuf_all(b, BLOB_MAX, blobbits)
+
+
+def _find_fastcdc(b):
+    return _helpers.fastcdc_splitbuf_all(b, BLOB_MAX, blobbits)
+
+
+# Each of these returns all the splits in a buffer, packed as described
+# for _helpers.splitbuf_all().
+CHUNKERS = {
+    'bupsplit': _find_bupsplit,  # the original rolling checksum
+    'fastcdc': _find_fastcdc,  # much faster, see lib/bup/fastcdc.c
+}
+
+# The blobbits each chunker can do well: bupsplit only has 16 well mixed
+# bits, and blobs have to fit comfortably in a BLOB_READ_SIZE read.
+_BLOBBITS_RANGE = {
+    'bupsplit': (10, 16),
+    'fastcdc': (10, 18),
+}
+_MAX_BLOB_MAX = BLOB_READ_SIZE // 2
+
+
+def _config_num(config_get, option, default, lo, hi):
+    v = config_get(option)
+    if v is None:
+        n = default
+    else:
+        try:
+            n = parse_num(v)
+        except ValueError:
+            n = None
+        if n is None or n != int(n):
+            raise ValueError('%s must be a whole number, not %r' % (option, v))
+        n = int(n)
+    if not lo <= n <= hi:
+        raise ValueError('%s must be between %d and %d, not %d'
+                         % (option, lo, hi, n))
+    return n
+
+
+def configure(config_get):
+    """Set up splitting the way the repository says it should be done.
+
+    config_get(name) must return the value of the repository's git config
+    option name, or None if it isn't set.  Raise ValueError if the
+    configuration isn't valid, leaving the current one alone.
+    """
+    global chunker, blobbits, BLOB_MAX, fanout, MAX_PER_TREE
+    name = config_get('bup.split.chunker') or 'bupsplit'
+    if name not in CHUNKERS:
+        raise ValueError('unknown bup.split.chunker %r (not one of %s)'
+                         % (name, ', '.join(sorted(CHUNKERS))))
+    lo, hi = _BLOBBITS_RANGE[name]
+    bits = _config_num(config_get, 'bup.split.blobbits',
+                       _helpers.blobbits(), lo, hi)
+    max_blob = _config_num(config_get, 'bup.split.maxblob',
+                           min(4 << bits, _MAX_BLOB_MAX),
+                           1 << bits, _MAX_BLOB_MAX)
+    fan = _config_num(config_get, 'bup.split.fanout', 16, 2, 1 << 16)
+    per_tree = _config_num(config_get, 'bup.split.treemax', 256, 2, 1 << 16)
+    chunker, blobbits, BLOB_MAX = name, bits, max_blob
+    fanout, MAX_PER_TREE = fan, per_tree
+
+
+def params():
+    """Return the current splitting configuration as a list of (option,
+    value) pairs, named and formatted the way configure() reads them."""
+    return [('bup.split.chunker', chunker),
+            ('bup.split.blobbits', str(blobbits)),
+            ('bup.split.maxblob', str(BLOB_MAX)),
+            ('bup.split.fanout', str(fanout)),
+            ('bup.split.treemax', str(MAX_PER_TREE))]
+
+
+def _splitbuf_all(buf, basebits, fanbits, find_splits):
+    # Same splits as _splitbuf(), but found in a single call to _helpers.
+    b = buf.peek(buf.used())
+    splits = array('I', find_splits(b))
+    ofs = 0
+    for i in xrange(0, len(splits), 2):
+        end, bits = splits[i], splits[i+1]
+        buf.eat(end - ofs)
+        yield buffer(b, ofs, end - ofs), (bits-basebits)//fanbits
+        ofs = end
+    while buf.used() >= BLOB_MAX:
+        # limit max blob size
+        yield buf.get(BLOB_MAX), 0
+
+
+def _hashsplit_iter(files, progress):
+    assert(BLOB_READ_SIZE > BLOB_MAX)
+    basebits = blobbits
+    fanbits = int(math.log(fanout or 128, 2))
+    if chunker == 'bupsplit' and _helpers.splitbuf is not _native_splitbuf:
+        # someone (eg. a test) replaced splitbuf
+        splitter = lambda buf: _splitbuf(buf, basebits, fanbits)
+    else:
+        find_splits = CHUNKERS[chunker]
+        splitter = lambda buf: _splitbuf_all(buf, basebits, fanbits,
+                                             find_splits)
+    buf = Buf()
+    try:
+        for n in readfile_iter(files, buf, progress):
+            for buf_and_level in splitter(buf):
+                yield buf_and_level
+        if buf.used():
+            yield buf.get(buf.used()), 0
+    finally:
+        buf.release()
+
+
+def _hashsplit_iter_keep_boundaries(files, progress):
+    for real_filenum,f in enumerate(files):
+        if progress:
+            def prog(filenum, nbytes):
+                # the inner _hashsplit_iter doesn't know the real file count,
+                # so we'll replace it here.
+                return progress(real_filenum, nbytes)
+        else:
+            prog = None
+        for buf_and_level in _hashsplit_iter([f], progress=prog):
+            yield buf_and_level
+
+
+def hashsplit_iter(files, keep_boundaries, progress):
+    if keep_boundaries:
+        return _hashsplit_iter_keep_boundaries(files, progress)
+    else:
+        return _hashsplit_iter(files, progress)
+
+
+def read_blobs(files, keep_boundaries=False):
+    """Split files and return their blobs as a list of (data, level).
+
+    Nothing is written, and the data is copied out of the read buffer, so
+    this can run ahead of the writer on another thread.  Pass the result
+    to blobs_to_blob_or_tree() to store it.
+    """
+    return [(str(blob), level)
+            for blob, level in hashsplit_iter(files, keep_boundaries, None)]
+
+
+total_split = 0
+def split_to_blobs(makeblob, files, keep_boundaries, progress):
+    return _write_blobs(makeblob,
+                        hashsplit_iter(files, keep_boundaries, progress))
+
+
+def _write_blobs(makeblob, blobs, makeblobs=None):
+    global total_split
+    if makeblobs:
+        shas = iter(makeblobs([blob for (blob, level) in blobs]))
+        makeblob = lambda blob: next(shas)
+    for (blob, level) in blobs:
+        sha = makeblob(blob)
+        total_split += len(blob)
+        if progress_callback:
+            progress_callback(len(blob))
+        yield (sha, len(blob), level)
+
+
+def _make_shalist(l):
+    ofs = 0
+    l = list(l)
+    total = sum(size for mode,sha,size, in l)
+    vlen = len('%x' % total)
+    shalist = []
+    for (mode, sha, size) in l:
+        shalist.append((mode, '%0*x' % (vlen,ofs), sha))
+        ofs += size
+    assert(ofs == total)
+    return (shalist, total)
+
+
+def _squish(maketree, stacks, n):
+    i = 0
+    while i < n or len(stacks[i]) >= MAX_PER_TREE:
+        while len(stacks) <= i+1:
+            stacks.append([])
+        if len(stacks[i]) == 1:
+            stacks[i+1] += stacks[i]
+        elif stacks[i]:
+            (shalist, size) = _make_shalist(stacks[i])
+            tree = maketree(shalist)
+            stacks[i+1].append((GIT_MODE_TREE, tree, size))
+        stacks[i] = []
+        i += 1
+
+
+def split_to_shalist(makeblob, maketree, files,
+                     keep_boundaries, progress=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+    return _shalist(maketree, sl)
+
+
+def _shalist(maketree, sl):
+    assert(fanout != 0)
+    if not fanout:
+        shal = []
+        for (sha,size,level) in sl:
+            shal.append((GIT_MODE_FILE, sha, size))
+        return _make_shalist(shal)[0]
+    else:
+        stacks = [[]]
+        for (sha,size,level) in sl:
+            stacks[0].append((GIT_MODE_FILE, sha, size))
+            _squish(maketree, stacks, level)
+        #log('stacks: %r\n' % [len(i) for i in stacks])
+        _squish(maketree, stacks, len(stacks)-1)
+        #log('stacks: %r\n' % [len(i) for i in stacks])
+        return _make_shalist(stacks[-1])[0]
+
+
+def split_to_blob_or_tree(makeblob, maketree, files,
+                          keep_boundaries, progress=None):
+    shalist = list(split_to_shalist(makeblob, maketree,
+                                    files, keep_boundaries, progress))
+    return _blob_or_tree(makeblob, maketree, shalist)
+
+
+def blobs_to_blob_or_tree(makeblob, maketree, blobs, makeblobs=None):
+    """Like split_to_blob_or_tree(), for blobs returned by read_blobs().
+
+    If makeblobs is given, it's called once with the list of all the blobs'
+    contents, and must return the list of their ids, instead of calling
+    makeblob for each of them.
+    """
+    shalist = list(_shalist(maketree,
+                            _write_blobs(makeblob, blobs, makeblobs)))
+    return _blob_or_tree(makeblob, maketree, shalist)
+
+
+def _blob_or_tree(makeblob, maketree, shalist):
+    if len(shalist) == 1:
+        return (shalist[0][0], shalist[0][2])
+    elif len(shalist) == 0:
+        return (GIT_MODE_FILE, makeblob(''))
+    else:
+        return (GIT_MODE_TREE, maketree(shalist))
+
+
+def open_noatime(name):
+    fd = _helpers.open_noatime(name)
+    try:
+        return os.fdopen(fd, 'rb', 1024*1024)
+    except:
+        try:
+            os.close(fd)
+        except:
+            pass
+        raise
+
+
+def fadvise_done(f, ofs):
+    assert(ofs >= 0)
+    if ofs > 0 and hasattr(f, 'fileno'):
+        _helpers.fadvise_done(f.fileno(), ofs)
+
+
+def fadvise_willneed(name, count):
+    if count > 0:
+        _helpers.fadvise_willneed(name, count)
+
+
+def madvise_done(m, ofs):
+    assert(ofs >= 0)
+    if ofs > 0:
+        _helpers.madvise_done(m, ofs)
@@ -0,0 +1,140 @@
+import mmap, math, tempfile
+from array import array
+from bup import _helpers
+from bup.helpers import *
+
+MIDX_VERSION = 4
+SHA_PER_PAGE = 4096/20.
+
+extract_bits = _helpers.extract_bits
+_total_searches = 0
+_total_steps = 0
+
+
+class PackMidx:
+    """Wrapper which contains data from multiple index files.
+    Multiple index (.midx) files constitute a wrapper around index (.idx) files
+    and make it possible for bup to expand Git's indexing capabilities to vast
+    amounts of files.
+    """
+    def __init__(self, filename, map=None):
+        self.name = filename
+        self.force_keep = False
+        self.map = None
+        assert(filename.endswith('.midx'))
+        self.map = map or mmap_read(open(filename))
+        if str(self.map[0:4]) != 'MIDX':
+            log('Warning: skipping: invalid MIDX header in %r\n' % filename)
+            self.force_keep = True
+            return self._init_failed()
+        ver = struct.unpack('!I', self.map[4:8])[0]
+        if ver < MIDX_VERSION:
+            log('Warning: ignoring old-style (v%d) midx %r\n' 
+                % (ver, filename))
+            self.force_keep = False  # old stuff is boring  
+            return self._init_failed()
+        if ver > MIDX_VERSION:
+            log('Warning: ignoring too-new (v%d) midx %r\n'
+                % (ver, filename))
+            self.force_keep = True  # new stuff is exciting
+            return self._init_failed()
+
+        self.bits = _helpers.firstword(self.map[8:12])
+        self.entries = 2**self.bits
+        self.fanout = buffer(self.map, 12, self.entries*4)
+        self.sha_ofs = 12 + self.entries*4
+        self.nsha = nsha = self._fanget(self.entries-1)
+        self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
+        self.which_ofs = self.sha_ofs + 20*nsha
+        self.whichlist = buffer(self.map, self.which_ofs, nsha*4)
+        self.idxnames = str(self.map[self.which_ofs + 4*nsha:]).split('\0')
+
+    def __del__(self):
+        self.close()
+
+    def _init_failed(self):
+        self.bits = 0
+        self.entries = 1
+        self.fanout = buffer('\0\0\0\0')
+        self.shatable = buffer('\0'*20)
+        self.idxnames = []
+
+    def _fanget(self, i):
+        start = i*4
+        s = self.fanout[start:start+4]
+        return _helpers.firstword(s)
+
+    def _get_idx_i(self, i):
+        return struct.unpack('!I', self.whichlist[i*4:(i+1)*4])[0]
+
+    def _get_idxname(self, i):
+        return self.idxnames[self._get_idx_i(i)]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object exists in the index files."""
+        global _total_searches, _total_steps
+        _total_searches += 1
+        idx, steps = _helpers.midx_find_sha(self.shatable, self.fanout,
+                                            self.bits, str(hash))
+        _total_steps += steps
+        if idx is None:
+            return None
+        return want_source and self._get_idxname(idx) or True
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of hashes."""
+        shas = sorted(set(str(h) for h in hashes))
+        found = dict((shas[n], want_source and self._source(i) or True)
+                     for n, i in self._find_sorted(''.join(shas)))
+        return [found.get(str(h)) for h in hashes]
+
+    def _find_sorted(self, shas):
+        """Return an (n, index) pair for each of the concatenated sorted
+        shas that's in the midx, where it's the nth of them."""
+        found = array('i', _helpers.find_shas(self.shatable, 20, len(self),
+                                              shas))
+        return zip(found[::2], found[1::2])
+
+    def _source(self, idx):
+        return self._get_idxname(idx)
+
+    def __iter__(self):
+        for i in xrange(self._fanget(self.entries-1)):
+            yield buffer(self.shatable, i*20, 20)
+
+    def __len__(self):
+        return int(self._fanget(self.entries-1))
+
+
+
+
+def merge(name, ixs):
+    """Return a PackMidx called name holding all the objects of the
+    (non-empty, version 2) PackIdxs in ixs.
+
+    Nothing is written to name; the midx lives in an unlinked temporary
+    file, so it goes away with the PackMidx.  That file takes 24 bytes
+    per object, so it's up to the caller to keep ixs small enough.
+    """
+    total = sum(len(ix) for ix in ixs)
+    pages = int(total/SHA_PER_PAGE) or 1
+    bits = int(math.ceil(math.log(pages, 2)))
+    names = '\0'.join(os.path.basename(ix.name) for ix in ixs)
+    names_ofs = 12 + 4*2**bits + 24*total
+    f = tempfile.TemporaryFile()
+    f.write('MIDX')
+    f.write(struct.pack('!II', MIDX_VERSION, bits))
+    f.truncate(names_ofs + len(names))
+    f.flush()
+    map = mmap_readwrite(f)
+    # merge_into wants them in descending order of their first sha.
+    inp = [(ix.map, len(ix), ix.sha_ofs, 0, i) for i, ix in enumerate(ixs)]
+    inp.sort(key=lambda x: str(x[0][x[2]:x[2]+20]), reverse=True)
+    _helpers.merge_into(map, bits, total, inp, False)
+    map[names_ofs:] = names
+    return PackMidx(name, map)
@@ -0,0 +1,755 @@
+"""Virtual File System representing bup's repository contents.
+
+The vfs.py library makes it possible to expose contents from bup's repository
+and abstracts internal name mangling and storage from the exposition layer.
+"""
+import os, re, stat, time, bisect
+from cStringIO import StringIO
+from bup import git, metadata, commitgraph
+from helpers import *
+from bup.git import BUP_NORMAL, BUP_CHUNKED, cp
+from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
+
+EMPTY_SHA='\0'*20
+CHUNK_INDEX_MAX = 16*1024*1024  # bytes of chunk tree offsets to keep
+DIR_CACHE_MAX = 200000  # directory entries to keep nodes for
+BUPM_INDEX_MAX = 16*1024*1024  # bytes of indexed .bupm files to keep
+PATH_CACHE_MAX = 10000  # resolved paths to keep, for each RefList
+
+
+class NodeError(Exception):
+    """VFS base exception."""
+    pass
+
+class NoSuchFile(NodeError):
+    """Request of a file that does not exist."""
+    pass
+
+class NotDir(NodeError):
+    """Attempt to do a directory action on a file that is not one."""
+    pass
+
+class NotFile(NodeError):
+    """Access to a node that does not represent a file."""
+    pass
+
+class TooManySymlinks(NodeError):
+    """Symlink dereferencing level is too deep."""
+    pass
+
+
+def _tree_decode(hash, repo_dir=None):
+    tree = [(int(name,16),stat.S_ISDIR(mode),sha)
+            for (mode,name,sha)
+            in git.read_tree(hash, repo_dir)]
+    assert(tree == list(sorted(tree)))
+    return tree
+
+
+def _chunk_len(hash, repo_dir=None):
+    return sum(len(b) for b in cp(repo_dir).join(hash.encode('hex')))
+
+
+def _last_chunk_info(hash, repo_dir=None):
+    tree = _tree_decode(hash, repo_dir)
+    assert(tree)
+    (ofs,isdir,sha) = tree[-1]
+    if isdir:
+        (subofs, sublen) = _last_chunk_info(sha, repo_dir)
+        return (ofs+subofs, sublen)
+    else:
+        return (ofs, _chunk_len(sha))
+
+
+def _total_size(hash, repo_dir=None):
+    (lastofs, lastsize) = _last_chunk_info(hash, repo_dir)
+    return lastofs + lastsize
+
+
+def _chunk_level_size(level):
+    # the offset, the sha and the subtree flag of each entry
+    return len(level[0]) * 64
+
+# The offsets of the entries of the chunk trees of files, by tree sha.
+_chunk_levels = LRUCache(CHUNK_INDEX_MAX, _chunk_level_size)
+
+def _chunk_level(hash, repo_dir=None):
+    """Return the offsets of the entries of the chunk tree hash, whether
+    each is a subtree (as a string of '\\0' or '\\1'), and their shas (all
+    in one string)."""
+    level = _chunk_levels.get(hash)
+    if level is None:
+        tree = _tree_decode(hash, repo_dir)
+        level = ([ofs for (ofs,isdir,sha) in tree],
+                 ''.join(isdir and '\1' or '\0' for (ofs,isdir,sha) in tree),
+                 ''.join(sha for (ofs,isdir,sha) in tree))
+        _chunk_levels.put(hash, level)
+    return level
+
+
+def _find_chunk(tree, ofs, repo_dir=None):
+    """Find the chunk that holds ofs, starting from tree, which is a chunk
+    tree of a file as (_chunk_level(), where it starts in the file, where
+    it ends or None at the end of the file).  Return the same for the tree
+    that the chunk is in, and the chunk's index in it."""
+    (level, start, end) = tree
+    while 1:
+        (offsets, isdirs, shas) = level
+        assert(offsets)
+        # each entry's offset is from the start of its tree
+        i = max(bisect.bisect_right(offsets, ofs - start) - 1, 0)
+        if isdirs[i] == '\0':
+            return ((level, start, end), i)
+        if i + 1 < len(offsets):
+            end = start + offsets[i+1]
+        start += offsets[i]
+        level = _chunk_level(shas[i*20 : i*20+20], repo_dir)
+
+
+class _FileReader(object):
+    def __init__(self, hash, size, isdir, repo_dir=None):
+        self.hash = hash
+        self.ofs = 0
+        self.size = size
+        self.isdir = isdir
+        self._chunk = None  # (sha, offset, content) of the last chunk read
+        self._tree = None  # the chunk tree of the last chunk read
+        self._repo_dir = repo_dir
+
+    def seek(self, ofs):
+        if ofs > self.size:
+            self.ofs = self.size
+        elif ofs < 0:
+            self.ofs = 0
+        else:
+            self.ofs = ofs
+
+    def tell(self):
+        return self.ofs
+
+    def _chunk_at(self, ofs):
+        chunk = self._chunk
+        if chunk and chunk[1] <= ofs < chunk[1] + len(chunk[2]):
+            return chunk
+        if self.isdir:
+            # Reads mostly go on from where the last one stopped, so the
+            # next chunk is likely in the same tree.
+            tree = self._tree
+            if (not tree or ofs < tree[1]
+                or (tree[2] is not None and ofs >= tree[2])):
+                tree = (_chunk_level(self.hash, self._repo_dir), 0, None)
+            (tree, i) = _find_chunk(tree, ofs, self._repo_dir)
+            self._tree = tree
+            ((offsets, isdirs, shas), start, end) = tree
+            start += offsets[i]
+            sha = shas[i*20 : i*20+20]
+        else:
+            (sha, start) = (self.hash, 0)
+        it = cp(self._repo_dir).get(sha.encode('hex'))
+        type = it.next()
+        assert(type == 'blob')
+        self._chunk = chunk = (sha, start, ''.join(it))
+        return chunk
+
+    def read(self, count = -1):
+        if count < 0 or count > self.size - self.ofs:
+            count = self.size - self.ofs
+        out = []
+        while count > 0:
+            (sha, start, content) = self._chunk_at(self.ofs)
+            pos = self.ofs - start
+            buf = content[pos : pos+count]
+            if not buf:
+                break  # the file is shorter than its size said
+            out.append(buf)
+            self.ofs += len(buf)
+            count -= len(buf)
+        debug2('read() returned %d\n' % sum(len(buf) for buf in out))
+        return ''.join(out)
+
+    def close(self):
+        pass
+
+
+def _release_node(key, node):
+    node.release()
+
+# The nodes whose children have been listed, sized by how many there are.
+# Those that haven't been used for a while are released, and will list
+# them again if they're needed.
+_dir_cache = LRUCache(DIR_CACHE_MAX, lambda node: len(node._subs) + 1,
+                      _release_node)
+
+
+class Node(object):
+    """Base class for file representation."""
+    __slots__ = ('parent', 'name', 'mode', 'hash', 'ctime', 'mtime', 'atime',
+                 '_repo_dir', '_subs', '_metadata')
+
+    def __init__(self, parent, name, mode, hash, repo_dir=None):
+        self.parent = parent
+        self.name = intern(name)  # the same names come up in every save
+        self.mode = mode
+        self.hash = hash
+        self.ctime = self.mtime = self.atime = 0
+        self._repo_dir = repo_dir
+        self._subs = None
+        self._metadata = None
+
+    def __repr__(self):
+        return "<%s object at %s - name:%r hash:%s parent:%r>" \
+            % (self.__class__, hex(id(self)),
+               self.name, self.hash.encode('hex'),
+               self.parent.name if self.parent else None)
+
+    def __cmp__(a, b):
+        if a is b:
+            return 0
+        return (cmp(a and a.parent, b and b.parent) or
+                cmp(a and a.name, b and b.name))
+
+    def __iter__(self):
+        return iter(self.subs())
+
+    def fullname(self, stop_at=None):
+        """Get this file's full path."""
+        assert(self != stop_at)  # would be the empty string; too weird
+        if self.parent and self.parent != stop_at:
+            return os.path.join(self.parent.fullname(stop_at=stop_at),
+                                self.name)
+        else:
+            return self.name
+
+    def _mksubs(self):
+        self._subs = {}
+
+    def _mksub(self, name, entry):
+        """Make the node for name from the entry _mksubs() left for it."""
+        raise NotImplementedError
+
+    def _getsubs(self):
+        subs = self._subs
+        if subs == None:
+            self._mksubs()
+            subs = self._subs
+            _dir_cache.put(id(self), self)
+        else:
+            _dir_cache.get(id(self))
+        return subs
+
+    def _node(self, subs, name):
+        n = subs[name]
+        if isinstance(n, tuple):
+            n = subs[name] = self._mksub(name, n)
+        return n
+
+    def subs(self):
+        """Get a list of nodes that are contained in this node."""
+        subs = self._getsubs()
+        return [self._node(subs, name) for name in sorted(subs)]
+
+    def sub(self, name):
+        """Get node named 'name' that is contained in this node."""
+        subs = self._getsubs()
+        if name not in subs:
+            raise NoSuchFile("no file %r in %r" % (name, self.name))
+        return self._node(subs, name)
+
+    def top(self):
+        """Return the very top node of the tree."""
+        if self.parent:
+            return self.parent.top()
+        else:
+            return self
+
+    def fs_top(self):
+        """Return the top node of the particular backup set.
+
+        If this node isn't inside a backup set, return the root level.
+        """
+        if self.parent and not isinstance(self.parent, CommitList):
+            return self.parent.fs_top()
+        else:
+            return self
+
+    def _lresolve(self, parts):
+        #debug2('_lresolve %r in %r\n' % (parts, self.name))
+        if not parts:
+            return self
+        (first, rest) = (parts[0], parts[1:])
+        if first == '.':
+            return self._lresolve(rest)
+        elif first == '..':
+            if not self.parent:
+                raise NoSuchFile("no parent dir for %r" % self.name)
+            return self.parent._lresolve(rest)
+        elif rest:
+            return self.sub(first)._lresolve(rest)
+        else:
+            return self.sub(first)
+
+    def lresolve(self, path, stay_inside_fs=False):
+        """Walk into a given sub-path of this node.
+
+        If the last element is a symlink, leave it as a symlink, don't resolve
+        it.  (like lstat())
+        """
+        start = self
+        if not path:
+            return start
+        if path.startswith('/'):
+            if stay_inside_fs:
+                start = self.fs_top()
+            else:
+                start = self.top()
+            path = path[1:]
+        parts = re.split(r'/+', path or '.')
+        if not parts[-1]:
+            parts[-1] = '.'
+        #debug2('parts: %r %r\n' % (path, parts))
+        return start._lresolve(parts)
+
+    def resolve(self, path = ''):
+        """Like lresolve(), and dereference it if it was a symlink."""
+        return self.lresolve(path).lresolve('.')
+
+    def try_resolve(self, path = ''):
+        """Like resolve(), but don't worry if a symlink uses an invalid path.
+
+        Returns an error if any intermediate nodes were invalid.
+        """
+        n = self.lresolve(path)
+        try:
+            n = n.lresolve('.')
+        except NoSuchFile:
+            pass
+        return n
+
+    def nlinks(self):
+        """Get the number of hard links to the current node."""
+        return 1
+
+    def size(self):
+        """Get the size of the current node."""
+        return 0
+
+    def open(self):
+        """Open the current node. It is an error to open a non-file node."""
+        raise NotFile('%s is not a regular file' % self.name)
+
+    def _sub_metadata(self, name):
+        # Only Dirs contain .bupm files, so by default, there's nothing.
+        return None
+
+    def metadata(self):
+        """Return this Node's Metadata() object, if any."""
+        if not self._metadata and self.parent:
+            self._metadata = self.parent._sub_metadata(self.name)
+        return self._metadata
+
+    def release(self):
+        """Release resources that can be automatically restored (at a cost)."""
+        self._metadata = None
+        self._subs = None
+
+
+class File(Node):
+    """A normal file from bup's repository."""
+    __slots__ = ('bupmode', '_cached_size', '_filereader')
+
+    def __init__(self, parent, name, mode, hash, bupmode, repo_dir=None):
+        Node.__init__(self, parent, name, mode, hash, repo_dir)
+        self.bupmode = bupmode
+        self._cached_size = None
+        self._filereader = None
+
+    def open(self):
+        """Open the file."""
+        # You'd think FUSE might call this only once each time a file is
+        # opened, but no; it's really more of a refcount, and it's called
+        # once per read().  Thus, it's important to cache the filereader
+        # object here so we're not constantly re-seeking.
+        if not self._filereader:
+            self._filereader = _FileReader(self.hash, self.size(),
+                                           self.bupmode == git.BUP_CHUNKED,
+                                           repo_dir = self._repo_dir)
+        self._filereader.seek(0)
+        return self._filereader
+
+    def size(self):
+        """Get this file's size."""
+        if self._cached_size == None:
+            debug1('<<<<File.size() is calculating (for %r)...\n' % self.name)
+            if self.bupmode == git.BUP_CHUNKED:
+                self._cached_size = _total_size(self.hash,
+                                                repo_dir = self._repo_dir)
+            else:
+                self._cached_size = _chunk_len(self.hash,
+                                               repo_dir = self._repo_dir)
+            debug1('<<<<File.size() done.\n')
+        return self._cached_size
+
+
+_symrefs = 0
+class Symlink(File):
+    """A symbolic link from bup's repository."""
+    __slots__ = ()
+
+    def __init__(self, parent, name, hash, bupmode, repo_dir=None):
+        File.__init__(self, parent, name, 0120000, hash, bupmode,
+                      repo_dir = repo_dir)
+
+    def size(self):
+        """Get the file size of the file at which this link points."""
+        return len(self.readlink())
+
+    def readlink(self):
+        """Get the path that this link points at."""
+        return ''.join(cp(self._repo_dir).join(self.hash.encode('hex')))
+
+    def dereference(self):
+        """Get the node that this link points at.
+
+        If the path is invalid, raise a NoSuchFile exception. If the level of
+        indirection of symlinks is 100 levels deep, raise a TooManySymlinks
+        exception.
+        """
+        global _symrefs
+        if _symrefs > 100:
+            raise TooManySymlinks('too many levels of symlinks: %r'
+                                  % self.fullname())
+        _symrefs += 1
+        try:
+            try:
+                return self.parent.lresolve(self.readlink(),
+                                            stay_inside_fs=True)
+            except NoSuchFile:
+                raise NoSuchFile("%s: broken symlink to %r"
+                                 % (self.fullname(), self.readlink()))
+        finally:
+            _symrefs -= 1
+
+    def _lresolve(self, parts):
+        return self.dereference()._lresolve(parts)
+
+
+class FakeSymlink(Symlink):
+    """A symlink that is not stored in the bup repository."""
+    __slots__ = ('toname',)
+
+    def __init__(self, parent, name, toname, repo_dir=None):
+        Symlink.__init__(self, parent, name, EMPTY_SHA, git.BUP_NORMAL,
+                         repo_dir = repo_dir)
+        self.toname = toname
+
+    def readlink(self):
+        """Get the path that this link points at."""
+        return self.toname
+
+
+def _bupm_index_size(index):
+    (content, offsets, names) = index
+    return len(content) + len(offsets) * 8 + sum(len(n) for n in names)
+
+# The .bupm of each Dir, by tree sha: its content, where each record
+# starts, and the (sorted) names of the entries that have one.
+_bupm_indexes = LRUCache(BUPM_INDEX_MAX, _bupm_index_size)
+
+
+class Dir(Node):
+    """A directory stored inside of bup's repository."""
+    __slots__ = ('_bupm',)
+
+    def __init__(self, *args, **kwargs):
+        Node.__init__(self, *args, **kwargs)
+        self._bupm = None
+
+    def _bupm_index(self):
+        index = _bupm_indexes.get(self.hash)
+        if index is None:
+            bupm = self.metadata_file()
+            if not bupm:
+                return None
+            content = bupm.open().read()
+            # The first record is the directory's own, then there's one
+            # for each entry that isn't a directory, in name order.
+            # Only find where each starts; they're decoded when needed.
+            port = StringIO(content)
+            offsets = []
+            while port.tell() < len(content):
+                offsets.append(port.tell())
+                metadata.Metadata.skip(port)
+            names = sorted(name for (name, n) in self._getsubs().iteritems()
+                           if not stat.S_ISDIR(isinstance(n, tuple)
+                                               and n[0] or n.mode))
+            index = (content, offsets, names)
+            _bupm_indexes.put(self.hash, index)
+        return index
+
+    def _read_metadata(self, i):
+        """Decode record i of the .bupm, if there is one."""
+        index = self._bupm_index()
+        if not index:
+            return None
+        (content, offsets, names) = index
+        if i >= len(offsets):
+            return None
+        port = StringIO(content)
+        port.seek(offsets[i])
+        return metadata.Metadata.read(port)
+
+    def _sub_metadata(self, name):
+        index = self._bupm_index()
+        if not index:
+            return None
+        names = index[2]
+        i = bisect.bisect_left(names, name)
+        if i == len(names) or names[i] != name:
+            return None
+        return self._read_metadata(i + 1)
+
+    def _mksubs(self):
+        # The nodes are only made when they're asked for; until then, each
+        # name just has its entry.
+        self._subs = {}
+        for (mode,mangled_name,sha) in git.read_tree(self.hash,
+                                                     self._repo_dir):
+            if mangled_name == '.bupm':
+                bupmode = stat.S_ISDIR(mode) and BUP_CHUNKED or BUP_NORMAL
+                self._bupm = File(self, mangled_name, GIT_MODE_FILE, sha,
+                                  bupmode)
+                continue
+            (name,bupmode) = git.demangle_name(mangled_name)
+            if bupmode == git.BUP_CHUNKED:
+                mode = GIT_MODE_FILE
+            self._subs[name] = (mode, sha, bupmode)
+
+    def _mksub(self, name, entry):
+        (mode, sha, bupmode) = entry
+        if stat.S_ISDIR(mode):
+            return Dir(self, name, mode, sha, self._repo_dir)
+        elif stat.S_ISLNK(mode):
+            return Symlink(self, name, sha, bupmode, self._repo_dir)
+        else:
+            return File(self, name, mode, sha, bupmode, self._repo_dir)
+
+    def metadata(self):
+        """Return this Dir's Metadata() object, if any."""
+        if not self._metadata:
+            self._metadata = self._read_metadata(0)
+        return self._metadata
+
+    def metadata_file(self):
+        """Return this Dir's .bupm File, if any."""
+        self._getsubs()
+        return self._bupm
+
+    def release(self):
+        """Release restorable resources held by this node."""
+        self._bupm = None
+        super(Dir, self).release()
+
+
+def _commit_date(sha, repo_dir):
+    c = commitgraph.graph(repo_dir).get(sha)
+    if c:
+        return c.date
+    return git.get_commit_dates([sha.encode('hex')], repo_dir=repo_dir)[0]
+
+
+class CommitDir(Node):
+    """A directory that contains all commits that are reachable by a ref.
+
+    Contains a set of subdirectories named after the commits' first byte in
+    hexadecimal. Each of those directories contain all commits with hashes that
+    start the same as the directory name. The name used for those
+    subdirectories is the hash of the commit without the first byte. This
+    separation helps us avoid having too much directories on the same level as
+    the number of commits grows big.
+    """
+    __slots__ = ()
+
+    def __init__(self, parent, name, repo_dir=None):
+        Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
+
+    def _mksubs(self):
+        self._subs = {}
+        tips = [sha for (name, sha) in git.list_refs(repo_dir=self._repo_dir)]
+        g = commitgraph.graph(self._repo_dir)
+        g.update(tips)
+        for (date, commit) in g.history(tips):
+            commithex = commit.encode('hex')
+            containername = commithex[:2]
+            dirname = commithex[2:]
+            n1 = self._subs.get(containername)
+            if not n1:
+                n1 = CommitList(self, containername, self._repo_dir)
+                self._subs[containername] = n1
+            n1.commits[dirname] = (commit, date)
+
+
+class CommitList(Node):
+    """A list of commits with hashes that start with the current node's name."""
+    __slots__ = ('commits',)
+
+    def __init__(self, parent, name, repo_dir=None):
+        Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
+        self.commits = {}
+
+    def _mksubs(self):
+        self._subs = dict(self.commits)
+
+    def _mksub(self, name, entry):
+        (hash, date) = entry
+        n1 = Dir(self, name, GIT_MODE_TREE, hash, self._repo_dir)
+        n1.ctime = n1.mtime = date
+        return n1
+
+
+class TagDir(Node):
+    """A directory that contains all tags in the repository."""
+    __slots__ = ()
+
+    def __init__(self, parent, name, repo_dir = None):
+        Node.__init__(self, parent, name, GIT_MODE_TREE, EMPTY_SHA, repo_dir)
+
+    def _mksubs(self):
+        self._subs = {}
+        tags = [(name[10:], sha) for (name, sha)
+                in git.list_refs(repo_dir=self._repo_dir)
+                if name.startswith('refs/tags/')]
+        commitgraph.graph(self._repo_dir).update([sha for (name, sha) in tags])
+        for (name, sha) in tags:
+            date = _commit_date(sha, self._repo_dir)
+            commithex = sha.encode('hex')
+            target = '../.commit/%s/%s' % (commithex[:2], commithex[2:])
+            tag1 = FakeSymlink(self, name, target, repo_dir, self._repo_dir)
+            tag1.ctime = tag1.mtime = date
+            self._subs[name] = tag1
+
+
+class BranchList(Node):
+    """A list of links to commits reachable by a branch in bup's repository.
+
+    Represents each commit as a symlink that points to the commit directory in
+    /.commit/??/ . The symlink is named after the commit date.
+    """
+    __slots__ = ()
+
+    def __init__(self, parent, name, hash, repo_dir=None):
+        Node.__init__(self, parent, name, GIT_MODE_TREE, hash, repo_dir)
+
+    def _mksubs(self):
+        self._subs = {}
+
+        tags = git.tags(repo_dir = self._repo_dir)
+
+        g = commitgraph.graph(self._repo_dir)
+        g.update([self.hash])
+        revs = list(g.history([self.hash]))
+        latest = revs[0]
+        for (date, commit) in revs:
+            l = time.localtime(date)
+            ls = time.strftime('%Y-%m-%d-%H%M%S', l)
+            commithex = commit.encode('hex')
+            target = '../.commit/%s/%s' % (commithex[:2], commithex[2:])
+            n1 = FakeSymlink(self, ls, target, self._repo_dir)
+            n1.ctime = n1.mtime = date
+            self._subs[ls] = n1
+
+            for tag in tags.get(commit, []):
+                t1 = FakeSymlink(self, tag, target, self._repo_dir)
+                t1.ctime = t1.mtime = date
+                self._subs[tag] = t1
+
+        (date, commit) = latest
+        commithex = commit.encode('hex')
+        target = '../.commit/%s/%s' % (commithex[:2], commithex[2:])
+        n1 = FakeSymlink(self, 'latest', target, self._repo_dir)
+        n1.ctime = n1.mtime = date
+        self._subs['latest'] = n1
+
+
+class RefList(Node):
+    """A list of branches in bup's repository.
+
+    The sub-nodes of the ref list are a series of CommitList for each commit
+    hash pointed to by a branch.
+
+    Also, a special sub-node named '.commit' contains all commit directories
+    that are reachable via a ref (e.g. a branch).  See CommitDir for details.
+
+    The paths that are resolved from here are remembered, whether they were
+    found or not, until the refs change.
+    """
+    __slots__ = ('_paths', '_refs_files', '_refs_stamp')
+
+    def __init__(self, parent, repo_dir=None):
+        Node.__init__(self, parent, '/', GIT_MODE_TREE, EMPTY_SHA, repo_dir)
+        self._paths = LRUCache(PATH_CACHE_MAX, lambda n: 1)
+        # Updating, adding or removing a ref (or packing them) changes
+        # the mtime of one of these.
+        self._refs_files = [git.repo(name, repo_dir) for name
+                            in ('refs/heads', 'refs/tags', 'packed-refs')]
+        self._refs_stamp = None
+
+    def _check_refs(self):
+        stamp = []
+        for name in self._refs_files:
+            try:
+                stamp.append(os.stat(name).st_mtime)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                stamp.append(None)
+        if stamp != self._refs_stamp:
+            if self._refs_stamp is not None:
+                self._paths.clear()
+                self.release()
+            self._refs_stamp = stamp
+
+    def _lresolve(self, parts):
+        self._check_refs()
+        key = tuple(parts)
+        # Start from the longest part of the path that's known.
+        i = len(key)
+        while i > 0:
+            n = self._paths.get(key[:i])
+            if n is not None:
+                break
+            i -= 1
+        else:
+            n = self
+        if isinstance(n, NoSuchFile):
+            raise n
+        try:
+            for j in xrange(i, len(key)):
+                if n is self:
+                    n = Node._lresolve(self, key[j:j+1])
+                else:
+                    n = n._lresolve(key[j:j+1])
+                self._paths.put(key[:j+1], n)
+        except NoSuchFile, e:
+            self._paths.put(key, e)
+            raise
+        return n
+
+    def _mksubs(self):
+        self._subs = {}
+
+        commit_dir = CommitDir(self, '.commit', self._repo_dir)
+        self._subs['.commit'] = commit_dir
+
+        tag_dir = TagDir(self, '.tag', self._repo_dir)
+        self._subs['.tag'] = tag_dir
+
+        refs_info = [(name[11:], sha) for (name,sha)
+                     in git.list_refs(repo_dir=self._repo_dir)
+                     if name.startswith('refs/heads/')]
+        commitgraph.graph(self._repo_dir).update([sha for (name, sha)
+                                                  in refs_info])
+        for (name, sha) in refs_info:
+            date = _commit_date(sha, self._repo_dir)
+            n1 = BranchList(self, name, sha, self._repo_dir)
+            n1.ctime = n1.mtime = date
+            self._subs[name] = n1
@@ -125,6 +125,17 @@ a
 WVPASS bup save -r ":$BUP_DIR" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
+WVPASS bup index -u --fake-invalid $D
+tree1=$(WVPASS bup save -t $D) || exit $?
+WVPASS bup index -u --fake-invalid $D
+WVPASSEQ "$(WVPASS bup save -t --split-jobs=4 $D)" "$tree1"
+WVPASS bup index -u --fake-invalid $D
+WVPASSEQ "$(WVPASS bup save -t --readahead=32M $D)" "$tree1"
+
+WVSTART "bench"
+WVPASS bup bench -s 1M -n 100 -f 10 -r 1 --json > bench.tmp
+WVPASSEQ "$(grep -c '"unit": ' bench.tmp)" 18
+WVFAIL bup bench no-such-benchmark
 
 WVSTART "split"
 WVPASS echo a >a.tmp
@@ -192,10 +203,19 @@ WVPASS bup bloom -d "$BUP_DIR"/objects/pack --ruin --force
 WVFAIL bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx|head -n1)
 WVPASS bup bloom --force -k 5
 WVPASS bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx|head -n1)
+WVPASS bup bloom --format 3
+WVPASS bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx|head -n1)
+WVPASS bup bloom -d "$BUP_DIR"/objects/pack --ruin
+WVFAIL bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx|head -n1)
+WVPASS bup bloom --force -k 9
+WVPASS bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx|head -n1)
+WVFAIL bup bloom --format 4
+WVFAIL bup bloom --format 2 -k 9
 
 WVSTART "memtest"
 WVPASS bup memtest -c1 -n100
 WVPASS bup memtest -c1 -n100 --existing
+WVPASS bup memtest -c1 -n100 --bloom
 
 WVSTART "join"
 WVPASS bup join $(cat tags1.tmp) >out1.tmp
@@ -283,6 +303,18 @@ WVPASSEQ "$(cat buprestore.tmp/data)" ""
     WVPASS force-delete "$tmp/restore"
     WVPASS bup restore -C $tmp/restore /foo/latest/x/.
     WVPASS "$top/t/compare-trees" $tmp/src/x/ $tmp/restore/
+
+    WVSTART "restore --jobs"
+    WVPASS force-delete "$tmp/restore"
+    WVFAIL bup restore -j 0 -C $tmp/restore /foo/latest/.
+    WVPASS bup restore -j 4 -C $tmp/restore /foo/latest/.
+    WVPASS "$top/t/compare-trees" $tmp/src/ $tmp/restore/
+
+    WVSTART "restore --pack-order"
+    WVPASS force-delete "$tmp/restore"
+    WVFAIL bup restore --pack-order -j 4 -C $tmp/restore /foo/latest/.
+    WVPASS bup restore --pack-order -C $tmp/restore /foo/latest/.
+    WVPASS "$top/t/compare-trees" $tmp/src/ $tmp/restore/
 ) || exit $?
 
 
@@ -320,6 +352,76 @@ WVSTART "save (no index)"
     WVPASS rm -r "$tmp"
 ) || exit $?
 
+WVSTART "chunking parameters"
+(
+    tmp=chunking.tmp
+    WVPASS force-delete $tmp
+    WVPASS mkdir $tmp
+    export BUP_DIR="$(WVPASS pwd)/$tmp/bup" || exit $?
+    WVFAIL bup init --blob-bits=17
+    WVFAIL [ -e "$BUP_DIR" ]
+    WVPASS bup init --chunker=fastcdc --blob-bits=17 --fanout=4
+    WVPASSEQ "$(bup split --params)" "bup.split.chunker=fastcdc
+bup.split.blobbits=17
+bup.split.maxblob=524288
+bup.split.fanout=4
+bup.split.treemax=256"
+    WVPASSEQ "$(bup split -r ":$BUP_DIR" --params | sed -n 1,2p)" \
+        "bup.split.chunker=fastcdc
+bup.split.blobbits=17"
+    WVPASS bup init --fanout=8
+    WVPASS bup random 1M | WVPASS bup split -n data
+    WVFAIL bup init --fanout=16
+    WVPASS bup init --chunker=fastcdc
+    WVPASSEQ "$(bup split --params | sed -n 4p)" "bup.split.fanout=8"
+    WVPASS rm -r "$tmp"
+) || exit $?
+
+WVSTART "midx tiers"
+(
+    tmp=midx-tiers.tmp
+    WVPASS force-delete $tmp
+    WVPASS mkdir $tmp
+    export BUP_DIR="$(WVPASS pwd)/$tmp/bup" || exit $?
+    packs="$BUP_DIR/objects/pack"
+    WVPASS bup init
+    WVFAIL bup midx -a --fan-in 1
+    # Every split writes a pack, and then runs bup midx -a.
+    for i in 1 2 3; do
+        WVPASS echo $i | WVPASS bup split -n s$i
+    done
+    WVPASSEQ "$(ls "$packs" | grep -c '\.midx$')" 0
+    WVPASS echo 4 | WVPASS bup split -n s4
+    WVPASSEQ "$(ls "$packs" | grep -c '\.midx$')" 1
+    WVPASS git --git-dir="$BUP_DIR" config bup.midx.fanin 2
+    WVPASS echo 5 | WVPASS bup split -n s5
+    WVPASS bup midx -a
+    WVPASSEQ "$(ls "$packs" | grep -c '\.midx$')" 1
+    WVPASS bup midx --check -a
+
+    # However small the packs, each object is only rewritten about
+    # log(packs, fan-in) times.
+    WVPASS rm -r "$BUP_DIR"
+    WVPASS bup init
+    WVPASS git --git-dir="$BUP_DIR" config bup.midx.fanin 3
+    seen=" "
+    written=0
+    for i in $(seq 32); do
+        WVPASS echo small $i | WVPASS bup split -n s$i
+        for m in "$packs"/*.midx; do
+            [ -e "$m" ] || continue
+            case "$seen" in *" $m "*) continue ;; esac
+            seen="$seen$m "
+            n=$(WVPASS bup list-idx "$m" | WVPASS wc -l) || exit $?
+            written=$((written + n))
+        done
+    done
+    objects=$(WVPASS bup list-idx "$packs"/*.idx | WVPASS wc -l) || exit $?
+    WVPASS test "$written" -gt 0
+    WVPASS test "$written" -le $((objects * 5))
+    WVPASS rm -r "$tmp"
+) || exit $?
+
 WVSTART "indexfile"
 D=indexfile.tmp
 INDEXFILE=tmpindexfile.tmp